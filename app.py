@@ -1,87 +1,180 @@
-from flask import Flask, request, jsonify, abort, g
+from flask import Flask, request, jsonify, abort, g, Response, stream_with_context
 import sqlite3
 import uuid
 import logging
 import json
 from logging import FileHandler, Formatter
 import time
+import os
+import sys
+import threading
+import atexit
+import hashlib
+import base64
+import calendar
+from datetime import datetime
+import migrations
+import data_filters
+import provisioning
+import purge_jobs
+import rate_limit
+import rollups
+import segment_store
+import sensor_data_store
+import exporter
+import ingest_formats
+import metrics
+import pubsub
+import latest_values
+import tokens
+import writer
+from ingest_queue import IngestQueue, QueueFull
+from key_cache import KeyCache, MISS
 
 app = Flask(__name__)
 
+# Configuración de SQLite, se puede sobrescribir con variables de entorno
+app.config.update(
+    DATABASE=os.environ.get('IOT_DATABASE', 'iot_data.db'),
+    # OFF, NORMAL, FULL o EXTRA. Con WAL, NORMAL no pierde consistencia ante caídas
+    SQLITE_SYNCHRONOUS=os.environ.get('IOT_SQLITE_SYNCHRONOUS', 'NORMAL'),
+    # Bytes a mapear en memoria para lecturas
+    SQLITE_MMAP_SIZE=int(os.environ.get('IOT_SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    # Valores negativos se interpretan en KiB (-65536 = 64 MiB)
+    SQLITE_CACHE_SIZE=int(os.environ.get('IOT_SQLITE_CACHE_SIZE', -65536)),
+    # Segundos que se espera un lock antes de fallar con "database is locked"
+    SQLITE_BUSY_TIMEOUT=float(os.environ.get('IOT_SQLITE_BUSY_TIMEOUT', 5.0)),
+    # Si es False se abre y cierra una conexión por petición
+    SQLITE_PERSISTENT_CONNECTIONS=os.environ.get('IOT_SQLITE_PERSISTENT_CONNECTIONS', '1') != '0',
+    # Aplica las migraciones pendientes al importar la app (gunicorn no ejecuta __main__)
+    AUTO_MIGRATE=os.environ.get('IOT_AUTO_MIGRATE', '1') != '0',
+    # Las lecturas se guardan en particiones por día o por mes (ver sensor_data_store.py)
+    SENSOR_DATA_PARTITION=os.environ.get('IOT_SENSOR_DATA_PARTITION', 'month'),
+    # Días que se conservan las lecturas de las compañías sin política propia; 0 las conserva siempre
+    RETENTION_DAYS=int(os.environ.get('IOT_RETENTION_DAYS', 0)),
+    # Segundos entre cada revisión de retención; 0 la desactiva en segundo plano
+    RETENTION_INTERVAL=float(os.environ.get('IOT_RETENTION_INTERVAL', 3600)),
+    # Segundos entre cada búsqueda de trabajos de purga de ubicaciones y sensores borrados; 0 la desactiva
+    PURGE_INTERVAL=float(os.environ.get('IOT_PURGE_INTERVAL', 5)),
+    # Máximo de lecturas que borra cada transacción de la purga, y segundos de pausa entre una y otra
+    PURGE_CHUNK_SIZE=int(os.environ.get('IOT_PURGE_CHUNK_SIZE', 1000)),
+    PURGE_PAUSE=float(os.environ.get('IOT_PURGE_PAUSE', 0.05)),
+    # Segundos sin avance tras los cuales otro worker puede retomar un trabajo
+    PURGE_LEASE_SECONDS=int(os.environ.get('IOT_PURGE_LEASE_SECONDS', 60)),
+    # Páginas libres que se devuelven al sistema después de cada pasada (auto_vacuum incremental); 0 lo desactiva
+    PURGE_VACUUM_PAGES=int(os.environ.get('IOT_PURGE_VACUUM_PAGES', 1000)),
+    # Métricas por ruta y por sentencia SQL en /metrics
+    METRICS_ENABLED=os.environ.get('IOT_METRICS', '1') != '0',
+    # Sentencias más lentas que estos segundos se registran en el log; 0 lo desactiva
+    SLOW_QUERY_SECONDS=float(os.environ.get('IOT_SLOW_QUERY_SECONDS', 0)),
+    # Archivo del log de consultas lentas; vacío usa el logger de la app
+    SLOW_QUERY_LOG=os.environ.get('IOT_SLOW_QUERY_LOG', ''),
+)
+
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
 # Se crea función que conecta a la base de datos
 def get_db_connection():
-    conn = sqlite3.connect('iot_data.db')
+    synchronous = app.config['SQLITE_SYNCHRONOUS'].upper()
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f'Invalid SQLITE_SYNCHRONOUS value: {synchronous}')
+
+    # Cada conexión la usa un solo hilo; check_same_thread=False solo permite cerrarla al salir.
+    # Con métricas, cada sentencia se mide (ver metrics.py)
+    factory = metrics.InstrumentedConnection if app.config['METRICS_ENABLED'] else sqlite3.Connection
+    conn = sqlite3.connect(app.config['DATABASE'], timeout=app.config['SQLITE_BUSY_TIMEOUT'],
+                           check_same_thread=False, factory=factory)
     conn.row_factory = sqlite3.Row
+    # WAL permite que los lectores no bloqueen al escritor
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA synchronous = {synchronous}')
+    conn.execute('PRAGMA mmap_size = {:d}'.format(app.config['SQLITE_MMAP_SIZE']))
+    conn.execute('PRAGMA cache_size = {:d}'.format(app.config['SQLITE_CACHE_SIZE']))
+    conn.execute('PRAGMA temp_store = MEMORY')
     return conn
 
-# Creación de tablas
-def init_db():
-    try:
-        # Se crea tabla Admin
+# Conexiones reutilizables, una por hilo del worker
+_local = threading.local()
+_open_connections = set()
+_open_connections_lock = threading.Lock()
+
+def _thread_connection():
+    conn = getattr(_local, 'conn', None)
+    # Si cambió la ruta de la base de datos se descarta la conexión anterior
+    if conn is not None and _local.database != app.config['DATABASE']:
+        _discard_connection(conn)
+        conn = None
+    if conn is None:
         conn = get_db_connection()
-        print("Initializing database...")
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS Admin (
-            Username STRING PRIMARY KEY,
-            Password STRING NOT NULL
-        )
-        ''')
-        print("Admin table created.")
-
-        # Se crea la tabla Company
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS Company(
-            ID INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-            Company_name STRING NOT NULL,
-            Company_api_key STRING NOT NULL
-        )
-        ''')
-        print("Company table created.")
-        
-        # Se crea la tabla Location
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS Location(
-            ID INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-            company_id INTEGER NOT NULL,
-            location_name STRING NOT NULL,
-            location_country STRING NOT NULL,
-            location_city STRING NOT NULL,
-            location_meta STRING NOT NULL,
-            FOREIGNKEY company_id REFERENCES Company(ID)
-        )
-        ''')
-        print("Location table created.")
-
-        # Se crea la tabla Sensor
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS Sensor(
-            location_id INTEGER NOT NULL,
-            sensor_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-            sensor_name STRING NOT NULL,
-            sensor_category STRING NOT NULL,
-            sensor_meta STRING NOT NULL,
-            sensor_api_key STRING NOT NULL,
-            FOREIGNKEY location_id REFERENCES Location(ID)
-        )
-        ''')
-        print("Sensor table created.")
-
-        # Se crea la tabla Sensor_Data
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS Sensor_Data(
-            ID INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-            sensor_id INTEGER NOT NULL,
-            data TEXT NOT NULL,
-            time DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGNKEY sensor_id REFERENCES Sensor(sensor_id)
-        )
-        ''')
-        print("Sensor_Data table created.")
-
-        # Confirmar las transacciones realizadas
-        conn.commit()
-        print("Database initialized successfully.")
+        _local.conn = conn
+        _local.database = app.config['DATABASE']
+        with _open_connections_lock:
+            _open_connections.add(conn)
+    return conn
 
+def _discard_connection(conn):
+    with _open_connections_lock:
+        _open_connections.discard(conn)
+    if getattr(_local, 'conn', None) is conn:
+        _local.conn = None
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+# Retorna la conexión de la petición actual, guardada en g
+def get_db():
+    if 'db' not in g:
+        if app.config['SQLITE_PERSISTENT_CONNECTIONS']:
+            g.db = _thread_connection()
+        else:
+            g.db = get_db_connection()
+    return g.db
+
+# Al terminar la petición se deshace cualquier transacción pendiente y se libera la conexión
+@app.teardown_appcontext
+def close_db(exception):
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        # Una conexión en mal estado no se reutiliza
+        _discard_connection(conn)
+        return
+    if not app.config['SQLITE_PERSISTENT_CONNECTIONS']:
+        conn.close()
+
+# Cierra todas las conexiones persistentes al terminar el proceso
+@atexit.register
+def close_all_connections():
+    with _open_connections_lock:
+        connections = list(_open_connections)
+        _open_connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+# Crea las tablas y aplica las migraciones pendientes del esquema
+def init_db():
+    conn = get_db_connection()
+    try:
+        # Las bases nuevas se crean con auto_vacuum incremental para devolver el espacio de lo que se purga
+        # (ver purge_jobs.incremental_vacuum). El modo WAL ya escribió el encabezado, así que el cambio se
+        # aplica con VACUUM, que con la base vacía es inmediato. En una base existente hay que hacerlo a mano
+        if not conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone():
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        version = migrations.current_version(conn)
+        applied = migrations.migrate(conn)
+        for name in applied:
+            print(f"Migration applied: {name}")
+        if applied:
+            print(f"Database migrated from version {version} to {migrations.latest_version()}.")
     except Exception as e:
         print(f"Error initializing database: {str(e)}")
         raise  # Levantar la excepción para identificar problemas durante la inicialización
@@ -89,9 +182,150 @@ def init_db():
         # Cierra la conexión a la base de datos
         conn.close()
 
+# Cache de resolución de credenciales. Cada worker tiene el suyo, por lo que los cambios
+# hechos en otro proceso se ven a lo más después de API_KEY_CACHE_TTL segundos
+app.config.update(
+    API_KEY_CACHE_SIZE=int(os.environ.get('IOT_API_KEY_CACHE_SIZE', 10000)),
+    API_KEY_CACHE_TTL=float(os.environ.get('IOT_API_KEY_CACHE_TTL', 60.0)),
+    API_KEY_CACHE_NEGATIVE_TTL=float(os.environ.get('IOT_API_KEY_CACHE_NEGATIVE_TTL', 10.0)),
+)
+
+def _new_key_cache():
+    return KeyCache(maxsize=app.config['API_KEY_CACHE_SIZE'],
+                    ttl=app.config['API_KEY_CACHE_TTL'],
+                    negative_ttl=app.config['API_KEY_CACHE_NEGATIVE_TTL'])
+
+company_key_cache = _new_key_cache()
+sensor_key_cache = _new_key_cache()
+admin_cache = _new_key_cache()
+
+# Retorna el ID de la compañía dueña del api key, o None si no existe
+@metrics.timed_auth('company')
+def resolve_company_id(company_api_key):
+    company_id = company_key_cache.get(company_api_key)
+    if company_id is MISS:
+        cur = get_db().cursor()
+        cur.execute('SELECT ID FROM Company WHERE Company_api_key = ?', (company_api_key,))
+        company = cur.fetchone()
+        company_id = company['ID'] if company else None
+        company_key_cache.set(company_api_key, company_id)
+    return company_id
+
+# Retorna el sensor_id del sensor dueño del api key, o None si no existe
+@metrics.timed_auth('sensor')
+def resolve_sensor_id(sensor_api_key):
+    sensor_id = sensor_key_cache.get(sensor_api_key)
+    if sensor_id is MISS:
+        cur = get_db().cursor()
+        # Los sensores de una ubicación borrada (sin compañía, pendientes de purga) ya no pueden enviar lecturas
+        cur.execute('SELECT sensor_id FROM Sensor WHERE sensor_api_key = ? AND company_id IS NOT NULL', (sensor_api_key,))
+        sensor = cur.fetchone()
+        sensor_id = sensor['sensor_id'] if sensor else None
+        sensor_key_cache.set(sensor_api_key, sensor_id)
+    return sensor_id
+
+# Resuelve varios api keys de sensores a la vez; retorna {api_key: sensor_id} solo con los válidos
+@metrics.timed_auth('sensor_batch')
+def resolve_sensor_ids(sensor_api_keys):
+    sensors = {}
+    pending = []
+    for api_key in set(sensor_api_keys):
+        sensor_id = sensor_key_cache.get(api_key)
+        if sensor_id is MISS:
+            pending.append(api_key)
+        elif sensor_id is not None:
+            sensors[api_key] = sensor_id
+
+    cur = get_db().cursor()
+    # Se consulta por bloques para no superar el límite de parámetros de SQLite
+    for i in range(0, len(pending), 500):
+        chunk = pending[i:i + 500]
+        cur.execute('SELECT sensor_id, sensor_api_key FROM Sensor WHERE sensor_api_key IN ({}) AND company_id IS NOT NULL'.format(','.join(['?'] * len(chunk))),
+                    chunk)
+        found = {row['sensor_api_key']: row['sensor_id'] for row in cur.fetchall()}
+        for api_key in chunk:
+            sensor_key_cache.set(api_key, found.get(api_key))
+        sensors.update(found)
+    return sensors
+
+# Retorna el Username si las credenciales son válidas, o None.
+# La contraseña no se guarda en el cache, solo su hash
+@metrics.timed_auth('admin')
+def resolve_admin(username, password):
+    key = (username, hashlib.sha256(password.encode('utf-8')).hexdigest())
+    admin = admin_cache.get(key)
+    if admin is MISS:
+        cur = get_db().cursor()
+        cur.execute('SELECT * FROM Admin WHERE Username = ? AND Password = ?', (username, password))
+        row = cur.fetchone()
+        admin = row['Username'] if row else None
+        admin_cache.set(key, admin)
+    return admin
+
+# Tokens de acceso firmados (ver tokens.py)
+app.config.update(
+    # Claves de firma separadas por coma; se firma con la última y se aceptan todas.
+    # Vacío usa la clave generada en la base al migrar
+    TOKEN_SECRET=os.environ.get('IOT_TOKEN_SECRET', ''),
+    # Segundos de validez de cada token
+    TOKEN_TTL=int(os.environ.get('IOT_TOKEN_TTL', 900)),
+    # Segundos máximos sin releer las épocas de revocación (las revocaciones hechas en otro worker
+    # tardan a lo más esto en aplicarse)
+    TOKEN_REVOCATION_REFRESH=float(os.environ.get('IOT_TOKEN_REVOCATION_REFRESH', 5.0)),
+)
+
+_access_tokens = None
+_access_tokens_lock = threading.Lock()
+
+def _load_token_epochs():
+    cur = get_db().cursor()
+    cur.execute('SELECT scope, subject, epoch FROM Token_Epoch')
+    return {(row['scope'], row['subject']): row['epoch'] for row in cur.fetchall()}
+
+# Se crea en la primera petición que usa tokens, porque la clave puede estar en la base
+def get_access_tokens():
+    global _access_tokens
+    if _access_tokens is None:
+        with _access_tokens_lock:
+            if _access_tokens is None:
+                secret_keys = [key.strip() for key in app.config['TOKEN_SECRET'].split(',') if key.strip()]
+                if not secret_keys:
+                    cur = get_db().cursor()
+                    cur.execute('SELECT secret FROM Token_Secret')
+                    secret_keys = [row['secret'] for row in cur.fetchall()]
+                _access_tokens = tokens.AccessTokens(secret_keys, ttl=app.config['TOKEN_TTL'],
+                                                     refresh_seconds=app.config['TOKEN_REVOCATION_REFRESH'],
+                                                     load_epochs=_load_token_epochs)
+    return _access_tokens
+
+# Token del header Authorization: Bearer <token>, o None
+def bearer_token():
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return None
+    return token.strip()
+
+# Identidad del token Bearer para el scope pedido, o None si la petición no trae token.
+# Si el token es inválido, expiró, fue revocado o es de otro scope aborta con 401
+@metrics.timed_auth('token')
+def token_subject(scope):
+    token = bearer_token()
+    if token is None:
+        return None
+    try:
+        return get_access_tokens().verify(token, scope)
+    except tokens.InvalidToken as e:
+        abort(401, str(e))
+
 # Se crea un decorador que se encarga de validar el company_api_key
 def require_company_api_key(f):
     def decorator(*args, **kwargs):
+        # Con un token de compañía no se consulta la base
+        company_id = token_subject('company')
+        if company_id is not None:
+            g.company_id = company_id
+            return check_company_rate_limit(company_id) or f(*args, **kwargs)
+
         # Obtiene el company_api_key de los parámetros de la petición.
         company_api_key = request.headers.get('company_api_key')
         # Si no es válido el api key, aborta la petición con un error HTTP 400
@@ -99,40 +333,37 @@ def require_company_api_key(f):
             abort(400, 'company_api_key is required')
         
         # Si el api key es válido, busca la compañía a la que corresponde
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT ID FROM Company WHERE Company_api_key = ?', (company_api_key,))
-        company = cur.fetchone()
-        conn.close()
-        
+        company_id = resolve_company_id(company_api_key)
+
         # Si no la encuentra, aborta la petición con error HTTP 401
-        if not company:
+        if company_id is None:
             abort(401, 'Invalid company_api_key')
-        
-        g.company_id = company['ID']
-        # Ejecuta la función original si el API key es válido
-        return f(*args, **kwargs)
+
+        g.company_id = company_id
+        # Ejecuta la función original si el API key es válido y la compañía no superó su límite
+        return check_company_rate_limit(company_id) or f(*args, **kwargs)
     decorator.__name__ = f.__name__
     return decorator
 
 # Se crea validador del sensor_api_key
 def require_sensor_api_key(f):
     def decorator(*args, **kwargs):
+        sensor_id = token_subject('sensor')
+        if sensor_id is not None:
+            g.sensor_id = sensor_id
+            return f(*args, **kwargs)
+
         sensor_api_key = request.json['api_key']
 
         if not sensor_api_key:
             abort(400, 'sensor_api_key is required')
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT sensor_id FROM Sensor WHERE sensor_api_key = ?', (sensor_api_key,))
-        sensor = cur.fetchone()
-        conn.close()
+        sensor_id = resolve_sensor_id(sensor_api_key)
 
-        if not sensor:
+        if sensor_id is None:
             abort(401, 'Invalid sensor_api_key')
 
-        g.sensor_id = sensor['sensor_id']
+        g.sensor_id = sensor_id
         return f(*args, **kwargs)
     decorator.__name__ = f.__name__
     return decorator
@@ -140,22 +371,23 @@ def require_sensor_api_key(f):
 # Se crea un decorador que se encarga de validar el Admin
 def require_admin(f):
     def decorator(*args, **kwargs):
+        admin = token_subject('admin')
+        if admin is not None:
+            g.admin = admin
+            return f(*args, **kwargs)
+
         username = request.headers.get('Username')
         password = request.headers.get('Password')
         
         if not username or not password:
             abort(401, 'Admin credentials are required')
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM Admin WHERE Username = ? AND Password = ?', (username, password))
-        admin = cur.fetchone()
-        conn.close()
-        
-        if not admin:
+        admin = resolve_admin(username, password)
+
+        if admin is None:
             abort(403, 'Invalid admin credentials')
-        
-        g.admin = admin['Username']
+
+        g.admin = admin
         
         return f(*args, **kwargs)
     decorator.__name__ = f.__name__
@@ -168,7 +400,7 @@ def generate_api_key():
 # Crear Admin
 @app.route('/api/v1/crea_admin', methods=['POST'])
 def create_admin():
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     try:
         # Obtener información para crear al admin
@@ -180,18 +412,126 @@ def create_admin():
     except Exception as e:
         conn.rollback()
         return jsonify({'error': str(e)}), 500
-    finally:
-        conn.close()
+
+    # Puede haber credenciales de este usuario guardadas como inválidas
+    admin_cache.clear()
 
     return jsonify({'message': 'Successfully created'}), 201
 
+# TOKENS DE ACCESO
+
+# Canjea credenciales por un token firmado de corta duración que se envía como Authorization: Bearer.
+# Headers Username y Password entregan un token de admin, company_api_key uno de compañía
+# y sensor_api_key uno de sensor
+@app.route('/api/v1/token', methods=['POST'])
+def issue_token():
+    username = request.headers.get('Username')
+    password = request.headers.get('Password')
+    if username and password:
+        scope, subject = 'admin', resolve_admin(username, password)
+        if subject is None:
+            abort(403, 'Invalid admin credentials')
+    elif request.headers.get('company_api_key'):
+        scope, subject = 'company', resolve_company_id(request.headers['company_api_key'])
+        if subject is None:
+            abort(401, 'Invalid company_api_key')
+    elif request.headers.get('sensor_api_key'):
+        scope, subject = 'sensor', resolve_sensor_id(request.headers['sensor_api_key'])
+        if subject is None:
+            abort(401, 'Invalid sensor_api_key')
+    else:
+        abort(400, 'Admin credentials, company_api_key or sensor_api_key are required')
+
+    token = get_access_tokens().issue(scope, subject)
+    return jsonify({'access_token': token, 'token_type': 'Bearer', 'expires_in': app.config['TOKEN_TTL'],
+                    'scope': scope, 'subject': subject}), 201
+
+# Incrementa la época de revocación de una identidad; sus tokens emitidos hasta ahora dejan de ser válidos
+def revoke_tokens(conn, scope, subject):
+    epoch = bump_token_epoch(conn.cursor(), scope, subject)
+    conn.commit()
+    get_access_tokens().set_epoch(scope, subject, epoch)
+    return epoch
+
+# Incrementa la época de revocación dentro de la transacción en curso; retorna la época nueva.
+# Después del commit hay que registrarla con get_access_tokens().set_epoch
+def bump_token_epoch(cur, scope, subject):
+    cur.execute('INSERT INTO Token_Epoch(scope, subject, epoch) VALUES(?, ?, 1) '
+                'ON CONFLICT(scope, subject) DO UPDATE SET epoch = epoch + 1 RETURNING epoch',
+                (scope, str(subject)))
+    return cur.fetchone()[0]
+
+# Admin revoca los tokens de una identidad: {"scope": "admin" | "company" | "sensor", "subject": ...}
+@app.route('/api/v1/token/revoke', methods=['POST'])
+@require_admin
+def revoke_token():
+    scope = request.json.get('scope')
+    subject = request.json.get('subject')
+    if scope not in tokens.SCOPES:
+        abort(400, 'scope must be admin, company or sensor')
+    if scope == 'admin':
+        valid = isinstance(subject, str)
+    else:
+        valid = isinstance(subject, int) and not isinstance(subject, bool)
+    if not valid:
+        abort(400, 'subject must be a Username for admin or an ID for company and sensor')
+    epoch = revoke_tokens(get_db(), scope, subject)
+    return jsonify({'scope': scope, 'subject': subject, 'epoch': epoch, 'message': 'Tokens revoked'}), 200
+
+# Admin consulta los contadores de tokens de este worker
+@app.route('/api/v1/stats/tokens', methods=['GET'])
+@require_admin
+def get_token_stats():
+    return jsonify(get_access_tokens().stats()), 200
+
+# Admin consulta los contadores del cache de api keys de este worker
+@app.route('/api/v1/stats/api_key_cache', methods=['GET'])
+@require_admin
+def get_api_key_cache_stats():
+    return jsonify({
+        'company': company_key_cache.stats(),
+        'sensor': sensor_key_cache.stats(),
+        'admin': admin_cache.stats(),
+    }), 200
+
+# Admin consulta el estado de la cola de ingesta de este worker
+@app.route('/api/v1/stats/ingest_queue', methods=['GET'])
+@require_admin
+def get_ingest_queue_stats():
+    if not app.config['INGEST_QUEUE_ENABLED']:
+        return jsonify({'enabled': False}), 200
+    return jsonify(dict(get_ingest_queue().stats(), enabled=True)), 200
+
+# Admin consulta la tabla de últimas lecturas de este worker
+@app.route('/api/v1/stats/latest_readings', methods=['GET'])
+@require_admin
+def get_latest_readings_stats():
+    return jsonify(latest_readings.stats()), 200
+
+# Admin consulta las suscripciones SSE de este worker
+@app.route('/api/v1/stats/subscriptions', methods=['GET'])
+@require_admin
+def get_subscription_stats():
+    return jsonify(reading_broker.stats()), 200
+
+# Admin consulta los contadores del proceso escritor (compartido por todos los workers)
+@app.route('/api/v1/stats/writer', methods=['GET'])
+@require_admin
+def get_writer_stats():
+    if not app.config['WRITER_SOCKET']:
+        return jsonify({'enabled': False}), 200
+    try:
+        return jsonify(dict(sensor_data.stats(), enabled=True)), 200
+    except writer.WriterError as e:
+        return jsonify({'error': str(e)}), 503
+
 # TABLA Company
 
 # Admin crea Company
 @app.route('/api/v1/company', methods=['POST'])
 @require_admin
 def create_company():
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     # Obtener información para crear la compañía y agregarla a la tabla
@@ -201,7 +541,7 @@ def create_company():
     cur.execute('INSERT INTO Company(Company_name, Company_api_key) VALUES(?, ?)', (company_name, company_api_key))
     conn.commit()
     company_id = cur.lastrowid
-    conn.close()
+    company_key_cache.invalidate(company_api_key)
 
     return jsonify({'company_id': company_id, 'company_api_key': company_api_key,  'message': 'Successfully created'}), 201
 
@@ -210,11 +550,10 @@ def create_company():
 # Valida el admin
 @require_admin
 def get_companys():
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     cur.execute('SELECT * FROM Company')
     rows = cur.fetchall()
-    conn.close()
     return jsonify([dict(row) for row in rows]), 200
 
 # TABLA LOCATION
@@ -223,7 +562,7 @@ def get_companys():
 @app.route('/api/v1/location', methods=['POST'])
 @require_admin
 def create_location():
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     # Obtiene las variables
@@ -237,7 +576,6 @@ def create_location():
                 (company_id, location_name, location_country, location_city, location_meta))
     conn.commit()
     location_id = cur.lastrowid
-    conn.close()
     
     return jsonify({'location_id': location_id, 'message': 'Successfully created'}), 201
 
@@ -246,22 +584,20 @@ def create_location():
 # Valida el api key
 @require_company_api_key
 def get_locations():
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     cur.execute('SELECT * FROM Location WHERE company_id = ?', (g.company_id,))
     rows = cur.fetchall()
-    conn.close()
     return jsonify([dict(row) for row in rows]), 200
 
 # Muestra uno de tabla Location, por nombre 
 @app.route('/api/v1/location/<location_name>', methods=['GET'])
 @require_company_api_key
 def get_location(location_name):
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     cur.execute('SELECT * FROM Location WHERE location_name = ? AND company_id = ?', (location_name, g.company_id))
     location = cur.fetchone()
-    conn.close()
     if not location:
         abort(404, 'Location not found')
     return jsonify(dict(location)), 200
@@ -270,14 +606,13 @@ def get_location(location_name):
 @app.route('/api/v1/location/<location_name>', methods=['PUT'])
 @require_company_api_key
 def update_location(location_name):
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     
     # Obtener la ubicación actual
     cur.execute('SELECT * FROM Location WHERE location_name = ? AND company_id = ?', (location_name, g.company_id))
     location = cur.fetchone()
     if not location:
-        conn.close()
         abort(404, 'Location not found')
 
     # Actualizar la ubicación
@@ -293,29 +628,45 @@ def update_location(location_name):
     ''', (location_name2, location_country, location_city, location_meta, location_name, g.company_id))
     
     conn.commit()
-    conn.close()
     return jsonify({'message': 'Updated successfully'}), 200
 
 # Elimina en tabla Location
 @app.route('/api/v1/location/<location_name>', methods=['DELETE'])
 @require_company_api_key
 def delete_location(location_name):
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     
     # Verificar si la ubicación existe
     cur.execute('SELECT * FROM Location WHERE location_name = ? AND company_id = ?', (location_name, g.company_id))
     location = cur.fetchone()
     if not location:
-        conn.close()
         abort(404, 'Location not found')
     
+    cur.execute('SELECT sensor_id, sensor_api_key FROM Sensor WHERE location_id IN '
+                '(SELECT ID FROM Location WHERE location_name = ? AND company_id = ?)', (location_name, g.company_id))
+    sensors = cur.fetchall()
+    sensor_ids = [sensor['sensor_id'] for sensor in sensors]
+
+    # Los sensores de la ubicación dejan de pertenecer a la compañía; sus lecturas y filas las borra
+    # un trabajo en segundo plano (ver purge_jobs.py)
+    cur.execute('UPDATE Sensor SET company_id = NULL WHERE location_id IN (SELECT ID FROM Location WHERE location_name = ? AND company_id = ?)',
+                (location_name, g.company_id))
+
     # Eliminar la ubicación
     cur.execute('DELETE FROM Location WHERE location_name = ? AND company_id = ?', (location_name, g.company_id))
+    job_id = purge_jobs.create_job(cur, 'location', location_name, g.company_id, sensor_ids)
+    # Los tokens emitidos para los sensores dejan de ser válidos
+    epochs = [(sensor_id, bump_token_epoch(cur, 'sensor', sensor_id)) for sensor_id in sensor_ids]
     
     conn.commit()
-    conn.close()
-    return jsonify({'message': 'Deleted successfully'}), 200
+    for sensor in sensors:
+        sensor_key_cache.invalidate(sensor['sensor_api_key'])
+        latest_readings.invalidate(sensor['sensor_id'])
+    forget_sensor_rate_limits(sensor_ids)
+    for sensor_id, epoch in epochs:
+        get_access_tokens().set_epoch('sensor', sensor_id, epoch)
+    return jsonify({'message': 'Deleted successfully', 'purge_job_id': job_id}), 200
 
 # TABLA SENSOR
 
@@ -323,7 +674,7 @@ def delete_location(location_name):
 @app.route('/api/v1/sensor', methods=['POST'])
 @require_admin
 def created_sensor():
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     # Obtiene variables
@@ -333,11 +684,12 @@ def created_sensor():
     sensor_meta = request.json['sensor_meta']
     sensor_api_key = generate_api_key()
 
-    cur.execute('INSERT INTO Sensor(location_id, sensor_name, sensor_category, sensor_meta, sensor_api_key) VALUES(?, ?, ?, ?, ?)', 
-                (location_id, sensor_name, sensor_category, sensor_meta, sensor_api_key))
+    # company_id se copia de la ubicación para autorizar con una sola búsqueda por sensor_id
+    cur.execute('INSERT INTO Sensor(location_id, sensor_name, sensor_category, sensor_meta, sensor_api_key, company_id) VALUES(?, ?, ?, ?, ?, (SELECT company_id FROM Location WHERE ID = ?))', 
+                (location_id, sensor_name, sensor_category, sensor_meta, sensor_api_key, location_id))
     conn.commit()
     sensor_id = cur.lastrowid
-    conn.close()
+    sensor_key_cache.invalidate(sensor_api_key)
 
     return jsonify({'sensor_id': sensor_id, 'sensor_api_key': sensor_api_key, 'message': 'Successfully created'}), 201
 
@@ -347,40 +699,90 @@ def created_sensor():
 # Valida el api key
 @require_company_api_key
 def get_sensors():
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
-    cur.execute('SELECT * FROM Sensor WHERE location_id IN (SELECT ID FROM Location WHERE company_id = ?)', (g.company_id,))    
+    cur.execute('SELECT * FROM Sensor WHERE company_id = ?', (g.company_id,))    
     rows = cur.fetchall()
-    conn.close()
     return jsonify([dict(row) for row in rows]), 200
 
+# JSON de una lectura de la tabla de últimas lecturas, igual al de GET /api/v1/sensor_data/<ID>
+def latest_reading_json(reading):
+    sensor_data_id, sensor_id, data_json, ts = reading
+    return exporter.sensor_data_json({'ID': sensor_data_id, 'sensor_id': sensor_id, 'data': data_json,
+                                      'time': format_time(ts), 'ts': ts})
+
+# Última lectura de cada sensor de la compañía, agrupada por ubicación. Las lecturas salen de memoria;
+# solo se consulta la jerarquía de ubicaciones y sensores. latest es null si el sensor no tiene lecturas
+@app.route('/api/v1/sensor/latest', methods=['GET'])
+@require_company_api_key
+def get_latest_snapshot():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+    SELECT l.ID AS location_id, l.location_name, s.sensor_id, s.sensor_name, s.sensor_category
+    FROM Location l LEFT JOIN Sensor s ON s.location_id = l.ID
+    WHERE l.company_id = ?
+    ORDER BY l.ID, s.sensor_id
+    ''', (g.company_id,))
+    rows = cur.fetchall()
+    latest = latest_readings.get_many(conn, [row['sensor_id'] for row in rows if row['sensor_id'] is not None])
+
+    # Se arma el JSON a mano para incrustar data tal como está guardado
+    locations = []
+    for row in rows:
+        if not locations or locations[-1][0] != row['location_id']:
+            locations.append((row['location_id'], row['location_name'], []))
+        if row['sensor_id'] is None:
+            continue
+        reading = latest.get(row['sensor_id'])
+        locations[-1][2].append('{"latest":%s,"sensor_category":%s,"sensor_id":%d,"sensor_name":%s}' % (
+            latest_reading_json(reading) if reading else 'null', json.dumps(row['sensor_category']),
+            row['sensor_id'], json.dumps(row['sensor_name'])))
+    body = '{"locations":[%s]}' % ','.join(
+        '{"location_id":%d,"location_name":%s,"sensors":[%s]}' % (location_id, json.dumps(location_name), ','.join(sensors))
+        for location_id, location_name, sensors in locations)
+    return json_response(body)
+
 # Muestra uno de tabla Sensor que se encuentre en las ubicaciones de la compañía validada por api key
 @app.route('/api/v1/sensor/<int:sensor_id>', methods=['GET'])
 @require_company_api_key
 def get_sensor(sensor_id):
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
-    cur.execute('SELECT * FROM Sensor WHERE sensor_id = ? AND location_id IN (SELECT ID FROM Location WHERE company_id = ?)', 
+    cur.execute('SELECT * FROM Sensor WHERE sensor_id = ? AND company_id = ?', 
                 (sensor_id, g.company_id))
     row = cur.fetchone()
-    conn.close()
     if not row:
         abort(404, 'Sensor not found')
     return jsonify(dict(row)), 200
 
+# Última lectura de un sensor de la compañía, desde memoria
+@app.route('/api/v1/sensor/<int:sensor_id>/latest', methods=['GET'])
+@require_company_api_key
+def get_sensor_latest(sensor_id):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('SELECT 1 FROM Sensor WHERE sensor_id = ? AND company_id = ?',
+                (sensor_id, g.company_id))
+    if not cur.fetchone():
+        abort(404, 'Sensor not found')
+    reading = latest_readings.get(conn, sensor_id)
+    if reading is None:
+        abort(404, 'Sensor has no readings')
+    return json_response(latest_reading_json(reading))
+
 # Edita en tabla Sensor
 @app.route('/api/v1/sensor/<int:sensor_id>', methods=['PUT'])
 @require_company_api_key
 def update_sensor(sensor_id):
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     # Obtener el sensor
-    cur.execute('SELECT * FROM Sensor WHERE sensor_id = ? AND location_id IN (SELECT ID FROM Location WHERE company_id = ?)', 
+    cur.execute('SELECT * FROM Sensor WHERE sensor_id = ? AND company_id = ?', 
                 (sensor_id, g.company_id))
     sensor = cur.fetchone()
     if not sensor:
-        conn.close()
         abort(404, 'Sensor not found')
 
     # Actualizar sensor
@@ -388,86 +790,650 @@ def update_sensor(sensor_id):
     sensor_name = request.json['sensor_name']
     sensor_category = request.json['sensor_category']
     sensor_meta = request.json['sensor_meta']
+
+    # Solo se puede mover a una ubicación de la misma compañía, así company_id no cambia
+    cur.execute('SELECT ID FROM Location WHERE ID = ? AND company_id = ?', (location_id, g.company_id))
+    if not cur.fetchone():
+        abort(404, 'Location not found')
     
-    cur.execute('UPDATE Sensor SET location_id = ?, sensor_name = ?, sensor_category = ?, sensor_meta = ? WHERE sensor_id = ? AND location_id IN (SELECT ID FROM Location WHERE company_id = ?)', 
+    cur.execute('UPDATE Sensor SET location_id = ?, sensor_name = ?, sensor_category = ?, sensor_meta = ? WHERE sensor_id = ? AND company_id = ?', 
                 (location_id, sensor_name, sensor_category, sensor_meta, sensor_id, g.company_id))
     conn.commit()
-    conn.close()
+    sensor_key_cache.invalidate(sensor['sensor_api_key'])
     return jsonify({'message': 'Updated successfully'}), 200
 
 # Elimina en tabla Sensor
 @app.route('/api/v1/sensor/<int:sensor_id>', methods=['DELETE'])
 @require_company_api_key
 def delete_sensor(sensor_id):
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
     
     # Verificar si el sensor existe
-    cur.execute('SELECT * FROM Sensor WHERE sensor_id = ? AND location_id IN (SELECT ID FROM Location WHERE company_id = ?)', 
+    cur.execute('SELECT * FROM Sensor WHERE sensor_id = ? AND company_id = ?', 
                 (sensor_id, g.company_id))
     sensor = cur.fetchone()
     if not sensor:
-        conn.close()
         abort(404, 'Sensor not found')
     
-    # Eliminar la ubicación
-    cur.execute('DELETE FROM Sensor WHERE sensor_id = ? AND location_id IN (SELECT ID FROM Location WHERE company_id = ?)', 
+    # Eliminar el sensor; sus lecturas las borra un trabajo en segundo plano (ver purge_jobs.py)
+    cur.execute('DELETE FROM Sensor WHERE sensor_id = ? AND company_id = ?', 
                 (sensor_id, g.company_id))
+    job_id = purge_jobs.create_job(cur, 'sensor', str(sensor_id), g.company_id, [sensor_id])
+    # Los tokens emitidos para el sensor dejan de ser válidos, en la misma transacción del borrado
+    epoch = bump_token_epoch(cur, 'sensor', sensor_id)
     
     conn.commit()
-    conn.close()
-    return jsonify({'message': 'Deleted successfully'}), 200
+    sensor_key_cache.invalidate(sensor['sensor_api_key'])
+    latest_readings.invalidate(sensor_id)
+    forget_sensor_rate_limits([sensor_id])
+    get_access_tokens().set_epoch('sensor', sensor_id, epoch)
+    return jsonify({'message': 'Deleted successfully', 'purge_job_id': job_id}), 200
+
+# ALTA MASIVA DE UBICACIONES Y SENSORES
+
+# Admin crea ubicaciones y sensores en una sola petición y una sola transacción (ver provisioning.py).
+# Acepta JSON {"locations": [...], "sensors": [...]} o un CSV con un sensor por línea.
+# Retorna los IDs y api keys en el orden de entrada; si algo es inválido no se crea nada
+@app.route('/api/v1/provisioning', methods=['POST'])
+@require_admin
+def provision():
+    try:
+        if request.mimetype in ingest_formats.CSV_TYPES:
+            locations, sensors = provisioning.from_csv(request.get_data(as_text=True))
+        else:
+            locations, sensors = provisioning.from_object(request.get_json(silent=True))
+    except provisioning.InvalidProvisioning as e:
+        return jsonify({'error': str(e), 'errors': e.errors}), 400
+
+    api_keys = [generate_api_key() for _ in sensors]
+    conn = get_db()
+    cur = conn.cursor()
+    # El lock de escritura se toma antes de revisar las referencias, así nadie borra una ubicación entremedio
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        location_companies = provisioning.check_references(cur, locations, sensors)
+        location_ids, sensor_ids = provisioning.insert(cur, locations, sensors, api_keys, location_companies)
+        conn.commit()
+    except provisioning.InvalidProvisioning as e:
+        conn.rollback()
+        return jsonify({'error': str(e), 'errors': e.errors}), 400
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 500
+
+    for api_key in api_keys:
+        sensor_key_cache.invalidate(api_key)
+
+    created_locations = []
+    for location, location_id in zip(locations, location_ids):
+        created = {'location_id': location_id, 'company_id': location['company_id'], 'location_name': location['location_name']}
+        if location['ref'] is not None:
+            created['ref'] = location['ref']
+        created_locations.append(created)
+    created_sensors = [{'sensor_id': sensor_id, 'sensor_api_key': api_key, 'sensor_name': sensor['sensor_name'],
+                        'location_id': location_ids[sensor['location_ref']] if sensor['location_ref'] is not None
+                        else sensor['location_id']}
+                       for sensor, sensor_id, api_key in zip(sensors, sensor_ids, api_keys)]
+    return jsonify({'locations': created_locations, 'sensors': created_sensors, 'message': 'Successfully created'}), 201
 
 # TABLA SENSOR_DATA
 
+# Lee las lecturas de la petición según su Content-Type y retorna una lista de (api_key, data_json):
+# - application/json: {"api_key": ..., "data": ...} (o el lote). Si viene el header sensor_api_key
+#   o un token de sensor, el cuerpo completo es data y se guarda tal cual, sin decodificarlo ni volver
+#   a codificarlo; con token api_key es None
+# - application/msgpack: la misma estructura que en JSON, codificada con MessagePack
+# - text/csv: ver ingest_formats.from_csv
+def read_readings(batch):
+    mimetype = request.mimetype
+    try:
+        if mimetype in ingest_formats.MSGPACK_TYPES:
+            return ingest_formats.from_msgpack(request.get_data(), batch)
+        if mimetype in ingest_formats.CSV_TYPES:
+            readings = ingest_formats.from_csv(request.get_data(as_text=True))
+        elif not batch and (request.headers.get('sensor_api_key') or bearer_token()):
+            readings = [(request.headers.get('sensor_api_key'), request.get_data(as_text=True))]
+        else:
+            return ingest_formats.from_object(request.json, batch)
+    except ingest_formats.InvalidPayload as e:
+        abort(400, str(e))
+
+    # El JSON que se guarda sin pasar por json.loads se valida antes de escribir
+    invalid = ingest_formats.first_invalid_json(get_db(), [data_json for _, data_json in readings])
+    if invalid is not None:
+        abort(400, f'Reading {invalid} has invalid JSON data')
+    return readings
+
 # Crea Sensor_Data
 @app.route('/api/v1/sensor_data', methods=['POST'])
 def insert_sensor_data():
-    sensor_api_key = request.json['api_key']
-
-    if not sensor_api_key:
-        abort(400, 'sensor_api_key is required')
+    readings = read_readings(batch=False)
+    if len(readings) != 1:
+        abort(400, 'Use /api/v1/sensor_data/batch to send several readings')
+    sensor_api_key, data_json = readings[0]
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT sensor_id FROM Sensor WHERE sensor_api_key = ?', (sensor_api_key,))
-    sensor = cur.fetchone()
-    conn.close()
+    if sensor_api_key is None:
+        sensor_id = token_subject('sensor')
+    else:
+        sensor_id = resolve_sensor_id(sensor_api_key)
 
-    if not sensor:
+    if sensor_id is None:
+        abort(401, 'Invalid sensor_api_key')
+    limited = check_ingest_rate_limit([sensor_id])
+    if limited is not None:
+        return limited
+
+    conn = get_db()
+    ack = ingest_ack_mode()
+
+    # Con la cola activa la lectura la escribe el hilo escritor junto con otras (group commit)
+    if app.config['INGEST_QUEUE_ENABLED']:
+        ingest_queue = get_ingest_queue()
+        try:
+            pending = ingest_queue.put([(sensor_id, data_json)], wait_commit=ack == 'commit',
+                                       timeout=app.config['INGEST_ENQUEUE_TIMEOUT'])
+        except QueueFull as e:
+            return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+        if ack == 'enqueue':
+            # El ID se asigna cuando el hilo escritor hace commit
+            return jsonify({'queue_depth': ingest_queue.depth(), 'message': 'Accepted'}), 202
+        try:
+            ids, tiempo = pending.wait(app.config['INGEST_COMMIT_TIMEOUT'])
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+        return jsonify({'sensor_data_id': ids[0], 'tiempo': tiempo, 'message': 'Successfully created'}), 201
+
+    ids, tiempo = insert_sensor_data_rows(conn, [(sensor_id, data_json)])
+
+    return jsonify({'sensor_data_id': ids[0], 'tiempo': tiempo, 'message': 'Successfully created'}), 201
+
+# Máximo de lecturas aceptadas en un solo lote
+MAX_BATCH_SIZE = 5000
+
+# Formato de texto de la columna time
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def format_time(ts):
+    return time.strftime(TIME_FORMAT, time.gmtime(ts))
+
+# Convierte un tiempo recibido en la API (epoch o texto 'YYYY-MM-DD HH:MM:SS' en UTC) a epoch.
+# Retorna None si no se puede interpretar
+def parse_time(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return calendar.timegm(datetime.fromisoformat(value.strip()).utctimetuple())
+        except ValueError:
+            return None
+    return None
+
+# Suscripciones a lecturas nuevas (SSE)
+app.config.update(
+    # Eventos pendientes por suscriptor; si se llena, el suscriptor se expulsa y debe reconectarse
+    SSE_BUFFER_SIZE=int(os.environ.get('IOT_SSE_BUFFER_SIZE', 1000)),
+    SSE_MAX_SUBSCRIBERS=int(os.environ.get('IOT_SSE_MAX_SUBSCRIBERS', 1000)),
+    # Segundos entre comentarios de keepalive cuando no hay lecturas
+    SSE_KEEPALIVE_SECONDS=float(os.environ.get('IOT_SSE_KEEPALIVE_SECONDS', 15.0)),
+)
+
+reading_broker = pubsub.Broker(buffer_size=app.config['SSE_BUFFER_SIZE'],
+                               max_subscribers=app.config['SSE_MAX_SUBSCRIBERS'])
+
+# Almacenamiento de las lecturas (ver la interfaz en sensor_data_store.SqliteBackend)
+app.config.update(
+    # sqlite: particiones en la base. segments: log de solo escritura al final por sensor (ver segment_store.py).
+    # Cambiar de backend no migra las lecturas existentes
+    SENSOR_DATA_BACKEND=os.environ.get('IOT_SENSOR_DATA_BACKEND', 'sqlite'),
+    SEGMENT_DIR=os.environ.get('IOT_SEGMENT_DIR', ''),
+    # Tamaño al que se cierra un segmento y se empieza otro
+    SEGMENT_MAX_BYTES=int(os.environ.get('IOT_SEGMENT_MAX_BYTES', 8 * 1024 * 1024)),
+    # Cada cuántos registros se guarda una entrada del índice disperso en memoria
+    SEGMENT_INDEX_INTERVAL=int(os.environ.get('IOT_SEGMENT_INDEX_INTERVAL', 64)),
+    # fsync después de cada escritura; sin fsync una caída del sistema puede perder las últimas lecturas
+    SEGMENT_FSYNC=os.environ.get('IOT_SEGMENT_FSYNC', '0') != '0',
+    # Segundos entre cada compactación de segmentos; 0 la desactiva en segundo plano
+    SEGMENT_COMPACTION_INTERVAL=float(os.environ.get('IOT_SEGMENT_COMPACTION_INTERVAL', 600)),
+)
+
+def create_sensor_data_backend():
+    backend = app.config['SENSOR_DATA_BACKEND']
+    if backend == 'sqlite':
+        return sensor_data_store.SqliteBackend(app.config['SENSOR_DATA_PARTITION'])
+    if backend == 'segments':
+        # Por defecto los segmentos quedan junto a la base
+        root = app.config['SEGMENT_DIR'] or app.config['DATABASE'] + '.segments'
+        return segment_store.SegmentStore(root, max_segment_bytes=app.config['SEGMENT_MAX_BYTES'],
+                                          index_interval=app.config['SEGMENT_INDEX_INTERVAL'],
+                                          fsync=app.config['SEGMENT_FSYNC'])
+    raise ValueError(f'Invalid SENSOR_DATA_BACKEND value: {backend}')
+
+sensor_data = create_sensor_data_backend()
+
+# Proceso escritor único (ver writer.py y gunicorn.conf.py)
+app.config.update(
+    # Socket Unix del proceso escritor; vacío escribe desde cada worker. gunicorn.conf.py lo define
+    WRITER_SOCKET=os.environ.get('IOT_WRITER_SOCKET', ''),
+    # Segundos que un worker espera la respuesta del escritor
+    WRITER_TIMEOUT=float(os.environ.get('IOT_WRITER_TIMEOUT', 10.0)),
+    # Máximo de lecturas por transacción al juntar inserciones de varios workers
+    WRITER_MAX_BATCH=int(os.environ.get('IOT_WRITER_MAX_BATCH', 5000)),
+    # Segundos que se espera al escritor en cambios de esquema de Sensor_Data (índices de campos frecuentes)
+    WRITER_SCHEMA_TIMEOUT=float(os.environ.get('IOT_WRITER_SCHEMA_TIMEOUT', 600.0)),
+)
+
+if app.config['WRITER_SOCKET']:
+    sensor_data = writer.RemoteWriteBackend(sensor_data, writer.WriterClient(app.config['WRITER_SOCKET'],
+                                                                             timeout=app.config['WRITER_TIMEOUT']),
+                                            schema_timeout=app.config['WRITER_SCHEMA_TIMEOUT'])
+
+# Corre en el proceso escritor, con su propio backend local y su propia conexión
+def serve_writer():
+    server = writer.WriterServer(app.config['WRITER_SOCKET'], create_sensor_data_backend(), get_db_connection,
+                                 max_batch=app.config['WRITER_MAX_BATCH'], logger=app.logger)
+    server.serve_forever()
+
+# Lo llama el maestro de gunicorn antes de crear los workers. El proceso escritor importa este módulo con
+# las mismas variables de entorno y llama a serve_writer()
+def start_writer_process():
+    command = [sys.executable, '-c', 'import app; app.serve_writer()']
+    process = writer.WriterProcess(app.config['WRITER_SOCKET'], command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   logger=app.logger)
+    process.start()
+    return process
+
+# Última lectura de cada sensor en memoria (ver latest_values.py)
+app.config.update(
+    # Segundos máximos sin revisar en la base las lecturas que insertaron otros workers
+    LATEST_REFRESH_SECONDS=float(os.environ.get('IOT_LATEST_REFRESH_SECONDS', 1.0)),
+    # Carga las últimas lecturas al importar la app en vez de hacerlo en la primera consulta
+    LATEST_WARM_ON_START=os.environ.get('IOT_LATEST_WARM_ON_START', '1') != '0',
+)
+
+latest_readings = latest_values.LatestValues(sensor_data, refresh_seconds=app.config['LATEST_REFRESH_SECONDS'])
+
+# Inserta varias lecturas en una sola transacción y las publica a los suscriptores.
+# rows es una lista de tuplas (sensor_id, data_json); retorna los ids asignados y el tiempo común del lote
+def insert_sensor_data_rows(conn, rows):
+    ts = int(time.time())
+
+    # Se publica junto al commit para que los suscriptores reciban los ids en orden
+    def publish(ids):
+        if reading_broker.has_subscribers():
+            reading_broker.publish([(sensor_id, (sensor_data_id, sensor_id, data_json, ts))
+                                    for sensor_data_id, (sensor_id, data_json) in zip(ids, rows)])
+
+    ids = sensor_data.insert(conn, rows, ts, after_commit=publish)
+    latest_readings.record([(sensor_data_id, sensor_id, data_json, ts)
+                            for sensor_data_id, (sensor_id, data_json) in zip(ids, rows)])
+    return ids, format_time(ts)
+
+# Cola de ingesta con group commit
+app.config.update(
+    INGEST_QUEUE_ENABLED=os.environ.get('IOT_INGEST_QUEUE', '1') != '0',
+    # Máximo de peticiones encoladas; al llenarse se responde 503 con Retry-After
+    INGEST_QUEUE_SIZE=int(os.environ.get('IOT_INGEST_QUEUE_SIZE', 10000)),
+    # Máximo de peticiones por commit y segundos que se espera para juntar más
+    INGEST_MAX_BATCH=int(os.environ.get('IOT_INGEST_MAX_BATCH', 500)),
+    INGEST_MAX_DELAY=float(os.environ.get('IOT_INGEST_MAX_DELAY', 0.02)),
+    # commit: se responde después del commit (201). enqueue: se responde al encolar (202).
+    # Cada petición puede elegir con ?ack= o el header X-Ack
+    INGEST_ACK=os.environ.get('IOT_INGEST_ACK', 'commit'),
+    INGEST_ENQUEUE_TIMEOUT=float(os.environ.get('IOT_INGEST_ENQUEUE_TIMEOUT', 1.0)),
+    INGEST_COMMIT_TIMEOUT=float(os.environ.get('IOT_INGEST_COMMIT_TIMEOUT', 10.0)),
+)
+
+INGEST_ACK_MODES = ('commit', 'enqueue')
+
+_ingest_queue = None
+_ingest_queue_lock = threading.Lock()
+
+# Corre en el hilo escritor. Cada payload es una lista de (sensor_id, data_json);
+# retorna por payload los ids asignados y el tiempo del commit
+def _write_queued_readings(payloads):
+    rows = [row for payload in payloads for row in payload]
+    ids, tiempo = insert_sensor_data_rows(_thread_connection(), rows)
+    results = []
+    offset = 0
+    for payload in payloads:
+        results.append((ids[offset:offset + len(payload)], tiempo))
+        offset += len(payload)
+    return results
+
+# Con el proceso escritor, una respuesta perdida no asegura que el lote no se escribió
+def _ingest_retryable(error):
+    return not isinstance(error, writer.WriterReplyLost)
+
+# La cola y su hilo se crean en el primer uso, así cada worker de gunicorn tiene la suya después del fork
+def get_ingest_queue():
+    global _ingest_queue
+    if _ingest_queue is not None and _ingest_queue.pid == os.getpid():
+        return _ingest_queue
+    with _ingest_queue_lock:
+        if _ingest_queue is None or _ingest_queue.pid != os.getpid():
+            _ingest_queue = IngestQueue(_write_queued_readings,
+                                        max_size=app.config['INGEST_QUEUE_SIZE'],
+                                        max_batch=app.config['INGEST_MAX_BATCH'],
+                                        max_delay=app.config['INGEST_MAX_DELAY'],
+                                        retryable=_ingest_retryable,
+                                        logger=app.logger)
+            # Al terminar el proceso se escriben las lecturas pendientes
+            atexit.register(_ingest_queue.stop)
+    return _ingest_queue
+
+def ingest_ack_mode():
+    ack = request.args.get('ack') or request.headers.get('X-Ack') or app.config['INGEST_ACK']
+    if ack not in INGEST_ACK_MODES:
+        abort(400, 'ack must be commit or enqueue')
+    return ack
+
+# Crea varios Sensor_Data en una sola petición.
+# Acepta {"readings": [{"api_key": ..., "data": ...}, ...]} o directamente el arreglo de lecturas,
+# en JSON o MessagePack, o un CSV con una lectura por línea (ver read_readings)
+@app.route('/api/v1/sensor_data/batch', methods=['POST'])
+def insert_sensor_data_batch():
+    # Todas las lecturas se validan antes de escribir
+    readings = read_readings(batch=True)
+    if len(readings) > MAX_BATCH_SIZE:
+        abort(400, f'A batch accepts at most {MAX_BATCH_SIZE} readings')
+
+    # Resolver cada api key una sola vez
+    sensors = resolve_sensor_ids(api_key for api_key, _ in readings)
+    if any(api_key not in sensors for api_key, _ in readings):
         abort(401, 'Invalid sensor_api_key')
 
-    sensor_id = sensor['sensor_id']
+    rows = [(sensors[api_key], data_json) for api_key, data_json in readings]
+    limited = check_ingest_rate_limit(sensor_id for sensor_id, _ in rows)
+    if limited is not None:
+        return limited
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    # El lote ya se escribe en una sola transacción; la cola solo se usa si se pide ack=enqueue
+    if ingest_ack_mode() == 'enqueue' and app.config['INGEST_QUEUE_ENABLED']:
+        ingest_queue = get_ingest_queue()
+        try:
+            ingest_queue.put(rows, wait_commit=False, timeout=app.config['INGEST_ENQUEUE_TIMEOUT'])
+        except QueueFull as e:
+            return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+        return jsonify({'count': len(rows), 'queue_depth': ingest_queue.depth(), 'message': 'Accepted'}), 202
 
-    # Obtiene variable
-    data = request.json['data']
-    data_json = json.dumps(data)
+    try:
+        ids, tiempo = insert_sensor_data_rows(get_db(), rows)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-    cur.execute('INSERT INTO Sensor_Data(sensor_id, data) VALUES(?, ?)', 
-                (sensor_id, data_json))
-    conn.commit()
-    sensor_data_id = cur.lastrowid
+    # Se responde en el mismo orden de entrada
+    items = [{'sensor_data_id': sensor_data_id, 'sensor_id': sensor_id, 'tiempo': tiempo}
+             for sensor_data_id, (sensor_id, _) in zip(ids, rows)]
+    return jsonify({'items': items, 'count': len(items), 'message': 'Successfully created'}), 201
+
+# Canal de ingesta de larga duración
+app.config.update(
+    # Lecturas por ventana: cada ventana se escribe en una transacción y se confirma con una línea de ack
+    STREAM_WINDOW_SIZE=int(os.environ.get('IOT_STREAM_WINDOW_SIZE', 500)),
+    # Una ventana se cierra antes si pasan estos segundos desde su primera lectura
+    STREAM_WINDOW_SECONDS=float(os.environ.get('IOT_STREAM_WINDOW_SECONDS', 1.0)),
+    # Largo máximo en bytes de una línea (una lectura)
+    STREAM_MAX_LINE=int(os.environ.get('IOT_STREAM_MAX_LINE', 65536)),
+)
+
+# Escribe las lecturas de una ventana, a través de la cola de ingesta si está activa
+def _write_stream_window(rows):
+    if app.config['INGEST_QUEUE_ENABLED']:
+        pending = get_ingest_queue().put(rows, wait_commit=True, timeout=app.config['INGEST_ENQUEUE_TIMEOUT'])
+        return pending.wait(app.config['INGEST_COMMIT_TIMEOUT'])
+    return insert_sensor_data_rows(get_db(), rows)
+
+# Lee el cuerpo línea por línea; retorna (número de línea, texto) o (número, None) si la línea es muy larga
+def _stream_lines(stream, max_line):
+    number = 0
+    while True:
+        line = stream.readline(max_line + 1)
+        if not line:
+            return
+        number += 1
+        if len(line) > max_line and not line.endswith(b'\n'):
+            # Se descarta el resto de la línea
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_line + 1)
+            yield number, None
+            continue
+        text = line.decode('utf-8', errors='replace').strip()
+        if text:
+            yield number, text
+
+def _ingest_stream(sensor_id, stream):
+    window_size = app.config['STREAM_WINDOW_SIZE']
+    window_seconds = app.config['STREAM_WINDOW_SECONDS']
+    total = 0
+    windows = 0
+    lines = []
+    rejected = []
+    window_started = None
+
+    def flush():
+        nonlocal total, windows, lines, rejected, window_started
+        texts = [text for _, text in lines]
+        invalid = set(ingest_formats.invalid_json_indexes(get_db(), texts))
+        rejected.extend(number for i, (number, _) in enumerate(lines) if i in invalid)
+        rows = [(sensor_id, text) for i, text in enumerate(texts) if i not in invalid]
+        ack = {'window': windows + 1, 'accepted': len(rows), 'rejected': rejected}
+        if rows:
+            throttle_ingest_stream(sensor_id, len(rows))
+            ids, tiempo = _write_stream_window(rows)
+            ack.update(first_id=ids[0], last_id=ids[-1], tiempo=tiempo)
+        total += len(rows)
+        windows += 1
+        ack['total'] = total
+        lines, rejected, window_started = [], [], None
+        return json.dumps(ack) + '\n'
 
-    # Para saber el tiempo
-    cur.execute('SELECT * FROM Sensor_Data WHERE ID = ?', (sensor_data_id,))
-    sensor_data = cur.fetchone()
+    try:
+        for number, text in _stream_lines(stream, app.config['STREAM_MAX_LINE']):
+            if text is None:
+                rejected.append(number)
+            else:
+                lines.append((number, text))
+                if window_started is None:
+                    window_started = time.monotonic()
+            if len(lines) >= window_size or (window_started is not None and time.monotonic() - window_started >= window_seconds):
+                yield flush()
+        if lines or rejected:
+            yield flush()
+    except Exception as e:
+        # Las ventanas ya confirmadas quedan escritas; el cliente reenvía desde la última confirmada
+        app.logger.error('Ingest stream failed after %d readings: %s', total, e)
+        yield json.dumps({'error': str(e), 'total': total}) + '\n'
+        return
+    yield json.dumps({'message': 'Stream closed', 'total': total, 'windows': windows}) + '\n'
+
+# Canal de ingesta para sensores que reportan varias veces por segundo.
+# El sensor se autentica una vez con el header sensor_api_key (o un token de sensor) y envía un cuerpo (normalmente con
+# Transfer-Encoding: chunked) con una lectura por línea: el JSON de data, que se guarda tal cual.
+# Las lecturas se escriben por ventanas y la respuesta, en NDJSON, trae una línea de ack por ventana
+# con los ids asignados y los números de línea rechazados.
+# Los workers sync de gunicorn leen el cuerpo chunked en bloques de 1 KiB, así que con pocas lecturas
+# la ventana se cierra cuando llega ese bloque o cuando termina el cuerpo
+@app.route('/api/v1/sensor_data/stream', methods=['POST'])
+def ingest_sensor_data_stream():
+    sensor_id = token_subject('sensor')
+    if sensor_id is None:
+        sensor_api_key = request.headers.get('sensor_api_key')
+        if not sensor_api_key:
+            abort(400, 'sensor_api_key is required')
+        sensor_id = resolve_sensor_id(sensor_api_key)
+        if sensor_id is None:
+            abort(401, 'Invalid sensor_api_key')
 
-    conn.close()
+    return Response(stream_with_context(_ingest_stream(sensor_id, request.stream)), mimetype='application/x-ndjson')
 
-    return jsonify({'sensor_data_id': sensor_data_id, 'tiempo': sensor_data['time'], 'message': 'Successfully created'}), 201
+def _sse_event(sensor_data_id, sensor_id, data_json, ts):
+    row = {'ID': sensor_data_id, 'data': data_json, 'sensor_id': sensor_id, 'time': format_time(ts), 'ts': ts}
+    return f'id: {sensor_data_id}\nevent: reading\ndata: {exporter.sensor_data_json(row)}\n\n'
 
-# Muestra todo de tabla Sensor_Data que correspondan a los sensores de las ubicaciones de la compañía validada por api key
+def _subscription_stream(subscription, sensor_ids, last_event_id):
+    keepalive = app.config['SSE_KEEPALIVE_SECONDS']
+    try:
+        yield 'retry: 2000\n\n'
+        # Al reanudar se envía desde la base lo insertado después de Last-Event-ID. La suscripción ya
+        # está activa, así que los eventos en vivo que también salieron de la base se omiten
+        caught_up = last_event_id
+        if last_event_id is not None:
+            chunk = []
+            for row in sensor_data.iter_after_id(get_db(), sensor_ids, last_event_id, g.company_id,
+                                                 chunk_size=STREAM_CHUNK_SIZE):
+                chunk.append(_sse_event(row['ID'], row['sensor_id'], row['data'], row['ts']))
+                caught_up = max(caught_up, row['ID'])
+                if len(chunk) >= STREAM_CHUNK_SIZE:
+                    yield ''.join(chunk)
+                    chunk = []
+            if chunk:
+                yield ''.join(chunk)
+
+        while True:
+            events = subscription.get(keepalive)
+            if subscription.evicted:
+                # El cliente se reconecta con Last-Event-ID y recupera lo perdido desde la base
+                yield 'event: evicted\ndata: {"reason": "slow consumer"}\n\n'
+                return
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+            if caught_up is not None:
+                events = [event for event in events if event[0] > caught_up]
+            yield ''.join(_sse_event(*event) for event in events)
+    finally:
+        subscription.close()
+
+# Suscripción Server-Sent Events a las lecturas nuevas de sensores de la compañía.
+# sensor_id es opcional (repetido o separado por comas); sin él se reciben todos los sensores de la compañía.
+# Cada evento trae como id el ID de la lectura; al reconectar con el header Last-Event-ID (o ?last_event_id=)
+# se envían primero las lecturas guardadas después de ese ID.
+# Las lecturas se reparten dentro de cada worker; con varios workers, lo insertado en otro worker
+# llega al reconectar. Cada suscripción ocupa un hilo, por lo que se necesitan workers con --threads
+@app.route('/api/v1/sensor_data/subscribe', methods=['GET'])
+@require_company_api_key
+def subscribe_sensor_data():
+    sensor_ids = parse_sensor_ids(request.args.getlist('sensor_id'))
+    if sensor_ids is None:
+        abort(400, 'Invalid sensor_id')
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id is not None:
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            abort(400, 'Invalid Last-Event-ID')
+
+    cur = get_db().cursor()
+    query = 'SELECT sensor_id FROM Sensor WHERE company_id = ?'
+    params = [g.company_id]
+    if sensor_ids:
+        query += ' AND sensor_id IN ({})'.format(','.join(['?'] * len(sensor_ids)))
+        params.extend(sensor_ids)
+    cur.execute(query, params)
+    sensor_ids = [row['sensor_id'] for row in cur.fetchall()]
+    if not sensor_ids:
+        abort(404, 'Sensor not found')
+
+    subscription = reading_broker.subscribe(sensor_ids)
+    if subscription is None:
+        return jsonify({'error': 'Too many subscribers'}), 503, {'Retry-After': '5'}
+
+    response = Response(stream_with_context(_subscription_stream(subscription, sensor_ids, last_event_id)),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Si el cliente se va antes de empezar a leer, el generador no alcanza a cerrar la suscripción
+    response.call_on_close(subscription.close)
+    return response
+
+# Tamaño de página por defecto y máximo al paginar Sensor_Data
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+# Filas que se leen del cursor por vez al transmitir la respuesta
+STREAM_CHUNK_SIZE = 500
+
+# Acepta sensor_id repetido (?sensor_id=1&sensor_id=2) o separado por comas (?sensor_id=1,2)
+def parse_sensor_ids(values):
+    sensor_ids = []
+    for value in values:
+        for part in value.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                sensor_ids.append(int(part))
+            except ValueError:
+                return None
+    # Se eliminan duplicados manteniendo el orden
+    return list(dict.fromkeys(sensor_ids))
+
+# Filtra los sensores que pertenecen a la compañía validada, manteniendo el orden
+def company_sensor_ids(cur, sensor_ids):
+    owned = set()
+    for i in range(0, len(sensor_ids), 500):
+        chunk = sensor_ids[i:i + 500]
+        cur.execute('SELECT sensor_id FROM Sensor WHERE sensor_id IN ({}) AND company_id = ?'.format(','.join(['?'] * len(chunk))),
+                    chunk + [g.company_id])
+        owned.update(row['sensor_id'] for row in cur.fetchall())
+    return [sensor_id for sensor_id in sensor_ids if sensor_id in owned]
+
+# El cursor de continuación es la posición (ts, ID) de la última fila entregada, codificada en base64
+def encode_cursor(ts, row_id):
+    return base64.urlsafe_b64encode(f'{ts}:{row_id}'.encode('ascii')).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('ascii')
+        ts, row_id = raw.split(':')
+        return int(ts), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+# Respuesta JSON ya serializada. Las lecturas se arman con exporter.sensor_data_json para
+# incrustar data sin codificarlo dos veces
+def json_response(body, status=200):
+    return Response(body + '\n', status=status, mimetype='application/json')
+
+# Emite las filas a medida que salen del cursor, sin cargarlas todas en memoria
+def stream_rows(rows, ndjson):
+    if not ndjson:
+        yield '['
+    first = True
+    chunk = []
+    for row in rows:
+        item = exporter.sensor_data_json(row)
+        if ndjson:
+            chunk.append(item + '\n')
+        else:
+            chunk.append(item if first else ',' + item)
+            first = False
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+    if not ndjson:
+        yield ']'
+
+# Muestra todo de tabla Sensor_Data que correspondan a los sensores de las ubicaciones de la compañía validada por api key.
+# Sin limit ni cursor responde el arreglo completo como antes. Con limit o cursor responde una página
+# ordenada por (ts, ID) y un next_cursor. Con stream=ndjson o stream=json la respuesta se transmite por partes.
+# filter (repetible) filtra por campos de data, p. ej. filter=temperature>40 (ver data_filters.py)
 @app.route('/api/v1/sensor_data', methods=['GET'])
 # Valida el api key
 @require_company_api_key
 def get_sensors_data():
     from_time = request.args.get('from')
     to_time = request.args.get('to')
-    sensor_ids = request.args.get('sensor_id')
+    sensor_ids = parse_sensor_ids(request.args.getlist('sensor_id'))
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    stream = request.args.get('stream')
 
+    if sensor_ids is None:
+        abort(400, 'Invalid sensor_id')
     if not from_time or not to_time or not sensor_ids:
         abort(400, 'Missing required parameters')
 
@@ -477,94 +1443,839 @@ def get_sensors_data():
     except ValueError:
         return jsonify({"error": "Invalid timestamp format"}), 400
 
-    # Convertir timestamps de EPOCH a formato datetime
-    from_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(from_time))
-    to_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(to_time))
+    if stream is not None and stream not in ('json', 'ndjson'):
+        abort(400, 'stream must be json or ndjson')
 
+    try:
+        filters = data_filters.parse_filters(request.args.getlist('filter'))
+    except ValueError as e:
+        abort(400, str(e))
+
+    paginate = stream is None and (limit is not None or cursor is not None)
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            abort(400, 'Invalid limit')
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            abort(400, f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    elif paginate:
+        limit = DEFAULT_PAGE_SIZE
+
+    position = None
+    if cursor is not None:
+        position = decode_cursor(cursor)
+        if position is None:
+            abort(400, 'Invalid cursor')
+
+    # Solo se consideran los sensores de la compañía validada
+    conn = get_db()
+    sensor_ids = company_sensor_ids(conn.cursor(), sensor_ids)
+    if not sensor_ids:
+        abort(404, 'Sensor not found')
 
-    # Crear la query para que acepte un arreglo de ids
-    query = 'SELECT * FROM Sensor_Data WHERE time BETWEEN ? AND ?'
-    params = [from_date, to_date]
+    # Solo se leen las particiones que se traslapan con el rango; ts es epoch, así que se compara directo.
+    # Al paginar se pide una fila extra para saber si hay otra página
+    rows = sensor_data.iter_range(conn, sensor_ids, from_time, to_time, after=position,
+                                  limit=limit + 1 if paginate else limit, company_id=g.company_id,
+                                  chunk_size=STREAM_CHUNK_SIZE, filters=filters)
+
+    if stream is not None:
+        ndjson = stream == 'ndjson'
+        mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+        return Response(stream_with_context(stream_rows(rows, ndjson)), mimetype=mimetype)
+
+    rows = list(rows)
+    if not paginate:
+        return json_response('[' + ','.join(map(exporter.sensor_data_json, rows)) + ']')
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['ts'], rows[-1]['ID'])
+    items = ','.join(map(exporter.sensor_data_json, rows))
+    return json_response('{"count":%d,"items":[%s],"next_cursor":%s}' % (len(rows), items, json.dumps(next_cursor)))
+
+# Agregados por bucket (count/min/max/avg/last) de los campos numéricos de data.
+# bucket acepta valores como 1m, 15m, 1h o 1d. Si el bucket es múltiplo de un tamaño precalculado
+# se responde desde Sensor_Data_Rollup; source=raw obliga a calcular desde las lecturas
+@app.route('/api/v1/sensor_data/aggregate', methods=['GET'])
+@require_company_api_key
+def aggregate_sensor_data():
+    from_time = request.args.get('from')
+    to_time = request.args.get('to')
+    sensor_ids = parse_sensor_ids(request.args.getlist('sensor_id'))
+    bucket = rollups.parse_bucket(request.args.get('bucket', '1h'))
+    fields = [field for value in request.args.getlist('field') for field in value.split(',') if field]
+    source = request.args.get('source', 'auto')
 
-    if sensor_ids:
-        query += " AND sensor_id IN ({})".format(','.join(['?'] * len(sensor_ids)))
-        params.extend(sensor_ids)
+    if sensor_ids is None:
+        abort(400, 'Invalid sensor_id')
+    if not from_time or not to_time or not sensor_ids:
+        abort(400, 'Missing required parameters')
+    try:
+        from_time = int(from_time)
+        to_time = int(to_time)
+    except ValueError:
+        return jsonify({"error": "Invalid timestamp format"}), 400
+    if bucket is None:
+        abort(400, 'Invalid bucket')
+    if (to_time - from_time) // bucket + 1 > rollups.MAX_BUCKETS:
+        abort(400, f'A query returns at most {rollups.MAX_BUCKETS} buckets')
+    if source not in ('auto', 'raw', 'rollup'):
+        abort(400, 'source must be auto, raw or rollup')
+
+    conn = get_db()
+
+    # Solo se consideran los sensores de la compañía validada
+    sensor_ids = company_sensor_ids(conn.cursor(), sensor_ids)
+    if not sensor_ids:
+        abort(404, 'Sensor not found')
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    try:
+        rows, used_source = sensor_data.aggregate(conn, sensor_ids, from_time, to_time, bucket, fields, source,
+                                                  g.company_id)
+    except ValueError as e:
+        abort(400, str(e))
+
+    series = []
+    current = None
+    for row in rows:
+        if current is None or (current['sensor_id'], current['field']) != (row['sensor_id'], row['field']):
+            current = {'sensor_id': row['sensor_id'], 'field': row['field'], 'buckets': []}
+            series.append(current)
+        current['buckets'].append({
+            'start': row['bucket'],
+            'time': format_time(row['bucket']),
+            'count': row['count'],
+            'min': row['min'],
+            'max': row['max'],
+            'avg': row['avg'],
+            'last': row['last'],
+        })
+
+    return jsonify({
+        'bucket': request.args.get('bucket', '1h'),
+        'bucket_seconds': bucket,
+        'source': used_source,
+        'series': series,
+    }), 200
+
+# EXPORTACIÓN DE SENSOR_DATA
+
+# Filas que se leen del cursor por vez al exportar
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'columnar': ('application/octet-stream', 'bin'),
+}
+
+# Columnas enteras del formato columnar
+COLUMNAR_INT_COLUMNS = ('ID', 'sensor_id', 'ts')
+
+def _export_rows(conn, sensor_ids, from_time, to_time, company_id, snapshot):
+    rows = sensor_data.iter_range(conn, sensor_ids, from_time, to_time, company_id=company_id,
+                                  chunk_size=EXPORT_CHUNK_SIZE, snapshot=snapshot)
+    return exporter.chunked(rows, EXPORT_CHUNK_SIZE)
+
+# Cada columna se escribe completa antes de la siguiente, así que se recorre el rango una vez por columna.
+# Todas las pasadas leen el mismo snapshot (se abre antes de contar)
+def _export_columnar(conn, sensor_ids, from_time, to_time, company_id, fields, snapshot):
+    count = sensor_data.count_range(conn, sensor_ids, from_time, to_time, company_id, snapshot=snapshot)
+    columns = [(name, '<i8') for name in COLUMNAR_INT_COLUMNS] + [('data.' + field, '<f8') for field in fields]
+    yield exporter.columnar_header(count, columns)
+
+    for name in COLUMNAR_INT_COLUMNS:
+        rows = sensor_data.iter_range(conn, sensor_ids, from_time, to_time, company_id=company_id,
+                                      chunk_size=EXPORT_CHUNK_SIZE, snapshot=snapshot)
+        for chunk in exporter.chunked(rows, EXPORT_CHUNK_SIZE):
+            yield exporter.column_chunk((row[name] for row in chunk), 'q')
+
+    for field in fields:
+        values = sensor_data.iter_field_values(conn, sensor_ids, from_time, to_time, field, company_id=company_id,
+                                               chunk_size=EXPORT_CHUNK_SIZE, snapshot=snapshot)
+        for chunk in exporter.chunked(values, EXPORT_CHUNK_SIZE):
+            yield exporter.column_chunk((float('nan') if value is None else value for value in chunk), 'd')
+
+def _export_stream(snapshot, chunks):
+    try:
+        yield from chunks
+    finally:
+        snapshot.close()
 
-    # Crea la consulta con la query anterior, se entregan los ids y los tiempos
-    cur.execute(query, params)
-    rows = cur.fetchall()
-    conn.close()
+# Exporta las lecturas de sensores de la compañía en un rango de tiempo, leyendo el cursor por partes.
+# format=csv|ndjson (comprimidos con gzip por defecto) o format=columnar (sin comprimir por defecto,
+# para poder mapearlo en memoria; ver exporter.py). compression=gzip|none cambia el default
+@app.route('/api/v1/sensor_data/export', methods=['GET'])
+@require_company_api_key
+def export_sensor_data():
+    from_time = request.args.get('from')
+    to_time = request.args.get('to')
+    sensor_ids = parse_sensor_ids(request.args.getlist('sensor_id'))
+    export_format = request.args.get('format', 'csv')
+    fields = [field for value in request.args.getlist('field') for field in value.split(',') if field]
 
-    return jsonify([dict(row) for row in rows]), 200
+    if sensor_ids is None:
+        abort(400, 'Invalid sensor_id')
+    if not from_time or not to_time or not sensor_ids:
+        abort(400, 'Missing required parameters')
+    try:
+        from_time = int(from_time)
+        to_time = int(to_time)
+    except ValueError:
+        return jsonify({"error": "Invalid timestamp format"}), 400
+    if export_format not in EXPORT_FORMATS:
+        abort(400, 'format must be csv, ndjson or columnar')
+    compression = request.args.get('compression', 'none' if export_format == 'columnar' else 'gzip')
+    if compression not in ('gzip', 'none'):
+        abort(400, 'compression must be gzip or none')
+    if any('"' in field for field in fields):
+        abort(400, 'Invalid field')
+
+    conn = get_db()
+
+    # Solo se exportan los sensores de la compañía validada
+    sensor_ids = company_sensor_ids(conn.cursor(), sensor_ids)
+    if not sensor_ids:
+        abort(404, 'Sensor not found')
+
+    # Todas las lecturas de la exportación salen del mismo snapshot
+    snapshot = sensor_data.open_snapshot(conn)
+    if export_format == 'csv':
+        chunks = exporter.csv_chunks(_export_rows(conn, sensor_ids, from_time, to_time, g.company_id, snapshot))
+    elif export_format == 'ndjson':
+        chunks = exporter.ndjson_chunks(_export_rows(conn, sensor_ids, from_time, to_time, g.company_id, snapshot))
+    else:
+        if not fields:
+            # Sin field se exportan los campos numéricos que aparecen en el rango
+            fields = [field for field in sensor_data.fields_in_range(conn, sensor_ids, from_time, to_time, snapshot=snapshot)
+                      if '"' not in field]
+        chunks = _export_columnar(conn, sensor_ids, from_time, to_time, g.company_id, fields, snapshot)
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    filename = f'sensor_data_{from_time}_{to_time}.{extension}'
+    if compression == 'gzip':
+        chunks = exporter.gzip_chunks(chunks)
+        mimetype = 'application/gzip'
+        filename += '.gz'
+
+    return Response(stream_with_context(_export_stream(snapshot, chunks)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 # Muestra uno de tabla Sensor_Data que se encuentre en el sensor de las ubicaciones de la compañía validada por api key
 @app.route('/api/v1/sensor_data/<int:ID>', methods=['GET'])
 @require_company_api_key
 def get_sensor_data(ID):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM Sensor_Data WHERE ID = ? AND sensor_id IN (SELECT sensor_id FROM Sensor WHERE location_id IN (SELECT ID FROM Location WHERE company_id = ?))', 
-                (ID, g.company_id))
-    row = cur.fetchone()
-    conn.close()
+    row = sensor_data.find(get_db(), ID, g.company_id)
     if not row:
         abort(404, 'Sensor not found')
-    return jsonify(dict(row)), 200
+    return json_response(exporter.sensor_data_json(row))
 
 
 # Edita en tabla Sensor_Data
 @app.route('/api/v1/sensor_data/<int:ID>', methods=['PUT'])
 @require_company_api_key
 def update_sensor_data(ID):
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    # Obtener el sensor data para ver si existe
-    cur.execute('SELECT * FROM Sensor_Data WHERE ID = ? AND sensor_id IN (SELECT sensor_id FROM Sensor WHERE location_id IN (SELECT ID FROM Location WHERE company_id = ?))', 
-                (ID, g.company_id))
-    sensor_data = cur.fetchone()
-    if not sensor_data:
-        conn.close()
-        abort(404, 'Sensor Data not found')
-
     # Actualizar sensor_data
     data = request.json['data']
-    time = request.json['time']
+    ts = parse_time(request.json['time'])
+    if ts is None:
+        abort(400, 'Invalid time format')
 
     data_json = json.dumps(data)
-    
-    cur.execute('UPDATE Sensor_Data SET data = ?, time = ? WHERE ID = ? AND sensor_id IN (SELECT sensor_id FROM Sensor WHERE location_id IN (SELECT ID FROM Location WHERE company_id = ?))', 
-                (data_json, time, ID, g.company_id))
-    conn.commit()
-    conn.close()
+
+    # Retorna la lectura anterior, o None si no existe
+    previous = sensor_data.update(get_db(), ID, g.company_id, data_json, ts)
+    if not previous:
+        abort(404, 'Sensor Data not found')
+    latest_readings.invalidate(previous['sensor_id'])
     return jsonify({'message': 'Updated successfully'}), 200
 
 # Elimina en tabla Sensor_Data
 @app.route('/api/v1/sensor_data/<int:ID>', methods=['DELETE'])
 @require_company_api_key
 def delete_sensor_data(ID):
+    # Elimina la lectura y retorna la fila borrada, o None si no existe
+    deleted = sensor_data.delete(get_db(), ID, g.company_id)
+    if not deleted:
+        abort(404, 'Sensor data not found')
+    latest_readings.invalidate(deleted['sensor_id'])
+    return jsonify({'message': 'Deleted successfully'}), 200
+
+# CAMPOS FRECUENTES DE DATA
+
+# Admin consulta los campos frecuentes declarados por categoría de sensor y sus columnas
+@app.route('/api/v1/hot_fields', methods=['GET'])
+@require_admin
+def get_hot_fields():
+    cur = get_db().cursor()
+    cur.execute('SELECT sensor_category, path, created_at FROM Hot_Field ORDER BY sensor_category, path')
+    return jsonify([dict(row, column=data_filters.column_name(row['path'])) for row in cur.fetchall()]), 200
+
+# Admin reemplaza los campos frecuentes de una categoría: {"fields": ["temperature", "probe.status"]}.
+# Cada campo pasa a ser una columna generada con índice en las particiones de Sensor_Data
+@app.route('/api/v1/hot_fields/<sensor_category>', methods=['PUT'])
+@require_admin
+def set_hot_fields(sensor_category):
+    fields = request.json.get('fields')
+    if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+        abort(400, 'fields must be a list of field paths')
+    if len(set(fields)) > data_filters.MAX_HOT_FIELDS:
+        abort(400, f'At most {data_filters.MAX_HOT_FIELDS} hot fields are allowed per category')
+    try:
+        for field in fields:
+            data_filters.parse_path(field)
+    except ValueError as e:
+        abort(400, str(e))
+    return _apply_hot_fields(sensor_category, sorted(set(fields)))
+
+# Admin quita los campos frecuentes de una categoría; las columnas que ya no usa ninguna categoría se eliminan
+@app.route('/api/v1/hot_fields/<sensor_category>', methods=['DELETE'])
+@require_admin
+def delete_hot_fields(sensor_category):
+    return _apply_hot_fields(sensor_category, [])
+
+def _apply_hot_fields(sensor_category, fields):
+    if not hasattr(sensor_data, 'set_hot_fields'):
+        abort(400, f'Hot fields are not supported by the {sensor_data.name} backend')
+    try:
+        added, dropped = sensor_data.set_hot_fields(get_db(), sensor_category, fields)
+    except sqlite3.Error as e:
+        return jsonify({'error': str(e)}), 500
+    except writer.WriterError as e:
+        # Reemplazar los campos de nuevo es seguro si no se supo si el escritor alcanzó a aplicarlos
+        return jsonify({'error': str(e)}), 503
+    return jsonify({'sensor_category': sensor_category, 'fields': fields,
+                    'columns_added': added, 'columns_dropped': dropped, 'message': 'Updated successfully'}), 200
+
+# RETENCIÓN DE SENSOR_DATA
+
+_retention_thread = None
+_retention_lock = threading.Lock()
+
+# Borra las particiones vencidas usando una conexión propia (se llama fuera de una petición)
+def run_retention():
     conn = get_db_connection()
+    try:
+        dropped = sensor_data.apply_retention(conn, app.config['RETENTION_DAYS'])
+    finally:
+        conn.close()
+    if dropped:
+        app.logger.info('Retention dropped partitions: %s', ', '.join(dropped))
+        # Puede haberse borrado la última lectura de algún sensor
+        latest_readings.clear()
+    return dropped
+
+def _retention_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            run_retention()
+        except Exception:
+            # Si la base está ocupada se reintenta en la siguiente vuelta; el hilo no debe terminar
+            app.logger.exception('Retention failed')
+
+# El hilo de retención se inicia en la primera petición de cada worker
+@app.before_request
+def start_retention_thread():
+    global _retention_thread
+    interval = app.config['RETENTION_INTERVAL']
+    if interval <= 0 or (_retention_thread is not None and _retention_thread.pid == os.getpid()):
+        return
+    with _retention_lock:
+        if _retention_thread is None or _retention_thread.pid != os.getpid():
+            _retention_thread = threading.Thread(target=_retention_loop, args=(interval,), name='retention', daemon=True)
+            _retention_thread.pid = os.getpid()
+            _retention_thread.start()
+
+# COMPACTACIÓN DE SEGMENTOS
+
+_compaction_thread = None
+_compaction_lock = threading.Lock()
+
+def _compaction_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            compacted = sensor_data.compact()
+        except Exception:
+            # Un segmento corrupto no debe terminar el hilo; se reintenta en la siguiente vuelta
+            app.logger.exception('Compaction failed')
+            continue
+        if compacted:
+            app.logger.info('Compacted segments of sensors: %s', ', '.join(map(str, compacted)))
+
+# Solo con el backend de segmentos; el hilo se inicia en la primera petición de cada worker
+@app.before_request
+def start_compaction_thread():
+    global _compaction_thread
+    interval = app.config['SEGMENT_COMPACTION_INTERVAL']
+    if (interval <= 0 or not hasattr(sensor_data, 'compact')
+            or (_compaction_thread is not None and _compaction_thread.pid == os.getpid())):
+        return
+    with _compaction_lock:
+        if _compaction_thread is None or _compaction_thread.pid != os.getpid():
+            _compaction_thread = threading.Thread(target=_compaction_loop, args=(interval,), name='compaction', daemon=True)
+            _compaction_thread.pid = os.getpid()
+            _compaction_thread.start()
+
+# Admin consulta la retención global, las políticas por compañía y las particiones
+@app.route('/api/v1/retention', methods=['GET'])
+@require_admin
+def get_retention():
+    cur = get_db().cursor()
+    cur.execute('SELECT company_id, retention_days FROM Retention_Policy ORDER BY company_id')
+    policies = [dict(row) for row in cur.fetchall()]
+    partitions = sensor_data.partitions(get_db())
+    return jsonify({'retention_days': app.config['RETENTION_DAYS'],
+                    'backend': sensor_data.name,
+                    'granularity': app.config['SENSOR_DATA_PARTITION'],
+                    'companies': policies,
+                    'partitions': partitions}), 200
+
+# Admin fija los días de retención de una compañía. Sus lecturas nuevas van a particiones propias,
+# que se borran completas al vencer
+@app.route('/api/v1/retention/<int:company_id>', methods=['PUT'])
+@require_admin
+def set_company_retention(company_id):
+    retention_days = request.json.get('retention_days')
+    if not isinstance(retention_days, int) or isinstance(retention_days, bool) or retention_days < 1:
+        abort(400, 'retention_days must be a positive integer')
+
+    conn = get_db()
     cur = conn.cursor()
-    
-    # Verificar si el sensor_data existe
-    cur.execute('SELECT * FROM Sensor_Data WHERE ID = ? AND sensor_id IN (SELECT sensor_id FROM Sensor WHERE location_id IN (SELECT ID FROM Location WHERE company_id = ?))', 
-                (ID, g.company_id))
-    sensor_data = cur.fetchone()
-    if not sensor_data:
+    cur.execute('SELECT ID FROM Company WHERE ID = ?', (company_id,))
+    if not cur.fetchone():
+        abort(404, 'Company not found')
+    cur.execute('INSERT INTO Retention_Policy(company_id, retention_days) VALUES(?, ?) '
+                'ON CONFLICT(company_id) DO UPDATE SET retention_days = excluded.retention_days',
+                (company_id, retention_days))
+    conn.commit()
+    return jsonify({'message': 'Updated successfully'}), 200
+
+# Admin elimina la política de una compañía; sus particiones propias pasan a usar la retención global
+@app.route('/api/v1/retention/<int:company_id>', methods=['DELETE'])
+@require_admin
+def delete_company_retention(company_id):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('DELETE FROM Retention_Policy WHERE company_id = ?', (company_id,))
+    if cur.rowcount == 0:
+        abort(404, 'Retention policy not found')
+    conn.commit()
+    return jsonify({'message': 'Deleted successfully'}), 200
+
+# Admin aplica la retención de inmediato
+@app.route('/api/v1/retention/run', methods=['POST'])
+@require_admin
+def run_retention_now():
+    try:
+        dropped = run_retention()
+    except sqlite3.Error as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'dropped': dropped, 'message': 'Retention applied'}), 200
+
+# PURGA DE UBICACIONES Y SENSORES ELIMINADOS
+
+_purge_thread = None
+_purge_lock = threading.Lock()
+
+# Ejecuta los trabajos pendientes usando una conexión propia (se llama fuera de una petición).
+# Retorna los IDs de los trabajos terminados
+def run_purge_jobs():
+    conn = get_db_connection()
+    owner = str(os.getpid())
+    finished = []
+    try:
+        while True:
+            job = purge_jobs.claim_next(conn, owner, app.config['PURGE_LEASE_SECONDS'])
+            if job is None:
+                break
+            try:
+                done = purge_jobs.run_job(conn, job, sensor_data, owner,
+                                          app.config['PURGE_CHUNK_SIZE'], app.config['PURGE_PAUSE'])
+            except Exception as e:
+                purge_jobs.record_error(conn, job['ID'], e)
+                raise
+            if done:
+                finished.append(job['ID'])
+                app.logger.info('Purge job %s finished', job['ID'])
+        purge_jobs.incremental_vacuum(conn, app.config['PURGE_VACUUM_PAGES'])
+    finally:
         conn.close()
-        abort(404, 'Sensor data not found')
-    
-    # Eliminar la ubicación
-    cur.execute('DELETE FROM Sensor_Data WHERE ID = ? AND sensor_id IN (SELECT sensor_id FROM Sensor WHERE location_id IN (SELECT ID FROM Location WHERE company_id = ?))', 
-                (ID, g.company_id))
-    
+    return finished
+
+def _purge_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            run_purge_jobs()
+        except Exception:
+            # El trabajo queda pendiente y se retoma en la siguiente vuelta; el hilo no debe terminar
+            app.logger.exception('Purge failed')
+
+# El hilo de purga se inicia en la primera petición de cada worker; los workers se reparten los trabajos
+@app.before_request
+def start_purge_thread():
+    global _purge_thread
+    interval = app.config['PURGE_INTERVAL']
+    if interval <= 0 or (_purge_thread is not None and _purge_thread.pid == os.getpid()):
+        return
+    with _purge_lock:
+        if _purge_thread is None or _purge_thread.pid != os.getpid():
+            _purge_thread = threading.Thread(target=_purge_loop, args=(interval,), name='purge', daemon=True)
+            _purge_thread.pid = os.getpid()
+            _purge_thread.start()
+
+PURGE_JOB_COLUMNS = ('ID, kind, target, status, sensors_total, sensors_deleted, rows_deleted, error, '
+                     'created_at, started_at, finished_at')
+
+# Muestra los trabajos de purga de la compañía validada por api key, los más recientes primero
+@app.route('/api/v1/purge_jobs', methods=['GET'])
+@require_company_api_key
+def get_purge_jobs():
+    cur = get_db().cursor()
+    cur.execute(f'SELECT {PURGE_JOB_COLUMNS} FROM Purge_Job WHERE company_id = ? ORDER BY ID DESC LIMIT 100',
+                (g.company_id,))
+    return jsonify([dict(row) for row in cur.fetchall()]), 200
+
+# Muestra el avance de un trabajo de purga
+@app.route('/api/v1/purge_jobs/<int:job_id>', methods=['GET'])
+@require_company_api_key
+def get_purge_job(job_id):
+    cur = get_db().cursor()
+    cur.execute(f'SELECT {PURGE_JOB_COLUMNS} FROM Purge_Job WHERE ID = ? AND company_id = ?', (job_id, g.company_id))
+    job = cur.fetchone()
+    if not job:
+        abort(404, 'Purge job not found')
+    return jsonify(dict(job)), 200
+
+# Admin consulta los trabajos de purga por estado y el espacio libre de la base
+@app.route('/api/v1/stats/purge', methods=['GET'])
+@require_admin
+def get_purge_stats():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('SELECT status, COUNT(*) AS jobs, SUM(sensors_total - sensors_deleted) AS sensors_pending, '
+                'SUM(rows_deleted) AS rows_deleted FROM Purge_Job GROUP BY status')
+    statuses = {row['status']: {'jobs': row['jobs'], 'sensors_pending': row['sensors_pending'],
+                                'rows_deleted': row['rows_deleted']} for row in cur.fetchall()}
+    cur.execute("SELECT ID, kind, error FROM Purge_Job WHERE status != 'done' AND error IS NOT NULL ORDER BY ID")
+    return jsonify({'jobs': statuses,
+                    'errors': [dict(row) for row in cur.fetchall()],
+                    'auto_vacuum': conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2,
+                    'freelist_pages': conn.execute('PRAGMA freelist_count').fetchone()[0]}), 200
+
+# Admin ejecuta los trabajos de purga pendientes de inmediato
+@app.route('/api/v1/purge_jobs/run', methods=['POST'])
+@require_admin
+def run_purge_jobs_now():
+    try:
+        finished = run_purge_jobs()
+    except (sqlite3.Error, OSError, writer.WriterError) as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'finished': finished, 'message': 'Purge jobs applied'}), 200
+
+# MÉTRICAS
+
+# La petición se mide hasta que termina de enviarse el cuerpo (teardown_request corre después
+# del stream con stream_with_context)
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        g.request_started = time.perf_counter()
+        metrics.start_request()
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exception):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    # Se usa la regla de la ruta (p. ej. /api/v1/sensor/<int:sensor_id>) para no crear una serie por ID
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    status = g.get('response_status', 500)
+    metrics.finish_request(request.method, route, status, time.perf_counter() - started)
+
+def _key_cache_samples():
+    caches = (('company', company_key_cache), ('sensor', sensor_key_cache), ('admin', admin_cache))
+    return [((name, stat), value) for name, cache in caches
+            for stat, value in cache.stats().items() if stat != 'maxsize']
+
+def _ingest_queue_samples():
+    if _ingest_queue is None or _ingest_queue.pid != os.getpid():
+        return []
+    return [((stat,), value) for stat, value in _ingest_queue.stats().items() if stat != 'running']
+
+metrics.registry.register(metrics.CallbackGauge(
+    'iot_api_key_cache', 'API key cache counters and size', ('cache', 'stat'), _key_cache_samples))
+metrics.registry.register(metrics.CallbackGauge(
+    'iot_ingest_queue', 'Ingest queue counters and depth', ('stat',), _ingest_queue_samples))
+metrics.registry.register(metrics.CallbackGauge(
+    'iot_sse', 'SSE subscription counters', ('stat',),
+    lambda: [((stat,), value) for stat, value in reading_broker.stats().items()]))
+metrics.registry.register(metrics.CallbackGauge(
+    'iot_latest_readings', 'In-memory latest reading table counters and size', ('stat',),
+    lambda: [((stat,), value) for stat, value in latest_readings.stats().items()]))
+
+# Métricas del proceso en formato de texto de Prometheus
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404, 'Metrics are disabled')
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+# Log de consultas lentas: a un archivo propio si se configura, si no al logger de la app
+if app.config['SLOW_QUERY_LOG']:
+    slow_query_logger = logging.getLogger('iot.slow_query')
+    slow_query_handler = FileHandler(app.config['SLOW_QUERY_LOG'])
+    slow_query_handler.setFormatter(Formatter('%(asctime)s %(message)s'))
+    slow_query_logger.addHandler(slow_query_handler)
+    slow_query_logger.setLevel(logging.WARNING)
+else:
+    slow_query_logger = app.logger
+metrics.configure_slow_query_log(app.config['SLOW_QUERY_SECONDS'], slow_query_logger)
+
+# LÍMITES DE PETICIONES Y DESCARTE POR SOBRECARGA (ver rate_limit.py)
+app.config.update(
+    RATE_LIMIT_ENABLED=os.environ.get('IOT_RATE_LIMIT', '1') != '0',
+    # Lecturas por segundo y ráfaga de cada sensor (un lote gasta una por lectura)
+    RATE_LIMIT_INGEST_RATE=float(os.environ.get('IOT_RATE_LIMIT_INGEST_RATE', 100)),
+    RATE_LIMIT_INGEST_BURST=float(os.environ.get('IOT_RATE_LIMIT_INGEST_BURST', 5000)),
+    # Consultas pesadas de Sensor_Data (listado, export, agregados, suscripción) por segundo de cada compañía
+    RATE_LIMIT_READ_RATE=float(os.environ.get('IOT_RATE_LIMIT_READ_RATE', 10)),
+    RATE_LIMIT_READ_BURST=float(os.environ.get('IOT_RATE_LIMIT_READ_BURST', 50)),
+    # Resto de las rutas de compañía por segundo de cada compañía
+    RATE_LIMIT_API_RATE=float(os.environ.get('IOT_RATE_LIMIT_API_RATE', 50)),
+    RATE_LIMIT_API_BURST=float(os.environ.get('IOT_RATE_LIMIT_API_BURST', 100)),
+    RATE_LIMIT_MAX_BUCKETS=int(os.environ.get('IOT_RATE_LIMIT_MAX_BUCKETS', 100000)),
+    # Segundos máximos sin releer los límites por compañía (los cambios hechos en otro worker tardan esto)
+    RATE_LIMIT_REFRESH=float(os.environ.get('IOT_RATE_LIMIT_REFRESH', 5.0)),
+    # Umbrales de sobrecarga del worker a partir de los cuales se rechazan las consultas pesadas; 0 desactiva cada uno.
+    # Peticiones en curso, latencia reciente de la ingesta en segundos y lecturas en la cola de ingesta.
+    # Un worker gthread atiende como mucho IOT_THREADS peticiones a la vez (ver gunicorn.conf.py), así que por
+    # defecto se rechaza cuando todos sus hilos están ocupados y las siguientes esperan en la cola de gunicorn
+    SHED_MAX_IN_FLIGHT=int(os.environ.get('IOT_SHED_MAX_IN_FLIGHT', max(1, int(os.environ.get('IOT_THREADS', 8)) - 1))),
+    SHED_MAX_LATENCY=float(os.environ.get('IOT_SHED_MAX_LATENCY', 1.0)),
+    SHED_MAX_QUEUE_DEPTH=int(os.environ.get('IOT_SHED_MAX_QUEUE_DEPTH', app.config['INGEST_QUEUE_SIZE'] // 2)),
+)
+
+ROUTE_CLASS_BY_ENDPOINT = {
+    'insert_sensor_data': 'ingest',
+    'insert_sensor_data_batch': 'ingest',
+    'ingest_sensor_data_stream': 'ingest',
+    'get_sensors_data': 'read',
+    'export_sensor_data': 'read',
+    'aggregate_sensor_data': 'read',
+    'subscribe_sensor_data': 'read',
+}
+# Conexiones de larga duración: no cuentan como peticiones en curso ni como latencia
+LONG_LIVED_ENDPOINTS = ('ingest_sensor_data_stream', 'subscribe_sensor_data')
+
+def _load_rate_limit_overrides():
+    conn = get_db_connection()
+    try:
+        return rate_limit.load_overrides(conn.cursor())
+    finally:
+        conn.close()
+
+rate_limiter = rate_limit.RateLimiter(
+    {'ingest': (app.config['RATE_LIMIT_INGEST_RATE'], app.config['RATE_LIMIT_INGEST_BURST']),
+     'read': (app.config['RATE_LIMIT_READ_RATE'], app.config['RATE_LIMIT_READ_BURST']),
+     'api': (app.config['RATE_LIMIT_API_RATE'], app.config['RATE_LIMIT_API_BURST'])},
+    max_buckets=app.config['RATE_LIMIT_MAX_BUCKETS'], refresh_seconds=app.config['RATE_LIMIT_REFRESH'],
+    load_overrides=_load_rate_limit_overrides)
+
+def _ingest_queue_depth():
+    if _ingest_queue is None or _ingest_queue.pid != os.getpid():
+        return 0
+    return _ingest_queue.depth()
+
+load_shedder = rate_limit.LoadShedder(max_in_flight=app.config['SHED_MAX_IN_FLIGHT'],
+                                      max_latency=app.config['SHED_MAX_LATENCY'],
+                                      max_queue_depth=app.config['SHED_MAX_QUEUE_DEPTH'],
+                                      queue_depth=_ingest_queue_depth)
+
+# Compañía de cada sensor, solo para aplicar los límites de ingesta propios de una compañía
+sensor_company_cache = _new_key_cache()
+
+def _sensor_companies(sensor_ids):
+    companies = {}
+    pending = []
+    for sensor_id in sensor_ids:
+        company_id = sensor_company_cache.get(sensor_id)
+        if company_id is MISS:
+            pending.append(sensor_id)
+        else:
+            companies[sensor_id] = company_id
+    cur = get_db().cursor()
+    for i in range(0, len(pending), 500):
+        chunk = pending[i:i + 500]
+        cur.execute('SELECT sensor_id, company_id FROM Sensor WHERE sensor_id IN ({})'.format(','.join(['?'] * len(chunk))),
+                    chunk)
+        found = {row['sensor_id']: row['company_id'] for row in cur.fetchall()}
+        for sensor_id in chunk:
+            sensor_company_cache.set(sensor_id, found.get(sensor_id))
+        companies.update(found)
+    return companies
+
+# Descarta los buckets de ingesta y la compañía en caché de sensores eliminados
+def forget_sensor_rate_limits(sensor_ids):
+    for sensor_id in sensor_ids:
+        rate_limiter.forget('ingest', sensor_id)
+        sensor_company_cache.invalidate(sensor_id)
+
+def rate_limited(wait):
+    return (jsonify({'error': 'Rate limit exceeded', 'retry_after': round(wait, 3)}), 429,
+            {'Retry-After': rate_limit.retry_after_header(wait)})
+
+# Gasta del bucket de la compañía para la ruta actual. Retorna la respuesta 429, o None si se acepta
+def check_company_rate_limit(company_id):
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return None
+    route_class = ROUTE_CLASS_BY_ENDPOINT.get(request.endpoint, 'api')
+    wait = rate_limiter.take([(route_class, company_id, 1, company_id)])
+    return rate_limited(wait) if wait else None
+
+# Gasta de los buckets de los sensores una unidad por lectura; si alguno no alcanza no se gasta de ninguno.
+# Retorna la respuesta 429, o None si se acepta
+def check_ingest_rate_limit(sensor_ids):
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return None
+    costs = {}
+    for sensor_id in sensor_ids:
+        costs[sensor_id] = costs.get(sensor_id, 0) + 1
+    companies = _sensor_companies(costs) if rate_limiter.has_overrides('ingest') else {}
+    wait = rate_limiter.take([('ingest', sensor_id, cost, companies.get(sensor_id)) for sensor_id, cost in costs.items()])
+    return rate_limited(wait) if wait else None
+
+# El canal de ingesta no se rechaza: se espera antes de escribir la ventana, lo que frena al sensor
+def throttle_ingest_stream(sensor_id, count):
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return
+    companies = _sensor_companies([sensor_id]) if rate_limiter.has_overrides('ingest') else {}
+    wait = rate_limiter.reserve('ingest', sensor_id, count, companies.get(sensor_id))
+    if wait:
+        time.sleep(wait)
+
+# Las consultas pesadas se rechazan antes de autenticar si el worker está sobrecargado; la ingesta sigue
+@app.before_request
+def shed_load():
+    if request.endpoint in LONG_LIVED_ENDPOINTS:
+        return None
+    g.load_started = time.perf_counter()
+    load_shedder.begin()
+    reason = load_shedder.should_shed(ROUTE_CLASS_BY_ENDPOINT.get(request.endpoint))
+    if reason is None:
+        return None
+    return jsonify({'error': f'Server is overloaded ({reason}), retry later'}), 429, {'Retry-After': '1'}
+
+@app.teardown_request
+def finish_load_tracking(exception):
+    started = g.pop('load_started', None)
+    if started is None:
+        return
+    load_shedder.end()
+    if ROUTE_CLASS_BY_ENDPOINT.get(request.endpoint) == 'ingest':
+        load_shedder.record_latency(time.perf_counter() - started)
+
+# Admin consulta los límites por defecto y los propios de cada compañía
+@app.route('/api/v1/rate_limits', methods=['GET'])
+@require_admin
+def get_rate_limits():
+    cur = get_db().cursor()
+    cur.execute('SELECT company_id, route_class, rate, burst FROM Rate_Limit ORDER BY company_id, route_class')
+    return jsonify({'enabled': app.config['RATE_LIMIT_ENABLED'],
+                    'defaults': {route_class: {'rate': rate, 'burst': burst}
+                                 for route_class, (rate, burst) in rate_limiter.limits.items()},
+                    'companies': [dict(row) for row in cur.fetchall()]}), 200
+
+# Admin fija los límites de una compañía: {"ingest": {"rate": 100, "burst": 1000}, "read": {...}}.
+# Las clases que no se incluyen usan el límite por defecto; rate 0 deja la clase sin límite
+@app.route('/api/v1/rate_limits/<int:company_id>', methods=['PUT'])
+@require_admin
+def set_company_rate_limits(company_id):
+    body = request.json
+    if not isinstance(body, dict) or not body:
+        abort(400, 'A limit for at least one route class is required')
+    limits = {}
+    for route_class, limit in body.items():
+        if route_class not in rate_limit.ROUTE_CLASSES:
+            abort(400, f'route class must be one of {", ".join(rate_limit.ROUTE_CLASSES)}')
+        rate = limit.get('rate') if isinstance(limit, dict) else None
+        burst = limit.get('burst') if isinstance(limit, dict) else None
+        if (not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in (rate, burst))
+                or rate < 0 or burst < 1):
+            abort(400, 'rate must be a number >= 0 and burst a number >= 1')
+        limits[route_class] = (float(rate), float(burst))
+
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('SELECT ID FROM Company WHERE ID = ?', (company_id,))
+    if not cur.fetchone():
+        abort(404, 'Company not found')
+    rate_limit.set_company_limits(cur, company_id, limits)
+    conn.commit()
+    rate_limiter.set_overrides(company_id, limits)
+    return jsonify({'message': 'Updated successfully'}), 200
+
+# Admin elimina los límites propios de una compañía; vuelve a usar los límites por defecto
+@app.route('/api/v1/rate_limits/<int:company_id>', methods=['DELETE'])
+@require_admin
+def delete_company_rate_limits(company_id):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('DELETE FROM Rate_Limit WHERE company_id = ?', (company_id,))
+    if cur.rowcount == 0:
+        abort(404, 'Rate limits not found')
     conn.commit()
-    conn.close()
+    rate_limiter.set_overrides(company_id, {})
     return jsonify({'message': 'Deleted successfully'}), 200
 
+# Admin consulta el estado de los límites y de la carga de este worker
+@app.route('/api/v1/stats/rate_limits', methods=['GET'])
+@require_admin
+def get_rate_limit_stats():
+    return jsonify({'limiter': rate_limiter.stats(), 'load': load_shedder.stats()}), 200
+
+def _rate_limit_samples():
+    stats = rate_limiter.stats(top=0)
+    return ([((route_class, 'allowed'), value) for route_class, value in stats['allowed'].items()]
+            + [((route_class, 'limited'), value) for route_class, value in stats['limited'].items()])
+
+def _load_samples():
+    stats = load_shedder.stats()
+    samples = [(('in_flight',), stats['in_flight']), (('ingest_latency',), stats['ingest_latency'])]
+    return samples + [((f'shed_{route_class}',), value) for route_class, value in stats['shed'].items()]
+
+metrics.registry.register(metrics.CallbackGauge(
+    'iot_rate_limit', 'Rate limiter decisions per route class', ('class', 'decision'), _rate_limit_samples))
+metrics.registry.register(metrics.CallbackGauge(
+    'iot_load', 'Worker load and shed request counters', ('stat',), _load_samples))
+
+# Gunicorn importa este módulo sin pasar por __main__, por eso la base se prepara al cargar la app.
+# Si no hay migraciones pendientes solo se lee PRAGMA user_version
+if app.config['AUTO_MIGRATE']:
+    init_db()
+
+# Carga la tabla de últimas lecturas con una conexión propia; si falla se carga en la primera consulta
+def warm_latest_readings():
+    conn = get_db_connection()
+    try:
+        latest_readings.sync(conn)
+    finally:
+        conn.close()
+
+if app.config['LATEST_WARM_ON_START']:
+    try:
+        warm_latest_readings()
+    except (sqlite3.Error, OSError) as e:
+        app.logger.warning('Could not load latest readings: %s', e)
 
 if __name__ == '__main__':
     init_db()
@@ -575,7 +2286,6 @@ if __name__ == '__main__':
 if not app.debug:
     file_handler = FileHandler('error.log')
     file_handler.setFormatter(Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    file_handler.setLevel(logging.INFO)
+    file_handler.setLevel(logging.WARNING)
     app.logger.addHandler(file_handler)
     app.logger.setLevel(logging.INFO)
-    app.logger.info('errors')
@@ -0,0 +1,427 @@
+# Benchmark de la API.
+# Crea una flota sintética (compañías, ubicaciones, sensores y lecturas) en una base SQLite temporal
+# y ejecuta una mezcla de peticiones contra la app, dentro del proceso con el test client de Flask
+# o contra un gunicorn local. Reporta throughput y latencias p50/p95/p99 por ruta, guarda los
+# resultados en JSON y falla (código de salida 1) si empeoran respecto de un baseline guardado.
+#
+# Ejemplos:
+#   python benchmark.py --requests 2000 --output bench.json
+#   python benchmark.py --mode gunicorn --workers 4 --concurrency 16 --baseline bench_baseline.json
+#   python benchmark.py --mix ingest=80,range=20 --save-baseline bench_baseline.json
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import migrations
+import sensor_data_store
+
+ADMIN_USERNAME = 'bench'
+ADMIN_PASSWORD = 'bench'
+ADMIN_HEADERS = {'Username': ADMIN_USERNAME, 'Password': ADMIN_PASSWORD}
+
+DEFAULT_MIX = 'ingest=50,range=20,location=10,sensor=10,auth=10'
+
+# FLOTA SINTÉTICA
+
+def generate_api_key():
+    return str(uuid.uuid4())
+
+def _reading(rng):
+    return {'temperature': round(rng.uniform(-10, 40), 2), 'humidity': round(rng.uniform(0, 100), 1),
+            'battery': rng.randint(0, 100)}
+
+# Crea la base con el esquema actual y la llena directamente con SQL (sin pasar por la API).
+# Las lecturas se reparten uniformemente en los últimos span_days días.
+# Retorna la flota: por compañía su api key, los nombres de sus ubicaciones y sus sensores
+def seed(db_path, companies, locations, sensors, readings, span_days, granularity, rng):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    migrations.migrate(conn)
+    cur = conn.cursor()
+
+    cur.execute('INSERT INTO Admin(Username, Password) VALUES(?, ?)', (ADMIN_USERNAME, ADMIN_PASSWORD))
+    fleet = []
+    for c in range(companies):
+        company_key = generate_api_key()
+        cur.execute('INSERT INTO Company(Company_name, Company_api_key) VALUES(?, ?)', (f'company-{c}', company_key))
+        company = {'id': cur.lastrowid, 'api_key': company_key, 'locations': [], 'sensors': []}
+        for l in range(locations):
+            name = f'location-{c}-{l}'
+            cur.execute('INSERT INTO Location(company_id, location_name, location_country, location_city, location_meta) VALUES (?, ?, ?, ?, ?)',
+                        (company['id'], name, 'Chile', 'Santiago', 'bench'))
+            location_id = cur.lastrowid
+            company['locations'].append({'id': location_id, 'name': name})
+            for s in range(sensors):
+                sensor_key = generate_api_key()
+                cur.execute('INSERT INTO Sensor(location_id, sensor_name, sensor_category, sensor_meta, sensor_api_key, company_id) VALUES(?, ?, ?, ?, ?, ?)',
+                            (location_id, f'sensor-{c}-{l}-{s}', 'weather', 'bench', sensor_key, company['id']))
+                company['sensors'].append({'id': cur.lastrowid, 'api_key': sensor_key})
+        fleet.append(company)
+    conn.commit()
+
+    # Un paso de tiempo por lectura de cada sensor; cada paso se inserta como un lote
+    sensor_ids = [sensor['id'] for company in fleet for sensor in company['sensors']]
+    now = int(time.time())
+    span = span_days * 86400
+    step = span // readings if readings else 0
+    for i in range(readings):
+        ts = now - span + i * step
+        cur.execute('BEGIN IMMEDIATE')
+        sensor_data_store.insert_rows(cur, [(sensor_id, json.dumps(_reading(rng))) for sensor_id in sensor_ids],
+                                      ts, granularity)
+        conn.commit()
+    conn.close()
+    return {'companies': fleet, 'from': now - span, 'to': now}
+
+# CLIENTES
+
+# Cliente dentro del proceso, con el test client de Flask
+class InProcessClient:
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def request(self, method, path, headers=None, body=None):
+        response = self.client.open(path, method=method, headers=headers, json=body)
+        data = response.get_data()
+        return response.status_code, data
+
+# Cliente HTTP contra un servidor (gunicorn); una conexión por hilo
+class HttpClient:
+    def __init__(self, host, port, timeout=30):
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, headers=None, body=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            # gunicorn cierra la conexión después de cada respuesta con workers sync; se reintenta una vez
+            self.connection.close()
+            self.connection.request(method, path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            self.connection.close()
+        return response.status, data
+
+# CARGA DE TRABAJO
+# Cada operación ejecuta una o más peticiones y registra (ruta, status, segundos, esperado)
+
+class Workload:
+    def __init__(self, fleet, rng, record):
+        self.fleet = fleet
+        self.rng = rng
+        self.record = record
+
+    def call(self, client, route, method, path, headers=None, body=None, expected=(200, 201)):
+        start = time.perf_counter()
+        status, data = client.request(method, path, headers, body)
+        self.record(route, status, time.perf_counter() - start, status in expected)
+        return status, data
+
+    def company(self):
+        return self.rng.choice(self.fleet['companies'])
+
+    def ingest(self, client):
+        sensor = self.rng.choice(self.company()['sensors'])
+        self.call(client, 'POST /api/v1/sensor_data', 'POST', '/api/v1/sensor_data',
+                  body={'api_key': sensor['api_key'], 'data': _reading(self.rng)})
+
+    # Rango de entre una hora y un día de uno a tres sensores de la misma compañía
+    def range(self, client):
+        company = self.company()
+        sensors = self.rng.sample(company['sensors'], min(len(company['sensors']), self.rng.randint(1, 3)))
+        width = self.rng.randint(3600, 86400)
+        start = self.rng.randint(self.fleet['from'], max(self.fleet['from'], self.fleet['to'] - width))
+        query = '&'.join(f'sensor_id={sensor["id"]}' for sensor in sensors)
+        self.call(client, 'GET /api/v1/sensor_data', 'GET',
+                  f'/api/v1/sensor_data?from={start}&to={start + width}&{query}',
+                  headers={'company_api_key': company['api_key']})
+
+    def location(self, client):
+        company = self.company()
+        headers = {'company_api_key': company['api_key']}
+        name = f'bench-{uuid.uuid4().hex[:12]}'
+        fields = {'location_country': 'Chile', 'location_city': 'Valparaíso', 'location_meta': 'bench'}
+        self.call(client, 'POST /api/v1/location', 'POST', '/api/v1/location', headers=ADMIN_HEADERS,
+                  body=dict(fields, company_id=company['id'], location_name=name))
+        self.call(client, 'GET /api/v1/location/<location_name>', 'GET', f'/api/v1/location/{name}', headers=headers)
+        self.call(client, 'PUT /api/v1/location/<location_name>', 'PUT', f'/api/v1/location/{name}', headers=headers,
+                  body=dict(fields, location_name=name + '-x'))
+        self.call(client, 'DELETE /api/v1/location/<location_name>', 'DELETE', f'/api/v1/location/{name}-x', headers=headers)
+
+    def sensor(self, client):
+        company = self.company()
+        headers = {'company_api_key': company['api_key']}
+        location = self.rng.choice(company['locations'])
+        fields = {'location_id': location['id'], 'sensor_category': 'weather', 'sensor_meta': 'bench'}
+        status, data = self.call(client, 'POST /api/v1/sensor', 'POST', '/api/v1/sensor', headers=ADMIN_HEADERS,
+                                 body=dict(fields, sensor_name='bench'))
+        if status != 201:
+            return
+        sensor_id = json.loads(data)['sensor_id']
+        self.call(client, 'GET /api/v1/sensor/<sensor_id>', 'GET', f'/api/v1/sensor/{sensor_id}', headers=headers)
+        self.call(client, 'PUT /api/v1/sensor/<sensor_id>', 'PUT', f'/api/v1/sensor/{sensor_id}', headers=headers,
+                  body=dict(fields, sensor_name='bench-x'))
+        self.call(client, 'DELETE /api/v1/sensor/<sensor_id>', 'DELETE', f'/api/v1/sensor/{sensor_id}', headers=headers)
+
+    # Peticiones baratas donde domina la validación de credenciales, incluidas api keys inválidas
+    def auth(self, client):
+        roll = self.rng.random()
+        if roll < 0.6:
+            self.call(client, 'GET /api/v1/location', 'GET', '/api/v1/location',
+                      headers={'company_api_key': self.company()['api_key']})
+        elif roll < 0.8:
+            self.call(client, 'GET /api/v1/location (invalid key)', 'GET', '/api/v1/location',
+                      headers={'company_api_key': generate_api_key()}, expected=(401,))
+        else:
+            self.call(client, 'GET /api/v1/company', 'GET', '/api/v1/company', headers=ADMIN_HEADERS)
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ('ingest', 'range', 'location', 'sensor', 'auth'):
+            raise argparse.ArgumentTypeError(f'Unknown workload: {name}')
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'Invalid weight for {name}: {weight}')
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError('The mix needs at least one workload with weight > 0')
+    return mix
+
+# Ejecuta operations operaciones repartidas en concurrency hilos. Retorna las muestras por ruta
+# y los segundos que tomó la corrida
+def run_workload(make_client, fleet, mix, operations, concurrency, seed_value, warmup=0):
+    samples = {}
+    lock = threading.Lock()
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    def worker(index, count, recording):
+        rng = random.Random(seed_value + index)
+        client = make_client()
+
+        def record(route, status, seconds, ok):
+            if not recording:
+                return
+            with lock:
+                entry = samples.setdefault(route, {'latencies': [], 'errors': 0, 'statuses': {}})
+                entry['latencies'].append(seconds)
+                entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+                if not ok:
+                    entry['errors'] += 1
+
+        workload = Workload(fleet, rng, record)
+        for _ in range(count):
+            getattr(workload, rng.choices(names, weights)[0])(client)
+
+    def run(total, recording):
+        threads = []
+        for i in range(concurrency):
+            count = total // concurrency + (1 if i < total % concurrency else 0)
+            threads.append(threading.Thread(target=worker, args=(i, count, recording)))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    if warmup:
+        run(warmup, False)
+    elapsed = run(operations, True)
+    return samples, elapsed
+
+# REPORTE
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    # Rango más cercano
+    index = max(0, min(len(sorted_values) - 1, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(latencies, errors, elapsed):
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'errors': errors,
+        'throughput_rps': len(values) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(values) / len(values) * 1000 if values else 0.0,
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+    }
+
+def build_report(samples, elapsed, config):
+    routes = {}
+    for route, entry in sorted(samples.items()):
+        routes[route] = summarize(entry['latencies'], entry['errors'], elapsed)
+        routes[route]['statuses'] = {str(status): count for status, count in sorted(entry['statuses'].items())}
+    total = summarize([s for entry in samples.values() for s in entry['latencies']],
+                      sum(entry['errors'] for entry in samples.values()), elapsed)
+    return {'config': config, 'elapsed_seconds': elapsed, 'total': total, 'routes': routes,
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())}
+
+def print_report(report):
+    print(f'{"route":<42} {"count":>7} {"err":>5} {"rps":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for route, stats in list(report['routes'].items()) + [('TOTAL', report['total'])]:
+        print(f'{route:<42} {stats["count"]:>7} {stats["errors"]:>5} {stats["throughput_rps"]:>9.1f} '
+              f'{stats["p50_ms"]:>8.2f} {stats["p95_ms"]:>8.2f} {stats["p99_ms"]:>8.2f}')
+
+# Compara con el baseline. Una ruta empeora si su p95 sube, o su throughput baja, más que tolerance
+# (fracción). Diferencias de p95 menores que min_delta_ms se ignoran porque son ruido.
+# Retorna la lista de regresiones encontradas
+def compare(report, baseline, tolerance, min_delta_ms):
+    regressions = []
+    current = dict(report['routes'], TOTAL=report['total'])
+    previous = dict(baseline['routes'], TOTAL=baseline['total'])
+    for route, base in previous.items():
+        stats = current.get(route)
+        if stats is None or not stats['count'] or not base['count']:
+            continue
+        if stats['p95_ms'] > base['p95_ms'] * (1 + tolerance) and stats['p95_ms'] - base['p95_ms'] > min_delta_ms:
+            regressions.append(f'{route}: p95 {base["p95_ms"]:.2f} ms -> {stats["p95_ms"]:.2f} ms')
+        if stats['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append(f'{route}: throughput {base["throughput_rps"]:.1f} -> {stats["throughput_rps"]:.1f} req/s')
+        if stats['errors'] > base['errors']:
+            regressions.append(f'{route}: errors {base["errors"]} -> {stats["errors"]}')
+    return regressions
+
+# GUNICORN
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_gunicorn(db_path, workers, threads, port, env_overrides):
+    env = dict(os.environ, IOT_DATABASE=db_path, **env_overrides)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-b', f'127.0.0.1:{port}', '-w', str(workers),
+         '--threads', str(threads), 'app:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with code {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start in 30 seconds')
+
+def stop_gunicorn(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the IoT API')
+    parser.add_argument('--mode', choices=('inprocess', 'gunicorn'), default='inprocess')
+    parser.add_argument('--companies', type=int, default=5)
+    parser.add_argument('--locations', type=int, default=4, help='locations per company')
+    parser.add_argument('--sensors', type=int, default=5, help='sensors per location')
+    parser.add_argument('--readings', type=int, default=200, help='seeded readings per sensor')
+    parser.add_argument('--span-days', type=int, default=30, help='days covered by the seeded readings')
+    parser.add_argument('--requests', type=int, default=2000, help='operations to run (CRUD operations send 4 requests)')
+    parser.add_argument('--warmup', type=int, default=100, help='operations run before measuring')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'workload weights (default {DEFAULT_MIX})')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn threads per worker')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database', help='scratch database file (default: a temporary file)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='fail if the results regress against this JSON file')
+    parser.add_argument('--save-baseline', help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression as a fraction (default 0.2)')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help='ignore p95 regressions smaller than this')
+    args = parser.parse_args(argv)
+
+    scratch = None
+    db_path = args.database
+    if db_path is None:
+        scratch = tempfile.mkdtemp(prefix='iot-bench-')
+        db_path = os.path.join(scratch, 'bench.db')
+    elif os.path.exists(db_path):
+        parser.error(f'{db_path} already exists; the benchmark needs a scratch database')
+
+    granularity = os.environ.get('IOT_SENSOR_DATA_PARTITION', 'month')
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    fleet = seed(db_path, args.companies, args.locations, args.sensors, args.readings, args.span_days, granularity, rng)
+    print(f'Seeded {args.companies * args.locations * args.sensors} sensors and '
+          f'{args.companies * args.locations * args.sensors * args.readings} readings in {time.perf_counter() - start:.1f}s')
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ('output', 'baseline', 'save_baseline', 'database')}
+    if args.mode == 'inprocess':
+        # La app lee IOT_DATABASE al importarse
+        os.environ['IOT_DATABASE'] = db_path
+        import app as iot_app
+        samples, elapsed = run_workload(lambda: InProcessClient(iot_app.app), fleet, args.mix, args.requests,
+                                        args.concurrency, args.seed, args.warmup)
+    else:
+        port = _free_port()
+        process = start_gunicorn(db_path, args.workers, args.threads, port, {})
+        try:
+            samples, elapsed = run_workload(lambda: HttpClient('127.0.0.1', port), fleet, args.mix, args.requests,
+                                            args.concurrency, args.seed, args.warmup)
+        finally:
+            stop_gunicorn(process)
+
+    if scratch:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = build_report(samples, elapsed, config)
+    print_report(report)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config', {}).get('mode') != args.mode:
+            print(f'Warning: baseline was recorded in {baseline.get("config", {}).get("mode")} mode')
+        regressions = compare(report, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print('Regressions against the baseline:')
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+        print('No regressions against the baseline')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+import json
+import math
+import operator
+import re
+import time
+import zlib
+
+# Filtros sobre los campos de data en GET /api/v1/sensor_data: filter=<ruta><operador><valor>, p. ej.
+# filter=temperature>40 o filter=probe.status="alarm". La ruta usa puntos para entrar en objetos y [n] para
+# arreglos; el valor es un literal JSON (número, "texto", true, false o null) y, si no lo es, se toma como texto.
+# Varios filter se combinan con AND. Una comparación solo se cumple si el campo tiene el tipo del valor
+# (temperature>40 no incluye lecturas donde temperature es texto); true y false valen 1 y 0, como en json_extract.
+#
+# Campos frecuentes (tabla Hot_Field): el admin declara rutas por sensor_category y cada partición de Sensor_Data
+# recibe una columna generada VIRTUAL con el valor de la ruta y un índice parcial (sensor_id, columna, ts).
+# Los filtros sobre esas rutas se evalúan contra la columna, así que pasan a ser búsquedas por rango en el índice
+# en vez de leer y parsear cada lectura del rango.
+
+OPERATORS = ('<=', '>=', '!=', '=', '<', '>')
+MAX_FILTERS = 10
+MAX_HOT_FIELDS = 20
+HOT_COLUMN_PREFIX = 'hot_'
+
+_KEY = r'[A-Za-z0-9_\-]+'
+_PATH = re.compile(rf'^{_KEY}(?:\.{_KEY}|\[\d+\])*$')
+_PATH_STEP = re.compile(rf'\.?({_KEY})|\[(\d+)\]')
+_FILTER = re.compile(r'^\s*([^<>=!\s]+)\s*(<=|>=|!=|=|<|>)\s*(.*?)\s*$')
+_COMPARE = {'=': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+            '>': operator.gt, '>=': operator.ge}
+
+class Predicate:
+    def __init__(self, path, op, value):
+        self.path = path
+        self.op = op
+        # json_extract entrega true y false como 1 y 0
+        self.value = int(value) if isinstance(value, bool) else value
+        self.steps = parse_path(path)
+
+    # Con el índice parcial (columna IS NOT NULL) se puede buscar por = y por rangos, no por != ni por null
+    def uses_index(self):
+        return self.value is not None and self.op != '!='
+
+# Convierte una ruta como probe.values[0] en sus pasos: ['probe', 'values', 0]. Levanta ValueError si es inválida
+def parse_path(path):
+    if not isinstance(path, str) or not _PATH.match(path):
+        raise ValueError(f'Invalid field path: {path}')
+    return [key if index == '' else int(index) for key, index in _PATH_STEP.findall(path)]
+
+# Ruta en la sintaxis de las funciones JSON de SQLite: $."probe"."values"[0]
+def json_path(path):
+    return '$' + ''.join(f'[{step}]' if isinstance(step, int) else f'."{step}"' for step in parse_path(path))
+
+# Levanta ValueError si el texto no es un filtro válido
+def parse_filter(text):
+    match = _FILTER.match(text)
+    if not match:
+        raise ValueError(f'Invalid filter: {text}')
+    path, op, raw = match.groups()
+    if raw == '':
+        raise ValueError(f'Filter without value: {text}')
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        value = raw
+    if isinstance(value, (dict, list)):
+        raise ValueError(f'Filter values must be numbers, strings, true, false or null: {text}')
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f'Invalid filter value: {text}')
+    if value is None and op not in ('=', '!='):
+        raise ValueError(f'null only supports = and !=: {text}')
+    return Predicate(path, op, value)
+
+def parse_filters(values):
+    if len(values) > MAX_FILTERS:
+        raise ValueError(f'At most {MAX_FILTERS} filters are allowed')
+    return [parse_filter(value) for value in values]
+
+# Expresión SQL del valor de la ruta en una lectura; las lecturas con data inválido no tienen campos
+def extract_sql(path):
+    return "CASE WHEN json_valid(data) THEN json_extract(data, '{}') END".format(json_path(path).replace("'", "''"))
+
+# Condición SQL del filtro y sus parámetros. column es la columna generada de la ruta, si es un campo frecuente
+def sql_condition(predicate, column=None):
+    expression = column if column is not None else extract_sql(predicate.path)
+    if predicate.value is None:
+        return f"({expression}) IS {'NOT ' if predicate.op == '!=' else ''}NULL", []
+    types = "('text')" if isinstance(predicate.value, str) else "('integer', 'real')"
+    return f'(({expression}) {predicate.op} ? AND typeof({expression}) IN {types})', [predicate.value]
+
+def _extract(data, steps):
+    for step in steps:
+        if isinstance(step, int):
+            if not isinstance(data, list) or step >= len(data):
+                return None
+        elif not isinstance(data, dict) or step not in data:
+            return None
+        data = data[step]
+    return data
+
+# Evalúa los filtros en Python sobre el JSON de una lectura (backend de segmentos), con las mismas reglas que en SQL
+def matches(data_json, predicates):
+    try:
+        data = json.loads(data_json)
+    except ValueError:
+        data = None
+    for predicate in predicates:
+        value = _extract(data, predicate.steps)
+        if predicate.value is None:
+            if (value is None) != (predicate.op == '='):
+                return False
+            continue
+        if isinstance(predicate.value, str):
+            if not isinstance(value, str):
+                return False
+        elif not isinstance(value, (int, float)):
+            return False
+        if not _COMPARE[predicate.op](value, predicate.value):
+            return False
+    return True
+
+# Nombre de la columna generada de una ruta; el crc evita choques entre rutas como a.b y a_b
+def column_name(path):
+    readable = re.sub(r'[^A-Za-z0-9]+', '_', path).strip('_')[:40]
+    return f'{HOT_COLUMN_PREFIX}{readable}_{zlib.crc32(path.encode("utf-8")):08x}'
+
+def create_tables(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS Hot_Field(
+        sensor_category TEXT NOT NULL,
+        path TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY(sensor_category, path)
+    ) WITHOUT ROWID
+    ''')
+
+# Rutas declaradas en alguna categoría. Antes de la migración que crea Hot_Field no hay ninguna
+def hot_paths(cur):
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Hot_Field'")
+    if not cur.fetchone():
+        return []
+    cur.execute('SELECT DISTINCT path FROM Hot_Field ORDER BY path')
+    return [row[0] for row in cur.fetchall()]
+
+# {ruta: columna} de los campos frecuentes
+def hot_columns(cur):
+    return {path: column_name(path) for path in hot_paths(cur)}
+
+# Reemplaza las rutas de una categoría. Debe llamarse dentro de una transacción de escritura
+def set_category_paths(cur, sensor_category, paths, now=None):
+    now = int(time.time()) if now is None else now
+    cur.execute('DELETE FROM Hot_Field WHERE sensor_category = ? AND path NOT IN ({})'.format(','.join(['?'] * len(paths))),
+                [sensor_category] + list(paths))
+    cur.executemany('INSERT OR IGNORE INTO Hot_Field(sensor_category, path, created_at) VALUES(?, ?, ?)',
+                    [(sensor_category, path, now) for path in paths])
@@ -0,0 +1,84 @@
+import csv
+import io
+import json
+import struct
+import sys
+import zlib
+from array import array
+
+# Codificadores de la exportación de Sensor_Data. Cada uno recibe las filas (o las columnas) a medida
+# que salen del cursor y produce bloques de bytes, así la respuesta se transmite sin armarla en memoria.
+
+CSV_COLUMNS = ('ID', 'sensor_id', 'ts', 'time', 'data')
+
+# Formato columnar:
+#   8 bytes   magic b'IOTCOL1\n'
+#   4 bytes   largo del encabezado (uint32 little-endian)
+#   encabezado JSON en UTF-8, rellenado con espacios hasta que los datos empiecen en un múltiplo de 8
+#   columnas una detrás de otra, cada una con 'rows' valores little-endian
+# El encabezado describe cada columna con su nombre, dtype (formato NumPy) y offset en bytes desde el
+# inicio de los datos (12 + largo del encabezado). Los campos numéricos de data van como <f8 con NaN
+# cuando la lectura no tiene el campo. Con NumPy:
+#   np.memmap(path, dtype=column['dtype'], mode='r', offset=12 + header_length + column['offset'], shape=rows)
+COLUMNAR_MAGIC = b'IOTCOL1\n'
+
+# Serializa una fila de Sensor_Data con data incrustado tal como está guardado (ya es JSON),
+# en vez de codificarlo otra vez como string. Las llaves van en el mismo orden que usa jsonify
+def sensor_data_json(row):
+    return '{"ID":%d,"data":%s,"sensor_id":%d,"time":"%s","ts":%d}' % (
+        row['ID'], row['data'], row['sensor_id'], row['time'], row['ts'])
+
+def csv_chunks(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(CSV_COLUMNS)
+    for rows in chunks:
+        for row in rows:
+            writer.writerow([row[column] for column in CSV_COLUMNS])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def ndjson_chunks(chunks):
+    for rows in chunks:
+        yield ''.join(sensor_data_json(row) + '\n' for row in rows).encode('utf-8')
+
+# Comprime con gzip cada bloque a medida que llega
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def columnar_header(rows, columns):
+    described = []
+    offset = 0
+    for name, dtype in columns:
+        described.append({'name': name, 'dtype': dtype, 'offset': offset})
+        offset += rows * 8
+    header = json.dumps({'version': 1, 'rows': rows, 'columns': described}).encode('utf-8')
+    header += b' ' * (-(len(COLUMNAR_MAGIC) + 4 + len(header)) % 8)
+    return COLUMNAR_MAGIC + struct.pack('<I', len(header)) + header
+
+# Convierte un bloque de valores de una columna a bytes little-endian.
+# typecode es 'q' para enteros (<i8) o 'd' para flotantes (<f8)
+def column_chunk(values, typecode):
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+# Agrupa las filas de un iterador en listas de hasta size elementos
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,38 @@
+import multiprocessing
+import os
+import tempfile
+
+# Configuración de gunicorn para correr con varios workers (gunicorn -c gunicorn.conf.py app:app).
+# Los workers leen directo de la base y envían las escrituras de lecturas a un proceso escritor único
+# (ver writer.py), que inicia el maestro antes de crear los workers.
+# IOT_WRITER=0 desactiva el proceso escritor y cada worker escribe con su propia conexión.
+
+bind = os.environ.get('IOT_BIND', '0.0.0.0:8080')
+# Hilos por worker: las suscripciones SSE y los canales de ingesta ocupan un hilo cada uno
+worker_class = 'gthread'
+workers = int(os.environ.get('IOT_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# La app lee el mismo IOT_THREADS para su umbral de descarte por sobrecarga (IOT_SHED_MAX_IN_FLIGHT), que debe
+# ser menor que threads: un worker nunca tiene más peticiones en curso que hilos
+threads = int(os.environ.get('IOT_THREADS', 8))
+# La app (migraciones, tabla de últimas lecturas) se carga una vez en el maestro y los workers la heredan
+preload_app = os.environ.get('IOT_PRELOAD', '1') != '0'
+timeout = int(os.environ.get('IOT_WORKER_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('IOT_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('IOT_KEEPALIVE', 5))
+
+# Este archivo se evalúa antes de importar la app, así que la app ya ve el socket al cargarse
+if os.environ.get('IOT_WRITER', '1') != '0':
+    os.environ.setdefault('IOT_WRITER_SOCKET', os.path.join(tempfile.gettempdir(), f'iot-writer-{os.getpid()}.sock'))
+
+def on_starting(server):
+    if not os.environ.get('IOT_WRITER_SOCKET'):
+        return
+    import app
+    server.writer_process = app.start_writer_process()
+    server.log.info('Writer process started (pid %s)', server.writer_process.process.pid)
+
+# Se llama después de detener los workers, que al salir ya escribieron lo que tenían en su cola de ingesta
+def on_exit(server):
+    writer_process = getattr(server, 'writer_process', None)
+    if writer_process is not None:
+        writer_process.stop()
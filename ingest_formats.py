@@ -0,0 +1,92 @@
+import csv
+import io
+import json
+
+import msgpack
+
+# Formatos de entrada de lecturas. Todos se normalizan a una lista de (api_key, data_json),
+# donde data_json es el texto JSON que se guarda en Sensor_Data.data.
+
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+CSV_TYPES = ('text/csv',)
+
+class InvalidPayload(ValueError):
+    pass
+
+def _reading(item):
+    if not isinstance(item, dict) or not item.get('api_key'):
+        raise InvalidPayload('sensor_api_key is required')
+    if 'data' not in item:
+        raise InvalidPayload('data is required')
+    try:
+        return item['api_key'], json.dumps(item['data'])
+    except (TypeError, ValueError) as e:
+        # MessagePack admite tipos sin equivalente en JSON (bin, ext, llaves no texto)
+        raise InvalidPayload(f'data cannot be stored as JSON: {e}')
+
+# Una lectura {"api_key": ..., "data": ...} o un lote (arreglo o {"readings": [...]}) ya decodificado
+def from_object(body, batch):
+    if not batch:
+        return [_reading(body)]
+    readings = body.get('readings') if isinstance(body, dict) else body
+    if not isinstance(readings, list) or not readings:
+        raise InvalidPayload('readings must be a non-empty array')
+    return [_reading(item) for item in readings]
+
+def from_msgpack(raw, batch):
+    try:
+        body = msgpack.unpackb(raw, raw=False)
+    except (ValueError, msgpack.UnpackException):
+        raise InvalidPayload('Invalid MessagePack payload')
+    return from_object(body, batch)
+
+def _csv_value(value):
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+# CSV con encabezado. La columna api_key es obligatoria. Si hay una columna data, su valor es el JSON
+# de la lectura y se guarda tal cual; si no, el resto de las columnas forman el objeto data
+# (los valores numéricos se guardan como números y las celdas vacías se omiten)
+def from_csv(text):
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, None)
+    if not header or 'api_key' not in header:
+        raise InvalidPayload('CSV header must include api_key')
+    key_index = header.index('api_key')
+    data_index = header.index('data') if 'data' in header else None
+    fields = [(i, name) for i, name in enumerate(header) if i not in (key_index, data_index)]
+
+    readings = []
+    for line in reader:
+        if not line:
+            continue
+        if len(line) != len(header):
+            raise InvalidPayload(f'CSV line {reader.line_num} has {len(line)} columns, expected {len(header)}')
+        if not line[key_index]:
+            raise InvalidPayload('sensor_api_key is required')
+        if data_index is not None:
+            data_json = line[data_index]
+        else:
+            data_json = json.dumps({name: _csv_value(line[i]) for i, name in fields if line[i] != ''})
+        readings.append((line[key_index], data_json))
+    if not readings:
+        raise InvalidPayload('readings must be a non-empty array')
+    return readings
+
+# Índices de los textos que no son JSON válido. Usa json_valid de SQLite, que valida sin construir
+# objetos de Python; los textos se envían como un arreglo de strings para validarlos en una sola sentencia
+def invalid_json_indexes(conn, texts):
+    if not texts:
+        return []
+    cur = conn.cursor()
+    cur.execute('SELECT key FROM json_each(?) WHERE NOT json_valid(value) ORDER BY key', (json.dumps(texts),))
+    return [row[0] for row in cur.fetchall()]
+
+# Índice del primer texto que no es JSON válido, o None
+def first_invalid_json(conn, texts):
+    invalid = invalid_json_indexes(conn, texts)
+    return invalid[0] if invalid else None
@@ -0,0 +1,175 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+# Marca para pedir al hilo escritor que termine
+_STOP = object()
+
+class QueueFull(Exception):
+    pass
+
+# Resultado pendiente de una lectura encolada. Quien espera el commit llama a wait()
+class Pending:
+    __slots__ = ('payload', 'wait_commit', 'result', 'error', '_event')
+
+    def __init__(self, payload, wait_commit):
+        self.payload = payload
+        self.wait_commit = wait_commit
+        self.result = None
+        self.error = None
+        self._event = threading.Event()
+
+    def resolve(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError('Timed out waiting for commit')
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+# Buffer de ingesta con un hilo escritor dedicado.
+# El hilo junta lecturas hasta max_batch o hasta max_delay segundos y las escribe con write_batch
+# en una sola transacción (group commit). write_batch recibe la lista de payloads y retorna
+# un resultado por payload, en el mismo orden.
+# retryable(error) indica si un error de write_batch deja el lote sin escribir; solo entonces se reintenta.
+# Sin retryable se reintenta siempre, lo que vale para SQLite local (un commit fallido no escribe nada)
+class IngestQueue:
+    def __init__(self, write_batch, max_size=10000, max_batch=500, max_delay=0.02, retries=3, retryable=None,
+                 logger=None):
+        self.write_batch = write_batch
+        self.retryable = retryable
+        self.max_size = max_size
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retries = retries
+        self.logger = logger or logging.getLogger(__name__)
+        # El proceso dueño del hilo; después de un fork hay que crear otra cola
+        self.pid = os.getpid()
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._stopped = False
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.last_commit_seconds = 0.0
+        self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+        self._thread.start()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    # Encola un payload. Si la cola está llena espera hasta timeout segundos y luego lanza QueueFull
+    def put(self, payload, wait_commit=True, timeout=None):
+        if self._stopped:
+            raise QueueFull('Ingest queue is shutting down')
+        pending = Pending(payload, wait_commit)
+        try:
+            self._queue.put(pending, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull('Ingest queue is full')
+        with self._lock:
+            self.enqueued += 1
+        return pending
+
+    # Deja de aceptar lecturas, escribe las pendientes y espera al hilo escritor
+    def stop(self, timeout=30.0):
+        if self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _next_batch(self, stopping):
+        batch = []
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            if not batch and not stopping:
+                item = self._queue.get()
+            else:
+                # Si alguien espera el commit, o la cola se está cerrando, no se espera por más lecturas
+                remaining = deadline - time.monotonic()
+                if stopping or remaining <= 0 or any(p.wait_commit for p in batch):
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                else:
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+            if item is _STOP:
+                stopping = True
+                continue
+            batch.append(item)
+        return batch, stopping
+
+    def _run(self):
+        stopping = False
+        while True:
+            batch, stopping = self._next_batch(stopping)
+            if batch:
+                self._write(batch)
+            elif stopping:
+                break
+
+    def _write(self, batch):
+        payloads = [pending.payload for pending in batch]
+        error = None
+        for attempt in range(self.retries):
+            start = time.monotonic()
+            try:
+                results = self.write_batch(payloads)
+            except Exception as e:
+                error = e
+                if self.retryable is not None and not self.retryable(e):
+                    # El lote pudo haberse escrito; reenviarlo duplicaría las lecturas
+                    break
+                time.sleep(0.05 * 2 ** attempt)
+                continue
+            with self._lock:
+                self.written += len(batch)
+                self.batches += 1
+                self.largest_batch = max(self.largest_batch, len(batch))
+                self.last_commit_seconds = time.monotonic() - start
+            for pending, result in zip(batch, results):
+                pending.resolve(result=result)
+            return
+
+        with self._lock:
+            self.failed += len(batch)
+        lost = sum(1 for pending in batch if not pending.wait_commit)
+        if lost:
+            self.logger.error('Ingest queue dropped %d acknowledged readings: %s', lost, error)
+        for pending in batch:
+            pending.resolve(error=error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self.depth(),
+                'capacity': self.max_size,
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'batches': self.batches,
+                'average_batch': self.written / self.batches if self.batches else 0.0,
+                'largest_batch': self.largest_batch,
+                'last_commit_seconds': self.last_commit_seconds,
+                'running': self._thread.is_alive(),
+            }
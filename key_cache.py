@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Valor que indica que la llave no está en el cache (distinto de None, que es un resultado negativo)
+MISS = object()
+
+# Cache LRU con expiración para resolver api keys a identidades (company_id, sensor_id, admin).
+# También guarda los resultados negativos (api keys inválidas) con un TTL propio, más corto
+class KeyCache:
+    def __init__(self, maxsize=10000, ttl=60.0, negative_ttl=10.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Retorna el valor guardado, None si la llave se guardó como inválida, o MISS
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISS
+            value, expires = entry
+            if expires <= now:
+                del self._entries[key]
+                self.misses += 1
+                return MISS
+            self._entries.move_to_end(key)
+            if value is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return value
+
+    # Guarda un valor; None se guarda como resultado negativo
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        ttl = self.negative_ttl if value is None else self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, MISS) is not MISS:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
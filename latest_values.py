@@ -0,0 +1,124 @@
+import threading
+import time
+
+# Última lectura de cada sensor en memoria del proceso, para responder "valor actual" sin consultar Sensor_Data.
+# Se carga desde el backend de lecturas (store, ver sensor_data_store.SqliteBackend) la primera vez que se usa
+# y la ruta de ingesta la actualiza con cada commit.
+# Con varios workers cada uno tiene su tabla: antes de responder se revisa el último ID de la secuencia
+# como mucho cada refresh_seconds y se aplican las lecturas con ID mayor que el último visto, así también
+# se ven las que insertaron los otros workers. Las ediciones y borrados de lecturas hechos en este proceso
+# invalidan el sensor, que se vuelve a buscar en la base en la siguiente consulta.
+
+class LatestValues:
+    def __init__(self, store, refresh_seconds=1.0):
+        self.store = store
+        self.refresh_seconds = refresh_seconds
+        # sensor_id: (ID, sensor_id, data_json, ts)
+        self._entries = {}
+        # Sensores que deben volver a buscarse en la base
+        self._stale = set()
+        # Último ID de la secuencia ya aplicado; None indica que hay que cargar todo
+        self._high_water = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        # Evita que varios hilos consulten la base a la vez para lo mismo
+        self._refresh_lock = threading.Lock()
+        self.loads = 0
+        self.refreshes = 0
+        self.applied = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Aplica lecturas (ID, sensor_id, data_json, ts); una lectura reemplaza a la guardada solo si es más reciente
+    def record(self, readings):
+        with self._lock:
+            for reading in readings:
+                current = self._entries.get(reading[1])
+                if current is None or (reading[3], reading[0]) >= (current[3], current[0]):
+                    self._entries[reading[1]] = reading
+            self.applied += len(readings)
+
+    def invalidate(self, sensor_id):
+        with self._lock:
+            self._entries.pop(sensor_id, None)
+            self._stale.add(sensor_id)
+
+    # Descarta todo; la siguiente consulta vuelve a cargar desde la base
+    def clear(self):
+        with self._refresh_lock, self._lock:
+            self._entries = {}
+            self._stale = set()
+            self._high_water = None
+
+    def _load(self, conn):
+        # La secuencia se lee antes que las lecturas: lo que se inserte entre medio se aplica de nuevo
+        # en el siguiente refresh, y record() ignora lo que no sea más reciente
+        high_water = self.store.last_id(conn)
+        latest = self.store.latest_per_sensor(conn)
+        entries = {sensor_id: (row['ID'], row['sensor_id'], row['data'], row['ts']) for sensor_id, row in latest.items()}
+        with self._lock:
+            # Lo que la ingesta registró mientras se cargaba no se pierde
+            for sensor_id, reading in self._entries.items():
+                current = entries.get(sensor_id)
+                if current is None or (reading[3], reading[0]) >= (current[3], current[0]):
+                    entries[sensor_id] = reading
+            self._entries = entries
+            self._stale = set()
+            self._high_water = high_water
+            self._checked_at = time.monotonic()
+            self.loads += 1
+
+    def _refresh(self, conn):
+        high_water = self.store.last_id(conn)
+        if high_water > self._high_water:
+            readings = [(row['ID'], row['sensor_id'], row['data'], row['ts'])
+                        for row in self.store.iter_after_id(conn, None, self._high_water)]
+            self.record(readings)
+        with self._lock:
+            stale = list(self._stale)
+        if stale:
+            latest = self.store.latest_per_sensor(conn, stale)
+            with self._lock:
+                self._stale.difference_update(stale)
+            # Lo que haya llegado después de invalidar es más reciente que lo que había en la base
+            self.record([(row['ID'], row['sensor_id'], row['data'], row['ts']) for row in latest.values()])
+        with self._lock:
+            self._high_water = max(self._high_water, high_water)
+            self._checked_at = time.monotonic()
+            self.refreshes += 1
+
+    # Carga o pone al día la tabla si corresponde
+    def sync(self, conn):
+        if (self._high_water is not None and not self._stale
+                and time.monotonic() - self._checked_at < self.refresh_seconds):
+            return
+        with self._refresh_lock:
+            if self._high_water is None:
+                self._load(conn)
+            elif self._stale or time.monotonic() - self._checked_at >= self.refresh_seconds:
+                self._refresh(conn)
+
+    # Retorna {sensor_id: (ID, sensor_id, data_json, ts)} con los sensores que tienen lecturas
+    def get_many(self, conn, sensor_ids):
+        self.sync(conn)
+        with self._lock:
+            found = {sensor_id: self._entries[sensor_id] for sensor_id in sensor_ids if sensor_id in self._entries}
+            self.hits += len(found)
+            self.misses += len(sensor_ids) - len(found)
+        return found
+
+    def get(self, conn, sensor_id):
+        return self.get_many(conn, [sensor_id]).get(sensor_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sensors': len(self._entries),
+                'stale': len(self._stale),
+                'high_water': self._high_water or 0,
+                'loads': self.loads,
+                'refreshes': self.refreshes,
+                'applied': self.applied,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,299 @@
+import bisect
+import functools
+import re
+import sqlite3
+import threading
+import time
+
+# Métricas en memoria del proceso, expuestas en formato de texto de Prometheus.
+# Con varios workers de gunicorn cada uno tiene las suyas; Prometheus las separa por instancia.
+
+# Límites de los buckets de los histogramas, en segundos
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, (), value) for labels, value in sorted(self._values.items())]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # Conteo por bucket (no acumulado), suma y total
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(entry[0]), entry[1], entry[2]) for labels, entry in sorted(self._values.items())]
+        samples = []
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket', labels, (('le', _format_value(float(bound))),), cumulative))
+            samples.append((self.name + '_sum', labels, (), total))
+            samples.append((self.name + '_count', labels, (), count))
+        return samples
+
+# Gauge cuyo valor se calcula al consultar /metrics. fn retorna una lista de (labels, valor)
+class CallbackGauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames, fn):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.fn = fn
+
+    def samples(self):
+        return [(self.name, tuple(labels), (), value) for labels, value in self.fn()]
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, extra, value in metric.samples():
+                lines.append(f'{name}{_format_labels(metric.labelnames, labels, extra)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    'iot_http_requests_total', 'HTTP requests by route and status code', ('method', 'route', 'status')))
+http_duration = registry.register(Histogram(
+    'iot_http_request_duration_seconds', 'HTTP request latency, including streamed bodies', ('method', 'route')))
+http_in_flight = registry.register(Gauge(
+    'iot_http_requests_in_flight', 'HTTP requests being served'))
+http_rows = registry.register(Counter(
+    'iot_http_rows_fetched_total', 'Rows read from SQLite while serving each route', ('method', 'route')))
+http_sql_seconds = registry.register(Counter(
+    'iot_http_sql_seconds_total', 'Time spent executing SQLite statements while serving each route', ('method', 'route')))
+http_auth_seconds = registry.register(Counter(
+    'iot_http_auth_seconds_total', 'Time spent resolving credentials while serving each route (includes its SQL time)',
+    ('method', 'route')))
+auth_duration = registry.register(Histogram(
+    'iot_auth_duration_seconds', 'Credential resolution latency', ('kind',)))
+sql_duration = registry.register(Histogram(
+    'iot_sqlite_statement_duration_seconds', 'SQLite statement execution time', ('statement',)))
+sql_lock_wait = registry.register(Histogram(
+    'iot_sqlite_lock_wait_seconds', 'Time to acquire the write lock with BEGIN IMMEDIATE/EXCLUSIVE'))
+sql_locked = registry.register(Counter(
+    'iot_sqlite_locked_total', 'Statements that failed with database is locked or busy', ('statement',)))
+slow_queries = registry.register(Counter(
+    'iot_sqlite_slow_queries_total', 'Statements slower than the slow query threshold', ('statement',)))
+
+# Estado de la petición en curso en este hilo
+_current = threading.local()
+
+def start_request():
+    http_in_flight.inc()
+    _current.rows = 0
+    _current.sql_seconds = 0.0
+    _current.auth_seconds = 0.0
+    _current.active = True
+
+def finish_request(method, route, status, seconds):
+    http_in_flight.dec()
+    _current.active = False
+    http_requests.inc(method, route, str(status))
+    http_duration.observe(method, route, value=seconds)
+    http_rows.inc(method, route, amount=_current.rows)
+    http_sql_seconds.inc(method, route, amount=_current.sql_seconds)
+    http_auth_seconds.inc(method, route, amount=_current.auth_seconds)
+
+# Decorador que mide la resolución de credenciales
+def timed_auth(kind):
+    def wrap(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                auth_duration.observe(kind, value=seconds)
+                if getattr(_current, 'active', False):
+                    _current.auth_seconds += seconds
+        return wrapper
+    return wrap
+
+# SQLITE
+
+# Umbral del log de consultas lentas (0 lo desactiva) y logger donde se escriben
+slow_query_seconds = 0.0
+slow_query_logger = None
+
+def configure_slow_query_log(seconds, logger):
+    global slow_query_seconds, slow_query_logger
+    slow_query_seconds = seconds
+    slow_query_logger = logger
+
+_PARTITION_NAME = re.compile(r'Sensor_Data_(?:c\d+_)?\d{6,8}(?:_\d+)?')
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?([A-Za-z_][A-Za-z0-9_<>]*)', re.IGNORECASE)
+_labels = {}
+_MAX_LABELS = 1024
+
+# Etiqueta de baja cardinalidad para una sentencia: verbo y primera tabla, con las particiones
+# de Sensor_Data agrupadas (p. ej. 'SELECT Sensor_Data_<partition>')
+def statement_label(sql):
+    label = _labels.get(sql)
+    if label is None:
+        text = _PARTITION_NAME.sub('Sensor_Data_<partition>', sql.strip())
+        words = text.split(None, 2)
+        verb = words[0].upper() if words else ''
+        if verb in ('BEGIN', 'CREATE', 'DROP', 'ALTER'):
+            # Transacciones y DDL: 'BEGIN IMMEDIATE', 'CREATE TABLE', 'DROP INDEX', ...
+            label = ' '.join(words[:2]).upper()
+        elif verb in ('COMMIT', 'ROLLBACK', 'PRAGMA'):
+            label = verb
+        else:
+            match = _TABLE.search(text)
+            label = f'{verb} {match.group(1)}' if match else verb
+        if len(_labels) < _MAX_LABELS:
+            _labels[sql] = label
+    return label
+
+def _record_statement(sql, seconds, error=None):
+    label = statement_label(sql)
+    sql_duration.observe(label, value=seconds)
+    if label in ('BEGIN IMMEDIATE', 'BEGIN EXCLUSIVE'):
+        sql_lock_wait.observe(value=seconds)
+    if getattr(_current, 'active', False):
+        _current.sql_seconds += seconds
+    if error is not None and ('locked' in str(error) or 'busy' in str(error)):
+        sql_locked.inc(label)
+    if slow_query_seconds and seconds >= slow_query_seconds:
+        slow_queries.inc(label)
+        if slow_query_logger is not None:
+            slow_query_logger.warning('Slow query (%.3fs): %s', seconds, ' '.join(sql.split())[:1000])
+
+def _count_rows(n):
+    if n and getattr(_current, 'active', False):
+        _current.rows += n
+
+# Cursor que mide cada sentencia y cuenta las filas leídas
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            result = super().execute(sql, *args)
+        except sqlite3.OperationalError as e:
+            _record_statement(sql, time.perf_counter() - start, e)
+            raise
+        _record_statement(sql, time.perf_counter() - start)
+        return result
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            result = super().executemany(sql, *args)
+        except sqlite3.OperationalError as e:
+            _record_statement(sql, time.perf_counter() - start, e)
+            raise
+        _record_statement(sql, time.perf_counter() - start)
+        return result
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _count_rows(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = super().fetchmany(*args)
+        _count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _count_rows(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        _count_rows(1)
+        return row
+
+# Conexión cuyos cursores (incluidos los de conn.execute) están instrumentados.
+# Se usa como factory de sqlite3.connect
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        except sqlite3.OperationalError as e:
+            _record_statement('COMMIT', time.perf_counter() - start, e)
+            raise
+        _record_statement('COMMIT', time.perf_counter() - start)
@@ -0,0 +1,199 @@
+# Migraciones versionadas del esquema.
+# La versión aplicada se guarda en PRAGMA user_version del archivo de base de datos,
+# así que revisar si hay migraciones pendientes cuesta una sola lectura del encabezado.
+import os
+import secrets
+import time
+import data_filters
+import purge_jobs
+import rate_limit
+import rollups
+import sensor_data_store
+
+MIGRATIONS = []
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+# Aplica las migraciones pendientes en una sola transacción y retorna los nombres aplicados.
+# Si varios workers arrancan a la vez, el lock exclusivo hace que solo uno migre
+def migrate(conn):
+    if current_version(conn) >= latest_version():
+        return []
+
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN EXCLUSIVE')
+        try:
+            version = current_version(conn)
+            applied = []
+            for target, name, fn in MIGRATIONS:
+                if target <= version:
+                    continue
+                fn(conn)
+                conn.execute(f'PRAGMA user_version = {target:d}')
+                applied.append(name)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_xinfo({table})')]
+
+@migration(1, 'Tablas iniciales')
+def create_tables(conn):
+    # Esquema original; en bases existentes las tablas ya están creadas
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS Admin (
+        Username STRING PRIMARY KEY,
+        Password STRING NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS Company(
+        ID INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        Company_name STRING NOT NULL,
+        Company_api_key STRING NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS Location(
+        ID INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        company_id INTEGER NOT NULL,
+        location_name STRING NOT NULL,
+        location_country STRING NOT NULL,
+        location_city STRING NOT NULL,
+        location_meta STRING NOT NULL,
+        FOREIGNKEY company_id REFERENCES Company(ID)
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS Sensor(
+        location_id INTEGER NOT NULL,
+        sensor_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        sensor_name STRING NOT NULL,
+        sensor_category STRING NOT NULL,
+        sensor_meta STRING NOT NULL,
+        sensor_api_key STRING NOT NULL,
+        FOREIGNKEY location_id REFERENCES Location(ID)
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS Sensor_Data(
+        ID INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        sensor_id INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        time DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGNKEY sensor_id REFERENCES Sensor(sensor_id)
+    )
+    ''')
+
+@migration(2, 'Índices de api keys y de la jerarquía compañía/ubicación/sensor')
+def create_lookup_indexes(conn):
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_company_api_key ON Company(Company_api_key)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_sensor_api_key ON Sensor(sensor_api_key)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_location_company_name ON Location(company_id, location_name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sensor_location ON Sensor(location_id)')
+
+@migration(3, 'Sensor_Data.time como epoch entero indexado')
+def sensor_data_epoch_time(conn):
+    # La hora se guarda en ts (segundos UTC desde epoch). time queda como columna generada
+    # con el mismo formato de texto de antes, así las respuestas de la API no cambian
+    if 'ts' in _columns(conn, 'Sensor_Data'):
+        return
+
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'Sensor_Data'").fetchone()
+    last_seq = row[0] if row else 0
+
+    conn.execute('''
+    CREATE TABLE Sensor_Data_new(
+        ID INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        sensor_id INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        ts INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        time TEXT GENERATED ALWAYS AS (datetime(ts, 'unixepoch')) VIRTUAL
+    )
+    ''')
+    # Los valores de time que no se puedan interpretar quedan en 0
+    conn.execute('''
+    INSERT INTO Sensor_Data_new(ID, sensor_id, data, ts)
+    SELECT ID, sensor_id, data, COALESCE(CAST(strftime('%s', time) AS INTEGER), 0) FROM Sensor_Data
+    ''')
+    conn.execute('DROP TABLE Sensor_Data')
+    conn.execute('ALTER TABLE Sensor_Data_new RENAME TO Sensor_Data')
+
+    # Se conserva el contador AUTOINCREMENT para no reutilizar ids de lecturas borradas
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = 'Sensor_Data'")
+    conn.execute("INSERT INTO sqlite_sequence(name, seq) SELECT 'Sensor_Data', MAX(?, COALESCE(MAX(ID), 0)) FROM Sensor_Data",
+                 (last_seq,))
+
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sensor_data_sensor_ts ON Sensor_Data(sensor_id, ts)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sensor_data_ts ON Sensor_Data(ts)')
+
+@migration(4, 'Rollups por bucket de los campos numéricos de Sensor_Data')
+def sensor_data_rollups(conn):
+    cur = conn.cursor()
+    rollups.create_rollup_table(cur)
+    # Se calculan los rollups de las lecturas que ya existen
+    rollups.rebuild_all_rollups(cur)
+
+@migration(5, 'Sensor_Data particionada por tiempo')
+def sensor_data_partitions(conn):
+    cur = conn.cursor()
+    sensor_data_store.create_catalog(cur)
+    # Las lecturas existentes pasan a particiones compartidas y se elimina la tabla Sensor_Data
+    granularity = os.environ.get('IOT_SENSOR_DATA_PARTITION', 'month')
+    sensor_data_store.partition_legacy_table(cur, granularity)
+
+@migration(6, 'Sensor.company_id para autorizar por compañía sin subconsultas')
+def sensor_company_id(conn):
+    # Copia desnormalizada de Location.company_id; se mantiene al crear o mover sensores y al borrar ubicaciones
+    if 'company_id' not in _columns(conn, 'Sensor'):
+        conn.execute('ALTER TABLE Sensor ADD COLUMN company_id INTEGER')
+    conn.execute('UPDATE Sensor SET company_id = (SELECT company_id FROM Location WHERE Location.ID = Sensor.location_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sensor_company ON Sensor(company_id)')
+
+@migration(7, 'Clave de firma y épocas de revocación de los tokens de acceso')
+def access_tokens(conn):
+    # La clave se genera una vez y la comparten todos los workers; IOT_TOKEN_SECRET la reemplaza
+    conn.execute('CREATE TABLE IF NOT EXISTS Token_Secret(secret TEXT NOT NULL)')
+    if conn.execute('SELECT COUNT(*) FROM Token_Secret').fetchone()[0] == 0:
+        conn.execute('INSERT INTO Token_Secret(secret) VALUES(?)', (secrets.token_hex(32),))
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS Token_Epoch(
+        scope TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        epoch INTEGER NOT NULL,
+        PRIMARY KEY(scope, subject)
+    )
+    ''')
+
+@migration(8, 'Borrado en segundo plano de lo que dependía de ubicaciones y sensores eliminados')
+def purge_jobs_tables(conn):
+    cur = conn.cursor()
+    purge_jobs.create_tables(cur)
+    # Un trabajo inicial limpia los sensores y lecturas que ya quedaron huérfanos
+    purge_jobs.create_job(cur, 'orphans', None, None, [], now=int(time.time()))
+
+@migration(9, 'Campos frecuentes de data por categoría de sensor, con columnas generadas e índices')
+def hot_fields(conn):
+    data_filters.create_tables(conn.cursor())
+
+@migration(10, 'Límites de peticiones propios de cada compañía')
+def rate_limits(conn):
+    rate_limit.create_tables(conn.cursor())
@@ -0,0 +1,207 @@
+import csv
+import io
+import json
+
+# Alta masiva de ubicaciones y sensores (POST /api/v1/provisioning).
+# El cuerpo JSON es {"locations": [...], "sensors": [...]}; cualquiera de los dos puede faltar.
+# Cada ubicación tiene company_id, location_name, location_country, location_city, location_meta y
+# opcionalmente ref, un nombre para referirse a ella desde los sensores de la misma petición.
+# Cada sensor tiene sensor_name, sensor_category, sensor_meta y location_id (una ubicación existente)
+# o location_ref (una ubicación de la petición).
+#
+# En CSV cada línea es un sensor con los datos de su ubicación (ver from_csv).
+# Todo se valida antes de escribir y se inserta en una sola transacción: o se crea todo o nada.
+
+MAX_LOCATIONS = 5000
+MAX_SENSORS = 20000
+# Máximo de errores que se informan en la respuesta
+MAX_ERRORS = 50
+
+LOCATION_FIELDS = ('location_name', 'location_country', 'location_city', 'location_meta')
+SENSOR_FIELDS = ('sensor_name', 'sensor_category', 'sensor_meta')
+
+class InvalidProvisioning(ValueError):
+    def __init__(self, errors):
+        super().__init__(errors[0] if len(errors) == 1 else f'{len(errors)} invalid items')
+        self.errors = errors[:MAX_ERRORS]
+
+def _is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+def _text_errors(item, fields, where):
+    errors = []
+    for field in fields:
+        value = item.get(field)
+        if not isinstance(value, str) or value == '':
+            errors.append(f'{where}: {field} is required')
+    return errors
+
+# Valida el cuerpo ya decodificado y retorna (locations, sensors) normalizados:
+# locations es una lista de {company_id, ref, campos}; sensors una lista de {location_id, location_ref, campos}.
+# Levanta InvalidProvisioning con todos los errores encontrados
+def from_object(body):
+    if not isinstance(body, dict):
+        raise InvalidProvisioning(['Body must be an object with locations and/or sensors'])
+    locations = body.get('locations', [])
+    sensors = body.get('sensors', [])
+    if not isinstance(locations, list) or not isinstance(sensors, list):
+        raise InvalidProvisioning(['locations and sensors must be arrays'])
+    if not locations and not sensors:
+        raise InvalidProvisioning(['Nothing to provision'])
+    if len(locations) > MAX_LOCATIONS:
+        raise InvalidProvisioning([f'At most {MAX_LOCATIONS} locations are allowed per request'])
+    if len(sensors) > MAX_SENSORS:
+        raise InvalidProvisioning([f'At most {MAX_SENSORS} sensors are allowed per request'])
+
+    errors = []
+    refs = {}
+    for index, item in enumerate(locations):
+        where = f'locations[{index}]'
+        if not isinstance(item, dict):
+            errors.append(f'{where}: must be an object')
+            continue
+        if not _is_id(item.get('company_id')):
+            errors.append(f'{where}: company_id is required')
+        errors.extend(_text_errors(item, LOCATION_FIELDS, where))
+        ref = item.get('ref')
+        if ref is not None:
+            if not isinstance(ref, str) or ref == '':
+                errors.append(f'{where}: ref must be a non-empty string')
+            elif ref in refs:
+                errors.append(f'{where}: ref {ref} is already used by locations[{refs[ref]}]')
+            else:
+                refs[ref] = index
+
+    for index, item in enumerate(sensors):
+        where = f'sensors[{index}]'
+        if not isinstance(item, dict):
+            errors.append(f'{where}: must be an object')
+            continue
+        errors.extend(_text_errors(item, SENSOR_FIELDS, where))
+        location_id = item.get('location_id')
+        location_ref = item.get('location_ref')
+        if (location_id is None) == (location_ref is None):
+            errors.append(f'{where}: exactly one of location_id or location_ref is required')
+        elif location_id is not None and not _is_id(location_id):
+            errors.append(f'{where}: location_id must be a positive integer')
+        elif location_ref is not None and location_ref not in refs:
+            errors.append(f'{where}: unknown location_ref {location_ref}')
+
+    if errors:
+        raise InvalidProvisioning(errors)
+    return ([dict({field: item[field] for field in LOCATION_FIELDS}, company_id=item['company_id'], ref=item.get('ref'))
+             for item in locations],
+            [dict({field: item[field] for field in SENSOR_FIELDS}, location_id=item.get('location_id'),
+                  location_ref=refs.get(item.get('location_ref')))
+             for item in sensors])
+
+# CSV con encabezado y un sensor por línea. Columnas: sensor_name, sensor_category, sensor_meta y
+# location_id (ubicación existente) o company_id más los campos de la ubicación. Las líneas sin location_id
+# con el mismo company_id y location_name van a una misma ubicación nueva, que se crea con los datos de
+# su primera línea. Una línea sin sensor_name solo crea la ubicación
+def from_csv(text):
+    reader = csv.DictReader(io.StringIO(text))
+    header = reader.fieldnames or []
+    if 'location_id' not in header and not {'company_id', 'location_name'} <= set(header):
+        raise InvalidProvisioning(['CSV header must include location_id or company_id and location_name'])
+
+    locations = []
+    sensors = []
+    refs = {}
+    errors = []
+    for line in reader:
+        where = f'CSV line {reader.line_num}'
+        # DictReader deja las columnas de más en la llave None y las que faltan con valor None
+        if None in line or None in line.values():
+            errors.append(f'{where}: expected {len(header)} columns')
+            continue
+        location_id = line.get('location_id') or None
+        if location_id is not None:
+            if not location_id.isdigit():
+                errors.append(f'{where}: location_id must be a positive integer')
+                continue
+            sensor = {'location_id': int(location_id)}
+        else:
+            company_id = line.get('company_id') or ''
+            if not company_id.isdigit():
+                errors.append(f'{where}: company_id is required')
+                continue
+            ref = json.dumps([int(company_id), line.get('location_name')])
+            if ref not in refs:
+                location_errors = _text_errors(line, LOCATION_FIELDS, where)
+                if location_errors:
+                    errors.extend(location_errors)
+                    continue
+                refs[ref] = len(locations)
+                location = {field: line.get(field) for field in LOCATION_FIELDS}
+                location.update(company_id=int(company_id), ref=ref)
+                locations.append(location)
+            sensor = {'location_ref': ref}
+        if line.get('sensor_name'):
+            sensor_errors = _text_errors(line, SENSOR_FIELDS, where)
+            if sensor_errors:
+                errors.extend(sensor_errors)
+                continue
+            sensor.update({field: line.get(field) for field in SENSOR_FIELDS})
+            sensors.append(sensor)
+
+    if errors:
+        raise InvalidProvisioning(errors)
+    # Las referencias internas no se muestran en la respuesta
+    locations, sensors = from_object({'locations': locations, 'sensors': sensors})
+    for location in locations:
+        location['ref'] = None
+    return locations, sensors
+
+# Revisa que existan las compañías y ubicaciones a las que se hace referencia.
+# Retorna {location_id: company_id} de las ubicaciones existentes
+def check_references(cur, locations, sensors):
+    company_ids = sorted({location['company_id'] for location in locations})
+    location_ids = sorted({sensor['location_id'] for sensor in sensors if sensor['location_id'] is not None})
+    found_companies = set()
+    location_companies = {}
+    # Se consulta por bloques para no superar el límite de parámetros de SQLite
+    for i in range(0, len(company_ids), 500):
+        chunk = company_ids[i:i + 500]
+        cur.execute('SELECT ID FROM Company WHERE ID IN ({})'.format(','.join(['?'] * len(chunk))), chunk)
+        found_companies.update(row[0] for row in cur.fetchall())
+    for i in range(0, len(location_ids), 500):
+        chunk = location_ids[i:i + 500]
+        cur.execute('SELECT ID, company_id FROM Location WHERE ID IN ({})'.format(','.join(['?'] * len(chunk))), chunk)
+        location_companies.update((row[0], row[1]) for row in cur.fetchall())
+
+    errors = [f'locations[{index}]: company {location["company_id"]} does not exist'
+              for index, location in enumerate(locations) if location['company_id'] not in found_companies]
+    errors.extend(f'sensors[{index}]: location {sensor["location_id"]} does not exist'
+                  for index, sensor in enumerate(sensors)
+                  if sensor['location_id'] is not None and sensor['location_id'] not in location_companies)
+    if errors:
+        raise InvalidProvisioning(errors)
+    return location_companies
+
+# Inserta las ubicaciones y los sensores y retorna (location_ids, sensor_ids) en el orden de entrada.
+# api_keys tiene un api key por sensor. Debe llamarse dentro de una transacción de escritura
+def insert(cur, locations, sensors, api_keys, location_companies):
+    location_ids = []
+    for location in locations:
+        cur.execute('INSERT INTO Location(company_id, location_name, location_country, location_city, location_meta) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (location['company_id'], location['location_name'], location['location_country'],
+                     location['location_city'], location['location_meta']))
+        location_ids.append(cur.lastrowid)
+
+    sensor_ids = []
+    for sensor, api_key in zip(sensors, api_keys):
+        if sensor['location_ref'] is not None:
+            location_id = location_ids[sensor['location_ref']]
+            company_id = locations[sensor['location_ref']]['company_id']
+        else:
+            location_id = sensor['location_id']
+            company_id = location_companies[location_id]
+        # company_id se copia de la ubicación, igual que al crear un sensor
+        cur.execute('INSERT INTO Sensor(location_id, sensor_name, sensor_category, sensor_meta, sensor_api_key, company_id) '
+                    'VALUES(?, ?, ?, ?, ?, ?)',
+                    (location_id, sensor['sensor_name'], sensor['sensor_category'], sensor['sensor_meta'], api_key,
+                     company_id))
+        sensor_ids.append(cur.lastrowid)
+    return location_ids, sensor_ids
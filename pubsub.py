@@ -0,0 +1,121 @@
+import threading
+from collections import deque
+
+# Fan-out en memoria de las lecturas nuevas hacia los suscriptores (SSE) del mismo proceso.
+# Cada suscriptor tiene un buffer acotado; si se llena, el suscriptor se expulsa en vez de
+# bloquear a quien publica o hacer crecer la memoria. Al reconectarse con Last-Event-ID
+# recupera desde la base lo que se perdió.
+
+class Subscription:
+    def __init__(self, broker, sensor_ids, maxsize):
+        self.broker = broker
+        self.sensor_ids = frozenset(sensor_ids)
+        self.maxsize = maxsize
+        self.closed = False
+        self.evicted = False
+        self._events = deque()
+        self._condition = threading.Condition()
+
+    # Lo llama quien publica; nunca bloquea. Retorna False si el suscriptor fue expulsado
+    def offer(self, events):
+        with self._condition:
+            if self.closed:
+                return False
+            if len(self._events) + len(events) > self.maxsize:
+                self.closed = True
+                self.evicted = True
+                self._events.clear()
+                self._condition.notify_all()
+                return False
+            self._events.extend(events)
+            self._condition.notify_all()
+        return True
+
+    # Retorna los eventos pendientes; espera hasta timeout segundos si no hay ninguno
+    def get(self, timeout):
+        with self._condition:
+            if not self._events and not self.closed:
+                self._condition.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        self.broker.unsubscribe(self)
+
+class Broker:
+    def __init__(self, buffer_size=1000, max_subscribers=1000):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._by_sensor = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        self.evictions = 0
+
+    # Retorna None si se alcanzó el máximo de suscriptores
+    def subscribe(self, sensor_ids):
+        subscription = Subscription(self, sensor_ids, self.buffer_size)
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                return None
+            self._count += 1
+            for sensor_id in subscription.sensor_ids:
+                self._by_sensor.setdefault(sensor_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            removed = False
+            for sensor_id in subscription.sensor_ids:
+                subscribers = self._by_sensor.get(sensor_id)
+                if subscribers and subscription in subscribers:
+                    subscribers.discard(subscription)
+                    removed = True
+                    if not subscribers:
+                        del self._by_sensor[sensor_id]
+            if removed:
+                self._count -= 1
+
+    # Permite evitar armar los eventos cuando nadie está suscrito
+    def has_subscribers(self):
+        return bool(self._by_sensor)
+
+    # events es una lista de (sensor_id, evento); cada suscriptor recibe los de sus sensores, en orden
+    def publish(self, events):
+        with self._lock:
+            if not self._by_sensor:
+                return
+            targets = {}
+            for sensor_id, event in events:
+                for subscription in self._by_sensor.get(sensor_id, ()):
+                    targets.setdefault(subscription, []).append(event)
+            self.published += len(events)
+        delivered = 0
+        evicted = []
+        for subscription, subscription_events in targets.items():
+            if subscription.offer(subscription_events):
+                delivered += len(subscription_events)
+            elif subscription.evicted:
+                evicted.append(subscription)
+        for subscription in evicted:
+            self.unsubscribe(subscription)
+        with self._lock:
+            self.delivered += delivered
+            self.evictions += len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': self._count,
+                'max_subscribers': self.max_subscribers,
+                'buffer_size': self.buffer_size,
+                'sensors': len(self._by_sensor),
+                'published': self.published,
+                'delivered': self.delivered,
+                'evictions': self.evictions,
+            }
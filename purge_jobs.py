@@ -0,0 +1,159 @@
+import time
+
+# Borrado en segundo plano de lo que dependía de una ubicación o un sensor eliminado.
+# Al borrar, la API quita o desvincula el registro padre de inmediato y crea un trabajo en Purge_Job con
+# los sensores a limpiar en Purge_Sensor. Un hilo de cada worker toma los trabajos pendientes y borra las
+# lecturas y filas de esos sensores por partes: cada parte es una transacción corta con un máximo de filas,
+# con una pausa entre partes para que la ingesta no espere. El trabajo se toma con un lease (claimed_at):
+# si el worker que lo tenía muere, otro lo retoma cuando el lease vence.
+#
+# El trabajo 'orphans' lo crea la migración para limpiar lo que quedó huérfano antes de existir esta limpieza:
+# sensores de ubicaciones borradas y lecturas de sensores que ya no existen.
+# Solo se borran filas de Sensor con company_id NULL, así un trabajo nunca borra un sensor vigente.
+
+KINDS = ('location', 'sensor', 'orphans')
+
+def create_tables(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS Purge_Job(
+        ID INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        kind TEXT NOT NULL,
+        target TEXT,
+        company_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'pending',
+        sensors_total INTEGER NOT NULL DEFAULT 0,
+        sensors_deleted INTEGER NOT NULL DEFAULT 0,
+        rows_deleted INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        claimed_by TEXT,
+        claimed_at INTEGER,
+        created_at INTEGER NOT NULL,
+        started_at INTEGER,
+        finished_at INTEGER
+    )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_purge_job_status ON Purge_Job(status)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_purge_job_company ON Purge_Job(company_id, ID)')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS Purge_Sensor(
+        job_id INTEGER NOT NULL,
+        sensor_id INTEGER NOT NULL,
+        PRIMARY KEY(job_id, sensor_id)
+    ) WITHOUT ROWID
+    ''')
+
+# Crea un trabajo para los sensores dados y retorna su ID. Debe llamarse dentro de la transacción del borrado
+def create_job(cur, kind, target, company_id, sensor_ids, now=None):
+    now = int(time.time()) if now is None else now
+    cur.execute('INSERT INTO Purge_Job(kind, target, company_id, sensors_total, created_at) VALUES(?, ?, ?, ?, ?)',
+                (kind, target, company_id, len(sensor_ids), now))
+    job_id = cur.lastrowid
+    cur.executemany('INSERT OR IGNORE INTO Purge_Sensor(job_id, sensor_id) VALUES(?, ?)',
+                    [(job_id, sensor_id) for sensor_id in sensor_ids])
+    return job_id
+
+# Toma el trabajo pendiente más antiguo (o uno cuyo lease venció) para owner. Retorna la fila o None
+def claim_next(conn, owner, lease_seconds, now=None):
+    now = int(time.time()) if now is None else now
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        cur.execute("SELECT * FROM Purge_Job WHERE status IN ('pending', 'running') "
+                    "AND (claimed_at IS NULL OR claimed_at < ?) ORDER BY ID LIMIT 1", (now - lease_seconds,))
+        job = cur.fetchone()
+        if job is not None:
+            cur.execute("UPDATE Purge_Job SET status = 'running', claimed_by = ?, claimed_at = ?, "
+                        "started_at = COALESCE(started_at, ?) WHERE ID = ?", (owner, now, now, job['ID']))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return job
+
+# Registra el avance y renueva el lease. Retorna False si otro worker tomó el trabajo
+def _progress(conn, job_id, owner, sensors_deleted=0, rows_deleted=0, status=None):
+    now = int(time.time())
+    cur = conn.cursor()
+    cur.execute('UPDATE Purge_Job SET sensors_deleted = sensors_deleted + ?, rows_deleted = rows_deleted + ?, '
+                'claimed_at = ?, status = COALESCE(?, status), '
+                "finished_at = CASE WHEN ? = 'done' THEN ? ELSE finished_at END "
+                'WHERE ID = ? AND claimed_by = ?',
+                (sensors_deleted, rows_deleted, now, status, status, now, job_id, owner))
+    owned = cur.rowcount == 1
+    conn.commit()
+    return owned
+
+# Llena Purge_Sensor del trabajo 'orphans': sensores desvinculados de su compañía (su ubicación se borró)
+# y sensores con lecturas que no están en la tabla Sensor
+def _prepare_orphans(conn, job_id, backend):
+    cur = conn.cursor()
+    cur.execute('SELECT sensor_id FROM Sensor WHERE company_id IS NULL')
+    orphans = {row[0] for row in cur.fetchall()}
+    reading_sensors = backend.reading_sensor_ids(conn)
+    cur.execute('SELECT sensor_id FROM Sensor')
+    existing = {row[0] for row in cur.fetchall()}
+    orphans.update(sensor_id for sensor_id in reading_sensors if sensor_id not in existing)
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        cur.executemany('INSERT OR IGNORE INTO Purge_Sensor(job_id, sensor_id) VALUES(?, ?)',
+                        [(job_id, sensor_id) for sensor_id in sorted(orphans)])
+        cur.execute('UPDATE Purge_Job SET sensors_total = ? WHERE ID = ?', (len(orphans), job_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+# Ejecuta un trabajo tomado con claim_next hasta terminarlo. backend es el de las lecturas
+# (ver sensor_data_store.SqliteBackend.purge_sensors). Retorna False si se perdió el lease
+def run_job(conn, job, backend, owner, chunk_size=1000, pause=0.05, sensors_per_step=100):
+    job_id = job['ID']
+    cur = conn.cursor()
+    # Se prepara en la primera pasada, o de nuevo si la anterior falló antes de llenar Purge_Sensor
+    if job['kind'] == 'orphans' and job['sensors_total'] == 0:
+        _prepare_orphans(conn, job_id, backend)
+
+    while True:
+        cur.execute('SELECT sensor_id FROM Purge_Sensor WHERE job_id = ? ORDER BY sensor_id LIMIT ?',
+                    (job_id, sensors_per_step))
+        sensor_ids = [row[0] for row in cur.fetchall()]
+        if not sensor_ids:
+            return _progress(conn, job_id, owner, status='done')
+
+        deleted = backend.purge_sensors(conn, sensor_ids, chunk_size)
+        if deleted:
+            if not _progress(conn, job_id, owner, rows_deleted=deleted):
+                return False
+        else:
+            # Ya no quedan lecturas de estos sensores: se borran sus filas
+            placeholders = ','.join(['?'] * len(sensor_ids))
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                cur.execute(f'DELETE FROM Sensor WHERE sensor_id IN ({placeholders}) AND company_id IS NULL', sensor_ids)
+                cur.execute(f'DELETE FROM Purge_Sensor WHERE job_id = ? AND sensor_id IN ({placeholders})',
+                            [job_id] + sensor_ids)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if not _progress(conn, job_id, owner, sensors_deleted=len(sensor_ids)):
+                return False
+        # Deja pasar a la ingesta entre partes
+        time.sleep(pause)
+
+# Guarda el error y suelta el trabajo para que se reintente en la siguiente pasada
+def record_error(conn, job_id, error):
+    conn.rollback()
+    conn.execute('UPDATE Purge_Job SET error = ?, claimed_at = NULL WHERE ID = ?', (str(error), job_id))
+    conn.commit()
+
+# Devuelve al sistema hasta pages páginas libres si la base usa auto_vacuum incremental.
+# Retorna las páginas liberadas
+def incremental_vacuum(conn, pages):
+    if pages <= 0 or conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 0
+    free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    if not free:
+        return 0
+    # Con execute la sentencia avanza un solo paso (una página); executescript la ejecuta completa
+    conn.executescript(f'PRAGMA incremental_vacuum({min(pages, free):d})')
+    return free - conn.execute('PRAGMA freelist_count').fetchone()[0]
@@ -0,0 +1,255 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# Límites de peticiones por token bucket, en memoria de cada worker.
+# Cada bucket es de una clase de ruta y una identidad: 'ingest' por sensor (el costo es la cantidad de
+# lecturas), 'read' (consultas pesadas de Sensor_Data) y 'api' (el resto de las rutas de compañía) por compañía.
+# Los límites por defecto vienen de la configuración y cada compañía puede tener los suyos (tabla Rate_Limit),
+# que cada proceso relee como mucho cada refresh_seconds. Con varios workers cada uno tiene sus buckets, así
+# que el límite efectivo se multiplica por la cantidad de workers.
+#
+# LoadShedder rechaza las consultas de baja prioridad cuando el worker está sobrecargado, antes de que la
+# ingesta se vea afectada (ver SHED_CLASSES).
+
+ROUTE_CLASSES = ('ingest', 'read', 'api')
+# Clases que se rechazan primero cuando el worker está sobrecargado; la ingesta nunca se descarta aquí
+SHED_CLASSES = ('read',)
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'allowed', 'limited')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.allowed = 0
+        self.limited = 0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Segundos que faltan para poder gastar cost. Un costo mayor que burst se acepta con el bucket lleno
+    # y deja el bucket en deuda, así un lote grande no queda rechazado para siempre
+    def wait_for(self, cost):
+        missing = min(cost, self.burst) - self.tokens
+        return 0.0 if missing <= 0 else missing / self.rate
+
+class RateLimiter:
+    # limits es {clase: (tokens por segundo, burst)}; una tasa de 0 deja la clase sin límite.
+    # load_overrides retorna {(company_id, clase): (tasa, burst)}
+    def __init__(self, limits, max_buckets=100000, refresh_seconds=5.0, load_overrides=None):
+        self.limits = dict(limits)
+        self.max_buckets = max_buckets
+        self.refresh_seconds = refresh_seconds
+        self.load_overrides = load_overrides
+        self._overrides = {}
+        self._loaded_at = None
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = dict.fromkeys(ROUTE_CLASSES, 0)
+        self.limited = dict.fromkeys(ROUTE_CLASSES, 0)
+        self.evictions = 0
+
+    def _sync(self):
+        if self.load_overrides is None:
+            return
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < self.refresh_seconds:
+            return
+        overrides = self.load_overrides()
+        with self._lock:
+            self._overrides = overrides
+            self._loaded_at = now
+
+    # Registra los límites de una compañía en este proceso; los demás los ven en su siguiente relectura
+    def set_overrides(self, company_id, limits):
+        with self._lock:
+            for route_class in ROUTE_CLASSES:
+                self._overrides.pop((company_id, route_class), None)
+            for route_class, limit in limits.items():
+                self._overrides[(company_id, route_class)] = limit
+
+    def has_overrides(self, route_class):
+        return any(override_class == route_class for _, override_class in self._overrides)
+
+    def limit_for(self, route_class, company_id):
+        return self._overrides.get((company_id, route_class), self.limits.get(route_class, (0, 0)))
+
+    def _bucket(self, route_class, key, company_id, now):
+        rate, burst = self.limit_for(route_class, company_id)
+        if rate <= 0:
+            return None
+        bucket = self._buckets.get((route_class, key))
+        if bucket is None:
+            bucket = self._buckets[(route_class, key)] = TokenBucket(rate, burst, now)
+            while len(self._buckets) > self.max_buckets:
+                # Un bucket que se descarta vuelve lleno, igual que uno que no se usó en un buen rato
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._buckets.move_to_end((route_class, key))
+            bucket.refill(now)
+            if (bucket.rate, bucket.burst) != (rate, burst):
+                # Si el límite cambió, el bucket conserva lo ya gastado respecto del burst nuevo
+                bucket.tokens = min(burst, bucket.tokens + max(0, burst - bucket.burst))
+                bucket.rate, bucket.burst = rate, burst
+        return bucket
+
+    # items es una lista de (clase, identidad, costo, company_id). Se gasta de todos los buckets o de ninguno.
+    # Retorna 0 si se aceptó, o los segundos que hay que esperar para reintentar
+    def take(self, items):
+        self._sync()
+        now = time.monotonic()
+        with self._lock:
+            buckets = [(self._bucket(route_class, key, company_id, now), route_class, cost)
+                       for route_class, key, cost, company_id in items]
+            wait = max([bucket.wait_for(cost) for bucket, _, cost in buckets if bucket is not None] or [0.0])
+            for bucket, route_class, cost in buckets:
+                if wait > 0:
+                    self.limited[route_class] += 1
+                    if bucket is not None and bucket.wait_for(cost) > 0:
+                        bucket.limited += 1
+                    continue
+                self.allowed[route_class] += 1
+                if bucket is not None:
+                    bucket.tokens -= cost
+                    bucket.allowed += 1
+        return wait
+
+    # Gasta cost aunque el bucket quede en deuda y retorna los segundos que hay que esperar para saldarla.
+    # Lo usa el canal de ingesta, que frena la lectura del cuerpo en vez de rechazar
+    def reserve(self, route_class, key, cost, company_id=None):
+        self._sync()
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket(route_class, key, company_id, now)
+            self.allowed[route_class] += 1
+            if bucket is None:
+                return 0.0
+            bucket.tokens -= cost
+            bucket.allowed += 1
+            return 0.0 if bucket.tokens >= 0 else -bucket.tokens / bucket.rate
+
+    # Olvida los buckets de una identidad (p. ej. un sensor eliminado)
+    def forget(self, route_class, key):
+        with self._lock:
+            self._buckets.pop((route_class, key), None)
+
+    def stats(self, top=20):
+        with self._lock:
+            limited = sorted(((bucket.limited, route_class, key, bucket) for (route_class, key), bucket
+                              in self._buckets.items() if bucket.limited), key=lambda item: item[0], reverse=True)
+            return {
+                'limits': {route_class: {'rate': rate, 'burst': burst} for route_class, (rate, burst) in self.limits.items()},
+                'company_overrides': len(self._overrides),
+                'buckets': len(self._buckets),
+                'evictions': self.evictions,
+                'allowed': dict(self.allowed),
+                'limited': dict(self.limited),
+                'most_limited': [{'class': route_class, 'key': key, 'limited': count, 'allowed': bucket.allowed,
+                                  'tokens': round(bucket.tokens, 2), 'rate': bucket.rate, 'burst': bucket.burst}
+                                 for count, route_class, key, bucket in limited[:top]],
+            }
+
+# Detecta la sobrecarga del worker: peticiones en curso, latencia reciente de la ingesta (promedio móvil que
+# decae a la mitad cada half_life segundos sin muestras nuevas) y profundidad de la cola de ingesta.
+# Un umbral en 0 no se revisa
+class LoadShedder:
+    def __init__(self, max_in_flight=0, max_latency=0.0, max_queue_depth=0, queue_depth=None, half_life=2.0,
+                 smoothing=0.2):
+        self.max_in_flight = max_in_flight
+        self.max_latency = max_latency
+        self.max_queue_depth = max_queue_depth
+        self.queue_depth = queue_depth
+        self.half_life = half_life
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self._latency = 0.0
+        self._latency_at = time.monotonic()
+        self.shed = dict.fromkeys(SHED_CLASSES, 0)
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    # Registra la duración de una petición de ingesta
+    def record_latency(self, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._latency = self._decayed(now) * (1 - self.smoothing) + seconds * self.smoothing
+            self._latency_at = now
+
+    def _decayed(self, now):
+        return self._latency * 0.5 ** ((now - self._latency_at) / self.half_life)
+
+    def latency(self):
+        with self._lock:
+            return self._decayed(time.monotonic())
+
+    # Retorna el motivo de la sobrecarga ('in_flight', 'latency' o 'queue_depth') o None
+    def overloaded(self):
+        if self.max_in_flight and self.in_flight > self.max_in_flight:
+            return 'in_flight'
+        if self.max_latency and self.latency() > self.max_latency:
+            return 'latency'
+        if self.max_queue_depth and self.queue_depth is not None and self.queue_depth() >= self.max_queue_depth:
+            return 'queue_depth'
+        return None
+
+    # Retorna el motivo si una petición de la clase debe rechazarse, o None
+    def should_shed(self, route_class):
+        if route_class not in SHED_CLASSES:
+            return None
+        reason = self.overloaded()
+        if reason is not None:
+            with self._lock:
+                self.shed[route_class] += 1
+        return reason
+
+    def stats(self):
+        reason = self.overloaded()
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'ingest_latency': round(self._decayed(time.monotonic()), 4),
+                'queue_depth': self.queue_depth() if self.queue_depth is not None else None,
+                'thresholds': {'in_flight': self.max_in_flight, 'latency': self.max_latency,
+                               'queue_depth': self.max_queue_depth},
+                'overloaded': reason,
+                'shed': dict(self.shed),
+            }
+
+def create_tables(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS Rate_Limit(
+        company_id INTEGER NOT NULL,
+        route_class TEXT NOT NULL,
+        rate REAL NOT NULL,
+        burst REAL NOT NULL,
+        PRIMARY KEY(company_id, route_class)
+    ) WITHOUT ROWID
+    ''')
+
+# {(company_id, clase): (tasa, burst)} de todas las compañías con límites propios
+def load_overrides(cur):
+    cur.execute('SELECT company_id, route_class, rate, burst FROM Rate_Limit')
+    return {(row[0], row[1]): (row[2], row[3]) for row in cur.fetchall()}
+
+# Reemplaza los límites de una compañía ({clase: (tasa, burst)}). Debe llamarse dentro de una transacción
+def set_company_limits(cur, company_id, limits):
+    cur.execute('DELETE FROM Rate_Limit WHERE company_id = ?', (company_id,))
+    cur.executemany('INSERT INTO Rate_Limit(company_id, route_class, rate, burst) VALUES(?, ?, ?, ?)',
+                    [(company_id, route_class, rate, burst) for route_class, (rate, burst) in limits.items()])
+
+# Valor del header Retry-After: segundos enteros, al menos 1
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,176 @@
+import re
+
+# Agregados por bucket de los campos numéricos de Sensor_Data.data.
+# Sensor_Data_Rollup guarda, por sensor, tamaño de bucket, inicio de bucket y campo:
+# cantidad, suma, mínimo, máximo y el último valor (según ts, ID).
+# Se mantiene en la misma transacción que inserta las lecturas.
+
+# Tamaños de bucket (en segundos) que se mantienen precalculados. Cada uno divide al siguiente
+ROLLUP_BUCKETS = (60, 3600, 86400)
+
+BUCKET_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Máximo de buckets que puede pedir una consulta
+MAX_BUCKETS = 100000
+
+# Solo se agregan los campos numéricos de primer nivel de un objeto JSON
+_FIELDS_SOURCE = '''json_each(CASE WHEN json_valid(sd.data)
+                          THEN (CASE WHEN json_type(sd.data) = 'object' THEN sd.data ELSE '{}' END)
+                          ELSE '{}' END) je'''
+
+_BUCKET_VALUES = ', '.join(f'({size:d})' for size in ROLLUP_BUCKETS)
+
+# source es la tabla (o partición) de lecturas de la que se agregan las filas
+def _upsert_sql(where, source='Sensor_Data'):
+    return f'''
+    WITH v AS (
+        SELECT sd.sensor_id AS sensor_id, b.column1 AS bucket_size, (sd.ts / b.column1) * b.column1 AS bucket_start,
+               je.key AS field, je.value AS value, sd.ts AS ts, sd.ID AS id,
+               ROW_NUMBER() OVER (PARTITION BY sd.sensor_id, b.column1, sd.ts / b.column1, je.key
+                                  ORDER BY sd.ts DESC, sd.ID DESC) AS rn
+        FROM {source} sd
+        JOIN {_FIELDS_SOURCE}
+        JOIN (VALUES {_BUCKET_VALUES}) b
+        WHERE {where} AND je.type IN ('integer', 'real')
+    )
+    INSERT INTO Sensor_Data_Rollup(sensor_id, bucket_size, bucket_start, field, value_count, value_sum,
+                                   value_min, value_max, last_value, last_ts, last_id)
+    SELECT sensor_id, bucket_size, bucket_start, field, COUNT(*), SUM(value), MIN(value), MAX(value),
+           MAX(CASE WHEN rn = 1 THEN value END), MAX(ts), MAX(CASE WHEN rn = 1 THEN id END)
+    FROM v WHERE true
+    GROUP BY sensor_id, bucket_size, bucket_start, field
+    ON CONFLICT(sensor_id, bucket_size, bucket_start, field) DO UPDATE SET
+        value_count = value_count + excluded.value_count,
+        value_sum = value_sum + excluded.value_sum,
+        value_min = MIN(value_min, excluded.value_min),
+        value_max = MAX(value_max, excluded.value_max),
+        last_value = CASE WHEN (excluded.last_ts, excluded.last_id) > (last_ts, last_id)
+                          THEN excluded.last_value ELSE last_value END,
+        last_id = CASE WHEN (excluded.last_ts, excluded.last_id) > (last_ts, last_id)
+                       THEN excluded.last_id ELSE last_id END,
+        last_ts = MAX(last_ts, excluded.last_ts)
+    '''
+
+def create_rollup_table(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS Sensor_Data_Rollup(
+        sensor_id INTEGER NOT NULL,
+        bucket_size INTEGER NOT NULL,
+        bucket_start INTEGER NOT NULL,
+        field TEXT NOT NULL,
+        value_count INTEGER NOT NULL,
+        value_sum NUMERIC NOT NULL,
+        value_min NUMERIC NOT NULL,
+        value_max NUMERIC NOT NULL,
+        last_value NUMERIC NOT NULL,
+        last_ts INTEGER NOT NULL,
+        last_id INTEGER NOT NULL,
+        PRIMARY KEY (sensor_id, bucket_size, bucket_start, field)
+    ) WITHOUT ROWID
+    ''')
+
+# Suma a los rollups las lecturas de source con ID entre first_id y last_id (recién insertadas)
+def add_to_rollups(cur, first_id, last_id, source='Sensor_Data'):
+    cur.execute(_upsert_sql('sd.ID BETWEEN ? AND ?', source), (first_id, last_id))
+
+# Recalcula todos los rollups a partir de las tablas de lecturas dadas
+def rebuild_all_rollups(cur, sources=('Sensor_Data',)):
+    cur.execute('DELETE FROM Sensor_Data_Rollup')
+    for source in sources:
+        cur.execute(_upsert_sql('1', source))
+
+# Recalcula los buckets de un sensor que contienen los tiempos dados, después de un UPDATE o DELETE.
+# Se recalcula el bucket más grande completo, que contiene a los más pequeños.
+# sources_for(start, end) retorna las tablas de lecturas que cubren ese rango
+def refresh_rollups(cur, sensor_id, ts_values, sources_for):
+    size = ROLLUP_BUCKETS[-1]
+    for start in {ts - ts % size for ts in ts_values}:
+        end = start + size - 1
+        cur.execute('DELETE FROM Sensor_Data_Rollup WHERE sensor_id = ? AND bucket_start BETWEEN ? AND ?',
+                    (sensor_id, start, end))
+        for source in sources_for(start, end):
+            cur.execute(_upsert_sql('sd.sensor_id = ? AND sd.ts BETWEEN ? AND ?', source), (sensor_id, start, end))
+
+# Convierte '15m', '1h', '1d', etc. a segundos. Retorna None si el formato no es válido
+def parse_bucket(value):
+    match = re.fullmatch(r'(\d+)([smhd])', value or '')
+    if not match:
+        return None
+    seconds = int(match.group(1)) * BUCKET_UNITS[match.group(2)]
+    return seconds or None
+
+# Mayor tamaño precalculado que divide al bucket pedido, o None si hay que usar los datos crudos
+def rollup_size_for(bucket):
+    sizes = [size for size in ROLLUP_BUCKETS if bucket % size == 0]
+    return sizes[-1] if sizes else None
+
+def _placeholders(values):
+    return ','.join(['?'] * len(values))
+
+# Rango [start, end] que se consulta para from/to alineados al bucket
+def aligned_range(from_ts, to_ts, bucket):
+    return from_ts - from_ts % bucket, to_ts - to_ts % bucket + bucket - 1
+
+# Campos numéricos con rollups de los sensores en [from_ts, to_ts] (alineado a días)
+def fields_in_range(cur, sensor_ids, from_ts, to_ts):
+    size = ROLLUP_BUCKETS[-1]
+    cur.execute(f'''
+    SELECT DISTINCT field FROM Sensor_Data_Rollup
+    WHERE bucket_size = ? AND sensor_id IN ({_placeholders(sensor_ids)}) AND bucket_start BETWEEN ? AND ?
+    ORDER BY field
+    ''', [size] + list(sensor_ids) + [from_ts - from_ts % size, to_ts])
+    return [row[0] for row in cur.fetchall()]
+
+# Consulta los agregados por bucket. Los límites from/to se alinean a los buckets.
+# Sin rollup_size se agregan las lecturas de las tablas raw_sources.
+# Retorna filas (sensor_id, bucket, field, count, min, max, avg, last) ordenadas por sensor, campo y bucket
+def aggregate(cur, sensor_ids, from_ts, to_ts, bucket, fields=None, rollup_size=None, raw_sources=('Sensor_Data',)):
+    start, end = aligned_range(from_ts, to_ts, bucket)
+
+    if rollup_size is None:
+        if not raw_sources:
+            return []
+        readings = ' UNION ALL '.join(f'SELECT ID, sensor_id, data, ts FROM {source}' for source in raw_sources)
+        params = [bucket, bucket, bucket]
+        where = f'sd.sensor_id IN ({_placeholders(sensor_ids)}) AND sd.ts BETWEEN ? AND ?'
+        params.extend(sensor_ids)
+        params.extend([start, end])
+        if fields:
+            where += f' AND je.key IN ({_placeholders(fields)})'
+            params.extend(fields)
+        source = f'''
+            SELECT sd.sensor_id AS sensor_id, (sd.ts / ?) * ? AS bucket, je.key AS field,
+                   1 AS value_count, je.value AS value_sum, je.value AS value_min, je.value AS value_max,
+                   je.value AS last_value,
+                   ROW_NUMBER() OVER (PARTITION BY sd.sensor_id, sd.ts / ?, je.key
+                                      ORDER BY sd.ts DESC, sd.ID DESC) AS rn
+            FROM ({readings}) sd
+            JOIN {_FIELDS_SOURCE}
+            WHERE {where} AND je.type IN ('integer', 'real')
+        '''
+    else:
+        params = [bucket, bucket, bucket, rollup_size]
+        where = f'bucket_size = ? AND sensor_id IN ({_placeholders(sensor_ids)}) AND bucket_start BETWEEN ? AND ?'
+        params.extend(sensor_ids)
+        params.extend([start, end])
+        if fields:
+            where += f' AND field IN ({_placeholders(fields)})'
+            params.extend(fields)
+        source = f'''
+            SELECT sensor_id, (bucket_start / ?) * ? AS bucket, field,
+                   value_count, value_sum, value_min, value_max, last_value,
+                   ROW_NUMBER() OVER (PARTITION BY sensor_id, bucket_start / ?, field
+                                      ORDER BY last_ts DESC, last_id DESC) AS rn
+            FROM Sensor_Data_Rollup
+            WHERE {where}
+        '''
+
+    cur.execute(f'''
+    WITH r AS ({source})
+    SELECT sensor_id, bucket, field, SUM(value_count) AS count, MIN(value_min) AS min, MAX(value_max) AS max,
+           SUM(value_sum) * 1.0 / SUM(value_count) AS avg, MAX(CASE WHEN rn = 1 THEN last_value END) AS last
+    FROM r
+    GROUP BY sensor_id, bucket, field
+    ORDER BY sensor_id, field, bucket
+    ''', params)
+    return cur
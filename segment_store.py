@@ -0,0 +1,749 @@
+import bisect
+import heapq
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Sin fcntl (Windows) el lock entre procesos no está disponible: usar un solo proceso
+    fcntl = None
+
+import data_filters
+import rollups
+
+# Almacenamiento alternativo de Sensor_Data en archivos (IOT_SENSOR_DATA_BACKEND=segments).
+# Compañías, ubicaciones y sensores siguen en SQLite; aquí solo van las lecturas.
+#
+# Cada sensor tiene un directorio s<sensor_id> con un log de solo escritura al final, dividido en segmentos
+# de hasta max_segment_bytes. MANIFEST lista los segmentos en orden y se reemplaza de forma atómica.
+# Cada segmento empieza con SEGMENT_MAGIC y sigue con registros:
+#   RECORD (kind, ID, ts, largo de data, crc32) + data en UTF-8
+# kind INSERT es una lectura nueva, REWRITE reemplaza la lectura con ese ID (PUT) y DELETE la borra.
+# La versión vigente de un ID reescrito o borrado se guarda en overrides; lo demás se descarta al leer
+# y la compactación lo elimina de los archivos.
+#
+# Los segmentos se leen con mmap: los encabezados se interpretan sobre el mapa sin copiarlos y data solo
+# se decodifica para las lecturas que se retornan. Por segmento se guarda en memoria un índice disperso
+# (ts, ID, offset) cada index_interval registros, que permite saltar al inicio de un rango de tiempo.
+#
+# El archivo sequence tiene dos enteros: el último ID asignado y el último ID escrito por completo.
+# Los escritores (de cualquier proceso) se serializan con flock sobre el archivo lock, así los IDs
+# se escriben en orden. Si un proceso muere a mitad de una escritura, el siguiente escritor corta el
+# registro incompleto al final del segmento y da por escritos los IDs asignados (quedan como hueco).
+
+SEGMENT_MAGIC = b'IOTSEG1\n'
+RECORD = struct.Struct('<BqqII')
+SEQUENCE = struct.Struct('<qq')
+INSERT, REWRITE, DELETE = 0, 1, 2
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_SENSOR_DIR = re.compile(r's(\d+)$')
+
+def _crc(kind, sensor_data_id, ts, data):
+    return zlib.crc32(data, zlib.crc32(RECORD.pack(kind, sensor_data_id, ts, len(data), 0)))
+
+def encode_record(kind, sensor_data_id, ts, data):
+    return RECORD.pack(kind, sensor_data_id, ts, len(data), _crc(kind, sensor_data_id, ts, data)) + data
+
+def _row(sensor_id, sensor_data_id, ts, data):
+    return {'ID': sensor_data_id, 'sensor_id': sensor_id, 'data': data, 'ts': ts,
+            'time': time.strftime(TIME_FORMAT, time.gmtime(ts))}
+
+# Un registro es vigente si no fue reescrito ni borrado después, o si es la versión que quedó
+def _live(overrides, name, offset, kind, sensor_data_id):
+    if kind == DELETE:
+        return False
+    if sensor_data_id in overrides:
+        return overrides[sensor_data_id] == (name, offset)
+    return kind == INSERT
+
+def _write_atomic(path, data, fsync):
+    tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class Segment:
+    def __init__(self, path, index_interval):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.index_interval = index_interval
+        # Bytes validados desde el inicio del archivo
+        self.size = len(SEGMENT_MAGIC)
+        self.count = 0
+        # Registros REWRITE y DELETE; si hay en un segmento cerrado conviene compactar
+        self.rewrites = 0
+        self.min_ts = self.max_ts = self.min_id = self.max_id = None
+        # Si los registros están en orden (ts, ID) el índice disperso sirve para buscar
+        self.ts_sorted = True
+        self.index = []
+        # Hay bytes después del último registro válido (escritura en curso o interrumpida)
+        self.torn = False
+        self._last = None
+        self._map = None
+
+    def _mapping(self, size):
+        if self._map is None or len(self._map) < size:
+            with open(self.path, 'rb') as f:
+                # El mapa anterior se libera cuando nadie lo usa (un snapshot puede seguir leyéndolo)
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    # Valida los registros nuevos al final del archivo y actualiza las estadísticas.
+    # Retorna [(kind, ID, offset)] de los registros nuevos
+    def scan(self):
+        file_size = os.path.getsize(self.path)
+        if file_size <= self.size:
+            self.torn = False
+            return []
+        mm = self._mapping(file_size)
+        if self.size == len(SEGMENT_MAGIC) and mm[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            raise ValueError(f'{self.path} is not a segment file')
+        new = []
+        offset = self.size
+        self.torn = False
+        with memoryview(mm) as view:
+            while offset < file_size:
+                if offset + RECORD.size > file_size:
+                    self.torn = True
+                    break
+                kind, sensor_data_id, ts, length, crc = RECORD.unpack_from(mm, offset)
+                end = offset + RECORD.size + length
+                if kind > DELETE or end > file_size or crc != _crc(kind, sensor_data_id, ts, view[offset + RECORD.size:end]):
+                    self.torn = True
+                    break
+                self._note(kind, sensor_data_id, ts, offset)
+                new.append((kind, sensor_data_id, offset))
+                offset = end
+        self.size = offset
+        return new
+
+    def _note(self, kind, sensor_data_id, ts, offset):
+        if self.count % self.index_interval == 0:
+            self.index.append((ts, sensor_data_id, offset))
+        self.count += 1
+        self.min_id = sensor_data_id if self.min_id is None else min(self.min_id, sensor_data_id)
+        self.max_id = sensor_data_id if self.max_id is None else max(self.max_id, sensor_data_id)
+        if kind == DELETE:
+            self.rewrites += 1
+            return
+        if kind == REWRITE:
+            self.rewrites += 1
+        self.min_ts = ts if self.min_ts is None else min(self.min_ts, ts)
+        self.max_ts = ts if self.max_ts is None else max(self.max_ts, ts)
+        if self._last is not None and (ts, sensor_data_id) < self._last:
+            self.ts_sorted = False
+        self._last = (ts, sensor_data_id)
+
+    # Recorre los registros en [start, end): (offset, kind, ID, ts, largo)
+    def records(self, start, end):
+        mm = self._mapping(end)
+        unpack = RECORD.unpack_from
+        offset = start
+        while offset < end:
+            kind, sensor_data_id, ts, length, _ = unpack(mm, offset)
+            yield offset, kind, sensor_data_id, ts, length
+            offset += RECORD.size + length
+
+    def data(self, offset, length):
+        start = offset + RECORD.size
+        return self._mapping(start + length)[start:start + length].decode('utf-8')
+
+    # Offset desde el que hay que leer para encontrar lecturas posteriores a (ts, ID)
+    def seek(self, position, end):
+        if not self.ts_sorted or not self.index:
+            return len(SEGMENT_MAGIC)
+        i = bisect.bisect_left(self.index, position) - 1
+        while i >= 0 and self.index[i][2] >= end:
+            i -= 1
+        return self.index[i][2] if i >= 0 else len(SEGMENT_MAGIC)
+
+# Estado de los segmentos de un sensor visto en un momento: [(segmento, bytes visibles)] y overrides
+class SensorView:
+    def __init__(self, sensor_id, segments, overrides):
+        self.sensor_id = sensor_id
+        self.segments = segments
+        self.overrides = overrides
+
+    # Lecturas vigentes en [from_ts, to_ts] posteriores a after, en orden (ts, ID)
+    def iter_range(self, from_ts, to_ts, after=None, with_data=True):
+        iterators = []
+        for segment, end in self.segments:
+            if segment.min_ts is None or segment.max_ts < from_ts or segment.min_ts > to_ts:
+                continue
+            if after is not None and segment.max_ts < after[0]:
+                continue
+            rows = self._segment_range(segment, end, from_ts, to_ts, after, with_data)
+            iterators.append(rows if segment.ts_sorted else iter(sorted(rows, key=lambda row: (row[0], row[1]))))
+        return heapq.merge(*iterators, key=lambda row: (row[0], row[1]))
+
+    # Filas (ts, ID, sensor_id, data) de un segmento; data es None si with_data es False
+    def _segment_range(self, segment, end, from_ts, to_ts, after, with_data):
+        start = (from_ts, -1) if after is None or (from_ts, -1) > tuple(after) else tuple(after)
+        offset = segment.seek(start, end) if segment.ts_sorted else len(SEGMENT_MAGIC)
+        overrides = self.overrides
+        for offset, kind, sensor_data_id, ts, length in segment.records(offset, end):
+            if ts > to_ts:
+                if segment.ts_sorted:
+                    return
+                continue
+            if ts < from_ts or (after is not None and (ts, sensor_data_id) <= tuple(after)):
+                continue
+            if not _live(overrides, segment.name, offset, kind, sensor_data_id):
+                continue
+            yield ts, sensor_data_id, self.sensor_id, segment.data(offset, length) if with_data else None
+
+    # Lecturas vigentes con ID mayor que after_id, en orden de ID: (ID, ts, sensor_id, data)
+    def after_id(self, after_id):
+        rows = []
+        for segment, end in self.segments:
+            if segment.max_id is None or segment.max_id <= after_id:
+                continue
+            for offset, kind, sensor_data_id, ts, length in segment.records(len(SEGMENT_MAGIC), end):
+                if sensor_data_id > after_id and _live(self.overrides, segment.name, offset, kind, sensor_data_id):
+                    rows.append((sensor_data_id, ts, self.sensor_id, segment.data(offset, length)))
+        rows.sort()
+        return rows
+
+    # Última lectura vigente (mayor ts y luego mayor ID) como (ts, ID, data), o None
+    def latest(self):
+        best = None
+        for segment, end in sorted(self.segments, key=lambda item: item[0].max_ts or 0, reverse=True):
+            if segment.max_ts is None or (best is not None and segment.max_ts < best[0]):
+                continue
+            for offset, kind, sensor_data_id, ts, length in segment.records(len(SEGMENT_MAGIC), end):
+                if (best is None or (ts, sensor_data_id) > best[:2]) and _live(self.overrides, segment.name, offset, kind, sensor_data_id):
+                    best = (ts, sensor_data_id, segment.data(offset, length))
+        return best
+
+    # Registro vigente con ese ID: (segmento, offset, ts, data), o None
+    def find(self, sensor_data_id):
+        for segment, end in self.segments:
+            if segment.min_id is None or not segment.min_id <= sensor_data_id <= segment.max_id:
+                continue
+            for offset, kind, record_id, ts, length in segment.records(len(SEGMENT_MAGIC), end):
+                if record_id == sensor_data_id and _live(self.overrides, segment.name, offset, kind, record_id):
+                    return segment, offset, ts, segment.data(offset, length)
+        return None
+
+class SensorLog:
+    def __init__(self, store, sensor_id):
+        self.store = store
+        self.sensor_id = sensor_id
+        self.directory = os.path.join(store.root, f's{sensor_id}')
+        self.manifest_path = os.path.join(self.directory, 'MANIFEST')
+        self.segments = []
+        self.next_number = 1
+        # ID: (segmento, offset) de la versión vigente, o None si se borró. Se reemplaza al cambiar
+        # (copy-on-write) para que las vistas ya entregadas no cambien
+        self.overrides = {}
+        self._manifest_key = None
+        # Desde qué segmento pueden haber crecido los archivos
+        self._open_from = 0
+        self._append_fd = None
+        self._append_name = None
+        self.lock = threading.Lock()
+
+    def _read_manifest(self):
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None, None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key == self._manifest_key:
+            return key, None
+        with open(self.manifest_path, 'rb') as f:
+            return key, json.loads(f.read())
+
+    # Pone al día la lista de segmentos y las lecturas nuevas; retorna una SensorView
+    def refresh(self):
+        with self.lock:
+            key, manifest = self._read_manifest()
+            if manifest is not None:
+                names = manifest['segments']
+                known = [segment.name for segment in self.segments]
+                if names[:len(known)] != known:
+                    # La compactación o la retención cambiaron segmentos: se vuelve a leer todo
+                    self.segments = []
+                    self.overrides = {}
+                    self._open_from = 0
+                    self._close_append()
+                for name in names[len(self.segments):]:
+                    self.segments.append(Segment(os.path.join(self.directory, name), self.store.index_interval))
+                self.next_number = manifest['next']
+                self._manifest_key = key
+            elif key is None and self.segments:
+                self.segments = []
+                self.overrides = {}
+                self._open_from = 0
+                self._manifest_key = None
+
+            overrides = None
+            for segment in self.segments[self._open_from:]:
+                for kind, sensor_data_id, offset in segment.scan():
+                    if kind == INSERT:
+                        continue
+                    if overrides is None:
+                        overrides = dict(self.overrides)
+                    overrides[sensor_data_id] = (segment.name, offset) if kind == REWRITE else None
+            if overrides is not None:
+                self.overrides = overrides
+            self._open_from = max(len(self.segments) - 1, 0)
+            return SensorView(self.sensor_id, [(segment, segment.size) for segment in self.segments], self.overrides)
+
+    def _write_manifest(self, names, next_number):
+        _write_atomic(self.manifest_path, json.dumps({'segments': names, 'next': next_number}).encode('utf-8'),
+                      self.store.fsync)
+
+    def _close_append(self):
+        if self._append_fd is not None:
+            os.close(self._append_fd)
+            self._append_fd = None
+            self._append_name = None
+
+    # Agrega registros al segmento activo. Debe llamarse con el lock de escritura del store
+    def append(self, records):
+        self.refresh()
+        with self.lock:
+            active = self.segments[-1] if self.segments else None
+            if active is not None and active.torn:
+                # Quedó un registro incompleto de un escritor que se interrumpió
+                os.truncate(active.path, active.size)
+                active.torn = False
+            rotate = active is None or active.size >= self.store.max_segment_bytes
+            if rotate:
+                os.makedirs(self.directory, exist_ok=True)
+                name = '%08d.seg' % self.next_number
+                with open(os.path.join(self.directory, name), 'wb') as f:
+                    f.write(SEGMENT_MAGIC)
+                self._write_manifest([segment.name for segment in self.segments] + [name], self.next_number + 1)
+        if rotate:
+            self.refresh()
+        with self.lock:
+            active = self.segments[-1]
+            if self._append_name != active.name:
+                self._close_append()
+                self._append_fd = os.open(active.path, os.O_WRONLY | os.O_APPEND | getattr(os, 'O_BINARY', 0))
+                self._append_name = active.name
+            os.write(self._append_fd, b''.join(records))
+            if self.store.fsync:
+                os.fsync(self._append_fd)
+        return self.refresh()
+
+    # Reemplaza los segmentos cerrados por una versión compactada. Retorna True si compactó
+    def compact(self):
+        view = self.refresh()
+        sealed = view.segments[:-1]
+        if not sealed:
+            return False
+        small = [segment for segment, _ in sealed if segment.size < self.store.max_segment_bytes // 2]
+        if not any(segment.rewrites or not segment.ts_sorted for segment, _ in sealed) and len(small) < 2:
+            return False
+
+        # Lecturas vigentes de los segmentos cerrados, en orden (ts, ID), escritas como INSERT
+        rows = []
+        for segment, end in sealed:
+            for offset, kind, sensor_data_id, ts, length in segment.records(len(SEGMENT_MAGIC), end):
+                if _live(view.overrides, segment.name, offset, kind, sensor_data_id):
+                    rows.append((ts, sensor_data_id, segment, offset, length))
+        rows.sort(key=lambda row: (row[0], row[1]))
+        outputs = []
+        chunk = []
+        size = len(SEGMENT_MAGIC)
+        for ts, sensor_data_id, segment, offset, length in rows:
+            record = encode_record(INSERT, sensor_data_id, ts, segment.data(offset, length).encode('utf-8'))
+            if chunk and size + len(record) > self.store.max_segment_bytes:
+                outputs.append(self._write_temp(chunk))
+                chunk = []
+                size = len(SEGMENT_MAGIC)
+            chunk.append(record)
+            size += len(record)
+        if chunk:
+            outputs.append(self._write_temp(chunk))
+
+        sealed_names = [segment.name for segment, _ in sealed]
+        with self.store.writer():
+            key, manifest = self._read_manifest()
+            names = manifest['segments'] if manifest is not None else [segment.name for segment in self.segments]
+            if names[:len(sealed_names)] != sealed_names:
+                # La retención cambió los segmentos mientras se compactaba
+                for path in outputs:
+                    os.remove(path)
+                return False
+            number = manifest['next'] if manifest is not None else self.next_number
+            new_names = []
+            for path in outputs:
+                name = '%08d.seg' % number
+                os.replace(path, os.path.join(self.directory, name))
+                new_names.append(name)
+                number += 1
+            self._write_manifest(new_names + names[len(sealed_names):], number)
+            for name in sealed_names:
+                os.remove(os.path.join(self.directory, name))
+        self.refresh()
+        return True
+
+    def _write_temp(self, records):
+        path = os.path.join(self.directory, f'compact-{uuid.uuid4().hex}.tmp')
+        with open(path, 'wb') as f:
+            f.write(SEGMENT_MAGIC)
+            f.write(b''.join(records))
+            if self.store.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        return path
+
+    # Quita los segmentos cuyas lecturas son todas anteriores a cutoff. Debe llamarse con el lock de escritura
+    def drop_before(self, cutoff):
+        self.refresh()
+        with self.lock:
+            expired = [segment for segment in self.segments if segment.max_ts is not None and segment.max_ts < cutoff]
+            if not expired:
+                return []
+            names = [segment.name for segment in self.segments if segment not in expired]
+            self._write_manifest(names, self.next_number)
+            self._close_append()
+            for segment in expired:
+                os.remove(segment.path)
+        self.refresh()
+        return [f's{self.sensor_id}/{segment.name}' for segment in expired]
+
+    # Borra segmentos completos desde el más antiguo hasta sumar limit registros (al menos uno). Cuando no
+    # quedan segmentos se borra el directorio del sensor. Retorna los registros borrados (0 si no había nada).
+    # Debe llamarse con el lock de escritura
+    def purge(self, limit):
+        self.refresh()
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                return 0
+            removed = []
+            count = 0
+            for segment in self.segments:
+                if removed and count + segment.count > limit:
+                    break
+                removed.append(segment)
+                count += segment.count
+            remaining = [segment.name for segment in self.segments if segment not in removed]
+            self._close_append()
+            if remaining:
+                self._write_manifest(remaining, self.next_number)
+                for segment in removed:
+                    os.remove(segment.path)
+            else:
+                shutil.rmtree(self.directory, ignore_errors=True)
+        self.refresh()
+        return count
+
+class SegmentSnapshot:
+    def __init__(self, store):
+        self.store = store
+        self.views = {}
+
+    def view(self, sensor_id):
+        if sensor_id not in self.views:
+            self.views[sensor_id] = self.store.view(sensor_id)
+        return self.views[sensor_id]
+
+    def close(self):
+        self.views = {}
+
+class SegmentStore:
+    name = 'segments'
+
+    def __init__(self, root, max_segment_bytes=8 * 1024 * 1024, index_interval=64, fsync=False):
+        self.root = root
+        self.max_segment_bytes = max_segment_bytes
+        self.index_interval = index_interval
+        self.fsync = fsync
+        os.makedirs(root, exist_ok=True)
+        sequence_path = os.path.join(root, 'sequence')
+        if not os.path.exists(sequence_path):
+            _write_atomic(sequence_path, SEQUENCE.pack(0, 0), fsync)
+        self._open()
+
+    # Los archivos se abren por proceso: flock se comparte entre los procesos que heredan el mismo archivo
+    # abierto, así que después de un fork (gunicorn con preload) hay que abrirlos de nuevo
+    def _open(self):
+        self.pid = os.getpid()
+        self._sequence = open(os.path.join(self.root, 'sequence'), 'r+b')
+        self._sequence_lock = threading.Lock()
+        self._lock_file = open(os.path.join(self.root, 'lock'), 'a+b')
+        self._write_lock = threading.Lock()
+        self._logs = {}
+        self._logs_lock = threading.Lock()
+        self._compaction_lock = threading.Lock()
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            self._open()
+
+    def _read_sequence(self):
+        self._check_pid()
+        with self._sequence_lock:
+            self._sequence.seek(0)
+            return SEQUENCE.unpack(self._sequence.read(SEQUENCE.size))
+
+    def _write_sequence(self, allocated, written):
+        with self._sequence_lock:
+            self._sequence.seek(0)
+            self._sequence.write(SEQUENCE.pack(allocated, written))
+            self._sequence.flush()
+            if self.fsync:
+                os.fsync(self._sequence.fileno())
+
+    # Lock de escritura entre hilos y entre procesos
+    @contextmanager
+    def writer(self):
+        self._check_pid()
+        with self._write_lock:
+            if fcntl is not None:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                allocated, written = self._read_sequence()
+                if allocated != written:
+                    # Un escritor anterior se interrumpió; sus IDs quedan como hueco
+                    self._write_sequence(allocated, allocated)
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _log(self, sensor_id):
+        self._check_pid()
+        with self._logs_lock:
+            log = self._logs.get(sensor_id)
+            if log is None:
+                log = self._logs[sensor_id] = SensorLog(self, sensor_id)
+            return log
+
+    def view(self, sensor_id):
+        return self._log(sensor_id).refresh()
+
+    def _views(self, sensor_ids, snapshot=None):
+        return [snapshot.view(sensor_id) if snapshot is not None else self.view(sensor_id) for sensor_id in sensor_ids]
+
+    def _all_sensor_ids(self):
+        sensor_ids = []
+        for name in os.listdir(self.root):
+            match = _SENSOR_DIR.match(name)
+            if match:
+                sensor_ids.append(int(match.group(1)))
+        return sorted(sensor_ids)
+
+    def insert(self, conn, rows, ts, after_commit=None):
+        by_sensor = {}
+        with self.writer():
+            allocated, _ = self._read_sequence()
+            ids = list(range(allocated + 1, allocated + 1 + len(rows)))
+            self._write_sequence(allocated + len(rows), allocated)
+            for sensor_data_id, (sensor_id, data_json) in zip(ids, rows):
+                by_sensor.setdefault(sensor_id, []).append(encode_record(INSERT, sensor_data_id, ts, data_json.encode('utf-8')))
+            for sensor_id, records in by_sensor.items():
+                self._log(sensor_id).append(records)
+            self._write_sequence(allocated + len(rows), allocated + len(rows))
+            if after_commit is not None:
+                after_commit(ids)
+        return ids
+
+    # Los filtros sobre data (ver data_filters.py) se evalúan en Python: aquí no hay campos frecuentes indexados
+    def iter_range(self, conn, sensor_ids, from_ts, to_ts, after=None, limit=None, company_id=None, chunk_size=500,
+                   snapshot=None, filters=None):
+        views = self._views(sensor_ids, snapshot)
+        rows = heapq.merge(*(view.iter_range(from_ts, to_ts, after) for view in views), key=lambda row: (row[0], row[1]))
+        if filters:
+            rows = (row for row in rows if data_filters.matches(row[3], filters))
+        for i, (ts, sensor_data_id, sensor_id, data) in enumerate(rows):
+            if limit is not None and i >= limit:
+                return
+            yield _row(sensor_id, sensor_data_id, ts, data)
+
+    def count_range(self, conn, sensor_ids, from_ts, to_ts, company_id=None, snapshot=None):
+        return sum(1 for view in self._views(sensor_ids, snapshot) for _ in view.iter_range(from_ts, to_ts, with_data=False))
+
+    def iter_field_values(self, conn, sensor_ids, from_ts, to_ts, field, company_id=None, chunk_size=500,
+                          snapshot=None):
+        for row in self.iter_range(conn, sensor_ids, from_ts, to_ts, snapshot=snapshot):
+            try:
+                data = json.loads(row['data'])
+            except ValueError:
+                data = None
+            value = data.get(field) if isinstance(data, dict) else None
+            yield value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+    def fields_in_range(self, conn, sensor_ids, from_ts, to_ts, snapshot=None):
+        fields = set()
+        for row in self.iter_range(conn, sensor_ids, from_ts, to_ts, snapshot=snapshot):
+            for field, value in _numeric_fields(row['data']):
+                fields.add(field)
+        return sorted(fields)
+
+    def iter_after_id(self, conn, sensor_ids, after_id, company_id=None, chunk_size=500):
+        if sensor_ids is None:
+            sensor_ids = self._all_sensor_ids()
+        rows = heapq.merge(*(view.after_id(after_id) for view in self._views(sensor_ids)))
+        for sensor_data_id, ts, sensor_id, data in rows:
+            yield _row(sensor_id, sensor_data_id, ts, data)
+
+    def last_id(self, conn):
+        return self._read_sequence()[1]
+
+    def latest_per_sensor(self, conn, sensor_ids=None):
+        if sensor_ids is None:
+            cur = conn.cursor()
+            cur.execute('SELECT sensor_id FROM Sensor')
+            sensor_ids = [row[0] for row in cur.fetchall()]
+        latest = {}
+        for view in self._views(sensor_ids):
+            found = view.latest()
+            if found is not None:
+                latest[view.sensor_id] = _row(view.sensor_id, found[1], found[0], found[2])
+        return latest
+
+    def _candidate_sensors(self, conn, company_id):
+        if company_id is None:
+            return self._all_sensor_ids()
+        cur = conn.cursor()
+        cur.execute('SELECT sensor_id FROM Sensor WHERE company_id = ?', (company_id,))
+        return [row[0] for row in cur.fetchall()]
+
+    # Busca el ID entre los sensores candidatos; retorna (vista, (segmento, offset, ts, data)) o (None, None)
+    def _find(self, conn, sensor_data_id, company_id):
+        for sensor_id in self._candidate_sensors(conn, company_id):
+            view = self.view(sensor_id)
+            found = view.find(sensor_data_id)
+            if found is not None:
+                return view, found
+        return None, None
+
+    def find(self, conn, sensor_data_id, company_id=None):
+        view, found = self._find(conn, sensor_data_id, company_id)
+        if found is None:
+            return None
+        _, _, ts, data = found
+        return _row(view.sensor_id, sensor_data_id, ts, data)
+
+    def update(self, conn, sensor_data_id, company_id, data_json, ts):
+        with self.writer():
+            row = self.find(conn, sensor_data_id, company_id)
+            if row is not None:
+                self._log(row['sensor_id']).append([encode_record(REWRITE, sensor_data_id, ts, data_json.encode('utf-8'))])
+        return row
+
+    def delete(self, conn, sensor_data_id, company_id):
+        with self.writer():
+            row = self.find(conn, sensor_data_id, company_id)
+            if row is not None:
+                self._log(row['sensor_id']).append([encode_record(DELETE, sensor_data_id, row['ts'], b'')])
+        return row
+
+    # Los agregados se calculan recorriendo las lecturas; no hay rollups precalculados
+    def aggregate(self, conn, sensor_ids, from_ts, to_ts, bucket, fields, source, company_id=None):
+        if source == 'rollup':
+            raise ValueError('No rollup is available with the segments backend')
+        start, end = rollups.aligned_range(from_ts, to_ts, bucket)
+        wanted = set(fields) if fields else None
+        groups = {}
+        for row in self.iter_range(conn, sensor_ids, start, end):
+            bucket_start = row['ts'] // bucket * bucket
+            for field, value in _numeric_fields(row['data']):
+                if wanted is not None and field not in wanted:
+                    continue
+                key = (row['sensor_id'], field, bucket_start)
+                group = groups.get(key)
+                if group is None:
+                    groups[key] = [1, value, value, value, value]
+                else:
+                    group[0] += 1
+                    group[1] += value
+                    group[2] = min(group[2], value)
+                    group[3] = max(group[3], value)
+                    # Las filas llegan en orden (ts, ID), así que la última es la más reciente
+                    group[4] = value
+        rows = [{'sensor_id': sensor_id, 'bucket': bucket_start, 'field': field, 'count': count,
+                 'min': low, 'max': high, 'avg': total * 1.0 / count, 'last': last}
+                for (sensor_id, field, bucket_start), (count, total, low, high, last) in sorted(groups.items())]
+        return rows, 'raw'
+
+    def open_snapshot(self, conn):
+        return SegmentSnapshot(self)
+
+    # Borra los segmentos vencidos según la retención de la compañía de cada sensor (ver
+    # sensor_data_store.apply_retention). Retorna los segmentos borrados
+    def apply_retention(self, conn, global_days, now=None):
+        now = int(time.time()) if now is None else now
+        cur = conn.cursor()
+        cur.execute('SELECT company_id, retention_days FROM Retention_Policy')
+        policies = {row[0]: row[1] for row in cur.fetchall()}
+        cur.execute('SELECT sensor_id, company_id FROM Sensor')
+        companies = {row[0]: row[1] for row in cur.fetchall()}
+        dropped = []
+        for sensor_id in self._all_sensor_ids():
+            days = policies.get(companies.get(sensor_id), global_days)
+            if not days:
+                continue
+            with self.writer():
+                dropped.extend(self._log(sensor_id).drop_before(now - days * 86400))
+        return dropped
+
+    # Ver sensor_data_store.SqliteBackend.purge_sensors
+    def purge_sensors(self, conn, sensor_ids, limit):
+        removed = 0
+        with self.writer():
+            for sensor_id in sensor_ids:
+                removed += self._log(sensor_id).purge(limit - removed)
+                if removed >= limit:
+                    break
+        return removed
+
+    def reading_sensor_ids(self, conn):
+        return self._all_sensor_ids()
+
+    def partitions(self, conn):
+        segments = []
+        for sensor_id in self._all_sensor_ids():
+            for segment, end in self.view(sensor_id).segments:
+                segments.append({'name': f's{sensor_id}/{segment.name}', 'sensor_id': sensor_id, 'bytes': end,
+                                 'records': segment.count, 'start_ts': segment.min_ts, 'end_ts': segment.max_ts,
+                                 'min_id': segment.min_id, 'max_id': segment.max_id, 'sorted': segment.ts_sorted})
+        return segments
+
+    # Compacta los sensores que lo necesitan. Con varios procesos solo uno compacta a la vez.
+    # Retorna los sensores compactados
+    def compact(self):
+        if not self._compaction_lock.acquire(blocking=False):
+            return []
+        lock_file = open(os.path.join(self.root, 'compaction.lock'), 'a+b')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return []
+            return [sensor_id for sensor_id in self._all_sensor_ids() if self._log(sensor_id).compact()]
+        finally:
+            lock_file.close()
+            self._compaction_lock.release()
+
+# Campos numéricos de primer nivel de un JSON de data: [(campo, valor)]
+def _numeric_fields(data_json):
+    try:
+        data = json.loads(data_json)
+    except ValueError:
+        return []
+    if not isinstance(data, dict):
+        return []
+    return [(field, value) for field, value in data.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)]
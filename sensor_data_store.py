@@ -0,0 +1,638 @@
+import calendar
+import json
+import threading
+import time
+import data_filters
+import rollups
+
+# Almacenamiento de Sensor_Data particionado por tiempo.
+# Cada partición es una tabla Sensor_Data_<periodo> (o Sensor_Data_c<compañía>_<periodo> para las compañías
+# con política de retención propia) con las mismas columnas que tenía Sensor_Data.
+# Sensor_Data_Partition registra el rango de tiempo y de IDs de cada partición, y Sensor_Data_Sequence
+# entrega los IDs, que siguen siendo únicos entre todas las particiones.
+
+CATALOG = 'Sensor_Data_Partition'
+GRANULARITIES = ('day', 'month')
+
+# SQLite no acepta más de 500 SELECT en un UNION ALL
+MAX_UNION_PARTITIONS = 400
+
+# Columnas de una lectura; las columnas generadas de los campos frecuentes (ver data_filters.py) no se leen
+COLUMNS = 'ID, sensor_id, data, ts, time'
+
+def create_catalog(cur):
+    cur.execute(f'''
+    CREATE TABLE IF NOT EXISTS {CATALOG}(
+        name TEXT PRIMARY KEY,
+        company_id INTEGER,
+        start_ts INTEGER NOT NULL,
+        end_ts INTEGER NOT NULL,
+        min_id INTEGER,
+        max_id INTEGER,
+        created_at INTEGER NOT NULL
+    )
+    ''')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_partition_range ON {CATALOG}(start_ts, end_ts)')
+    cur.execute('CREATE TABLE IF NOT EXISTS Sensor_Data_Sequence(seq INTEGER NOT NULL)')
+    # Días de retención por compañía; las demás usan la retención global de la configuración
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS Retention_Policy(
+        company_id INTEGER PRIMARY KEY,
+        retention_days INTEGER NOT NULL
+    )
+    ''')
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+# Inicio, fin y sufijo del período (día o mes UTC) que contiene ts
+def period_bounds(ts, granularity):
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'Invalid partition granularity: {granularity}')
+    t = time.gmtime(ts)
+    if granularity == 'day':
+        start = calendar.timegm((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0))
+        return start, start + 86400 - 1, time.strftime('%Y%m%d', t)
+    start = calendar.timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0))
+    year, month = (t.tm_year + 1, 1) if t.tm_mon == 12 else (t.tm_year, t.tm_mon + 1)
+    end = calendar.timegm((year, month, 1, 0, 0, 0)) - 1
+    return start, end, time.strftime('%Y%m', t)
+
+def _create_partition_table(cur, name):
+    cur.execute(f'''
+    CREATE TABLE IF NOT EXISTS {_quote(name)}(
+        ID INTEGER PRIMARY KEY NOT NULL,
+        sensor_id INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        time TEXT GENERATED ALWAYS AS (datetime(ts, 'unixepoch')) VIRTUAL
+    )
+    ''')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS {_quote("idx_" + name + "_sensor_ts")} ON {_quote(name)}(sensor_id, ts)')
+    for path in data_filters.hot_paths(cur):
+        _add_hot_column(cur, name, path)
+
+def _hot_index(name, column):
+    return 'idx_' + name + '_' + column
+
+def _partition_hot_columns(cur, name):
+    cur.execute('SELECT name FROM pragma_table_xinfo(?)', (name,))
+    return {row[0] for row in cur.fetchall() if row[0].startswith(data_filters.HOT_COLUMN_PREFIX)}
+
+# Columna generada VIRTUAL con el valor de la ruta (no ocupa espacio en la tabla) y su índice parcial.
+# El índice incluye ts para descartar las lecturas fuera del rango sin leer la fila
+def _add_hot_column(cur, name, path):
+    column = data_filters.column_name(path)
+    if column not in _partition_hot_columns(cur, name):
+        cur.execute(f'ALTER TABLE {_quote(name)} ADD COLUMN {_quote(column)} '
+                    f'GENERATED ALWAYS AS ({data_filters.extract_sql(path)}) VIRTUAL')
+    cur.execute(f'CREATE INDEX IF NOT EXISTS {_quote(_hot_index(name, column))} ON {_quote(name)}'
+                f'(sensor_id, {_quote(column)}, ts) WHERE {_quote(column)} IS NOT NULL')
+
+# Deja en cada partición las columnas de los campos frecuentes declarados, agregando y quitando las que
+# corresponda. Retorna (columnas agregadas, columnas quitadas). Debe llamarse dentro de una transacción de escritura
+def sync_hot_columns(cur):
+    wanted = data_filters.hot_columns(cur)
+    added, dropped = set(), set()
+    for partition in all_partitions(cur):
+        name = partition['name']
+        existing = _partition_hot_columns(cur, name)
+        for path, column in wanted.items():
+            if column not in existing:
+                _add_hot_column(cur, name, path)
+                added.add(column)
+        for column in existing - set(wanted.values()):
+            cur.execute(f'DROP INDEX IF EXISTS {_quote(_hot_index(name, column))}')
+            cur.execute(f'ALTER TABLE {_quote(name)} DROP COLUMN {_quote(column)}')
+            dropped.add(column)
+    return sorted(added), sorted(dropped)
+
+# Retorna la partición que debe guardar una lectura con tiempo ts, creándola si no existe.
+# company_id None indica la partición compartida. Debe llamarse dentro de una transacción de escritura
+def ensure_partition(cur, ts, company_id, granularity):
+    cur.execute(f'SELECT name FROM {CATALOG} WHERE company_id IS ? AND start_ts <= ? AND end_ts >= ?',
+                (company_id, ts, ts))
+    row = cur.fetchone()
+    if row:
+        return row[0]
+
+    start, end, suffix = period_bounds(ts, granularity)
+    # Si cambió la granularidad puede haber particiones vecinas que se traslapan; se recorta el rango
+    cur.execute(f'SELECT MAX(end_ts) FROM {CATALOG} WHERE company_id IS ? AND end_ts < ? AND end_ts >= ?',
+                (company_id, ts, start))
+    previous_end = cur.fetchone()[0]
+    cur.execute(f'SELECT MIN(start_ts) FROM {CATALOG} WHERE company_id IS ? AND start_ts > ? AND start_ts <= ?',
+                (company_id, ts, end))
+    next_start = cur.fetchone()[0]
+    clipped = previous_end is not None or next_start is not None
+    if previous_end is not None:
+        start = previous_end + 1
+    if next_start is not None:
+        end = next_start - 1
+
+    name = 'Sensor_Data_' + (f'c{company_id}_' if company_id is not None else '') + suffix
+    if clipped:
+        name += f'_{start}'
+    _create_partition_table(cur, name)
+    cur.execute(f'INSERT INTO {CATALOG}(name, company_id, start_ts, end_ts, created_at) VALUES(?, ?, ?, ?, ?)',
+                (name, company_id, start, end, int(time.time())))
+    return name
+
+def _note_ids(cur, name, first_id, last_id):
+    cur.execute(f'''
+    UPDATE {CATALOG}
+    SET min_id = MIN(COALESCE(min_id, ?), ?), max_id = MAX(COALESCE(max_id, ?), ?)
+    WHERE name = ?
+    ''', (first_id, first_id, last_id, last_id, name))
+
+# Reserva n IDs consecutivos y retorna el primero
+def allocate_ids(cur, n):
+    cur.execute('UPDATE Sensor_Data_Sequence SET seq = seq + ?', (n,))
+    cur.execute('SELECT seq FROM Sensor_Data_Sequence')
+    return cur.fetchone()[0] - n + 1
+
+# Compañías con partición propia de los sensores dados: {sensor_id: company_id}
+def _dedicated_owners(cur, sensor_ids):
+    cur.execute('SELECT EXISTS(SELECT 1 FROM Retention_Policy)')
+    if not cur.fetchone()[0]:
+        return {}
+    owners = {}
+    sensor_ids = list(sensor_ids)
+    for i in range(0, len(sensor_ids), 500):
+        chunk = sensor_ids[i:i + 500]
+        cur.execute('''
+        SELECT s.sensor_id, r.company_id FROM Sensor s
+        JOIN Retention_Policy r ON r.company_id = s.company_id
+        WHERE s.sensor_id IN ({})
+        '''.format(','.join(['?'] * len(chunk))), chunk)
+        owners.update((row[0], row[1]) for row in cur.fetchall())
+    return owners
+
+# Inserta las lecturas (sensor_id, data_json) con tiempo ts y actualiza los rollups.
+# Retorna los IDs asignados en el mismo orden. Debe llamarse dentro de una transacción de escritura
+def insert_rows(cur, rows, ts, granularity):
+    first_id = allocate_ids(cur, len(rows))
+    owners = _dedicated_owners(cur, {sensor_id for sensor_id, _ in rows})
+
+    by_partition = {}
+    for offset, (sensor_id, data_json) in enumerate(rows):
+        by_partition.setdefault(owners.get(sensor_id), []).append((first_id + offset, sensor_id, data_json, ts))
+
+    for company_id, values in by_partition.items():
+        name = ensure_partition(cur, ts, company_id, granularity)
+        cur.executemany(f'INSERT INTO {_quote(name)}(ID, sensor_id, data, ts) VALUES(?, ?, ?, ?)', values)
+        low, high = values[0][0], values[-1][0]
+        _note_ids(cur, name, low, high)
+        # Todos los IDs entre low y high de esta partición son de este lote
+        rollups.add_to_rollups(cur, low, high, _quote(name))
+
+    return list(range(first_id, first_id + len(rows)))
+
+def all_partitions(cur):
+    cur.execute(f'SELECT * FROM {CATALOG} ORDER BY start_ts, name')
+    return cur.fetchall()
+
+# Particiones que se traslapan con [from_ts, to_ts], ordenadas por tiempo.
+# Con company_id se omiten las particiones propias de otras compañías
+def partitions_for_range(cur, from_ts, to_ts, company_id=None):
+    query = f'SELECT * FROM {CATALOG} WHERE start_ts <= ? AND end_ts >= ?'
+    params = [to_ts, from_ts]
+    if company_id is not None:
+        query += ' AND (company_id IS NULL OR company_id = ?)'
+        params.append(company_id)
+    cur.execute(query + ' ORDER BY start_ts, name', params)
+    return cur.fetchall()
+
+def tables_for_range(cur, from_ts, to_ts, company_id=None):
+    return [_quote(row['name']) for row in partitions_for_range(cur, from_ts, to_ts, company_id)]
+
+# Agrupa particiones ordenadas cuyos rangos de tiempo se traslapan (compartida y propias del mismo período).
+# Los grupos quedan en orden de tiempo y no se traslapan entre sí
+def _overlap_groups(partitions, start='start_ts', end='end_ts'):
+    groups = []
+    group_end = None
+    for partition in partitions:
+        if groups and partition[start] <= group_end:
+            groups[-1].append(partition)
+            group_end = max(group_end, partition[end])
+        else:
+            groups.append([partition])
+            group_end = partition[end]
+    return groups
+
+# Recorre las lecturas de los sensores en [from_ts, to_ts] ordenadas por (ts, ID), partición por partición.
+# after es la posición (ts, ID) desde la que se continúa; chunk_size controla cuántas filas se leen por vez.
+# columns es la lista de columnas a leer (debe incluir ts e ID) y column_params sus parámetros.
+# filters son predicados de data_filters; los que son sobre campos frecuentes usan la columna generada y
+# el primero que puede usar su índice se fuerza con INDEXED BY (el planificador preferiría (sensor_id, ts))
+def iter_range(conn, sensor_ids, from_ts, to_ts, after=None, limit=None, company_id=None, chunk_size=500,
+               columns=COLUMNS, column_params=(), filters=None):
+    partitions = partitions_for_range(conn.cursor(), from_ts, to_ts, company_id)
+    conditions, condition_params, hot_index = '', [], None
+    if filters:
+        hot = data_filters.hot_columns(conn.cursor())
+        for predicate in filters:
+            column = hot.get(predicate.path)
+            condition, params = data_filters.sql_condition(predicate, _quote(column) if column else None)
+            conditions += ' AND ' + condition
+            condition_params.extend(params)
+            if column and hot_index is None and predicate.uses_index():
+                hot_index = column
+    remaining = limit
+    for group in _overlap_groups(partitions):
+        if remaining is not None and remaining <= 0:
+            return
+        parts = []
+        params = []
+        for partition in group:
+            where = 'ts BETWEEN ? AND ? AND sensor_id IN ({})'.format(','.join(['?'] * len(sensor_ids)))
+            params.extend(column_params)
+            params.extend([from_ts, to_ts])
+            params.extend(sensor_ids)
+            if after is not None:
+                where += ' AND (ts, ID) > (?, ?)'
+                params.extend(after)
+            where += conditions
+            params.extend(condition_params)
+            source = _quote(partition['name'])
+            if hot_index is not None:
+                source += ' INDEXED BY ' + _quote(_hot_index(partition['name'], hot_index))
+            parts.append(f'SELECT {columns} FROM {source} WHERE {where}')
+        query = 'SELECT * FROM ({}) ORDER BY ts, ID'.format(' UNION ALL '.join(parts))
+        if remaining is not None:
+            query += ' LIMIT ?'
+            params.append(remaining)
+
+        cur = conn.cursor()
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+            if remaining is not None:
+                remaining -= len(rows)
+
+# Recorre las lecturas de los sensores con ID mayor que after_id, ordenadas por ID.
+# Los IDs se asignan en orden de commit, así que sirve para continuar desde la última lectura vista.
+# sensor_ids None recorre las lecturas de todos los sensores
+def iter_after_id(conn, sensor_ids, after_id, company_id=None, chunk_size=500):
+    query = f'SELECT * FROM {CATALOG} WHERE max_id > ?'
+    params = [after_id]
+    if company_id is not None:
+        query += ' AND (company_id IS NULL OR company_id = ?)'
+        params.append(company_id)
+    partitions = conn.execute(query + ' ORDER BY min_id', params).fetchall()
+
+    for group in _overlap_groups(partitions, 'min_id', 'max_id'):
+        parts = []
+        params = []
+        for partition in group:
+            if sensor_ids is None:
+                parts.append('SELECT {} FROM {} WHERE ID > ?'.format(COLUMNS, _quote(partition['name'])))
+                params.append(after_id)
+                continue
+            parts.append('SELECT {} FROM {} WHERE ID > ? AND sensor_id IN ({})'.format(
+                         COLUMNS, _quote(partition['name']), ','.join(['?'] * len(sensor_ids))))
+            params.append(after_id)
+            params.extend(sensor_ids)
+        cur = conn.cursor()
+        cur.execute('SELECT * FROM ({}) ORDER BY ID'.format(' UNION ALL '.join(parts)), params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+
+# Último ID entregado por la secuencia (0 si todavía no hay lecturas)
+def last_id(cur):
+    cur.execute('SELECT seq FROM Sensor_Data_Sequence')
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+# Última lectura (mayor ts y, si empatan, mayor ID) de cada sensor: {sensor_id: fila}. Sin sensor_ids considera
+# todos los sensores de la tabla Sensor. Recorre los grupos de particiones del más reciente al más antiguo y se
+# detiene cuando todos tienen lectura; en cada partición cada sensor es una búsqueda en el índice (sensor_id, ts)
+def latest_per_sensor(cur, sensor_ids=None):
+    if sensor_ids is None:
+        cur.execute('SELECT sensor_id FROM Sensor')
+        sensor_ids = [row[0] for row in cur.fetchall()]
+    pending = set(sensor_ids)
+    latest = {}
+    for group in reversed(_overlap_groups(all_partitions(cur))):
+        if not pending:
+            break
+        ids = json.dumps(sorted(pending))
+        for partition in group:
+            name = _quote(partition['name'])
+            cur.execute(f'''
+            SELECT d.ID, d.sensor_id, d.data, d.ts, d.time FROM json_each(?) AS s
+            JOIN {name} AS d ON d.ID = (SELECT ID FROM {name} WHERE sensor_id = s.value ORDER BY ts DESC, ID DESC LIMIT 1)
+            ''', (ids,))
+            for row in cur.fetchall():
+                current = latest.get(row['sensor_id'])
+                if current is None or (row['ts'], row['ID']) > (current['ts'], current['ID']):
+                    latest[row['sensor_id']] = row
+        pending.difference_update(latest)
+    return latest
+
+# Cantidad de lecturas de los sensores en [from_ts, to_ts]
+def count_range(cur, sensor_ids, from_ts, to_ts, company_id=None):
+    total = 0
+    for partition in partitions_for_range(cur, from_ts, to_ts, company_id):
+        cur.execute('SELECT COUNT(*) FROM {} WHERE ts BETWEEN ? AND ? AND sensor_id IN ({})'.format(
+                    _quote(partition['name']), ','.join(['?'] * len(sensor_ids))),
+                    [from_ts, to_ts] + list(sensor_ids))
+        total += cur.fetchone()[0]
+    return total
+
+# Busca una lectura por ID. Retorna (partición, fila) o (None, None).
+# Con company_id solo encuentra lecturas de sensores de esa compañía
+def find(cur, sensor_data_id, company_id=None):
+    cur.execute(f'SELECT name FROM {CATALOG} WHERE min_id <= ? AND max_id >= ? ORDER BY start_ts DESC',
+                (sensor_data_id, sensor_data_id))
+    for (name,) in cur.fetchall():
+        query = f'SELECT {COLUMNS} FROM {_quote(name)} AS d WHERE ID = ?'
+        params = [sensor_data_id]
+        if company_id is not None:
+            query += ' AND EXISTS (SELECT 1 FROM Sensor WHERE Sensor.sensor_id = d.sensor_id AND Sensor.company_id = ?)'
+            params.append(company_id)
+        cur.execute(query, params)
+        row = cur.fetchone()
+        if row:
+            return name, row
+    return None, None
+
+def _refresh_rollups(cur, sensor_id, ts_values):
+    rollups.refresh_rollups(cur, sensor_id, ts_values, lambda start, end: tables_for_range(cur, start, end))
+
+# Actualiza data y ts de una lectura encontrada con find(). Si el nuevo ts cae en otra partición la fila se mueve,
+# conservando su ID. Debe llamarse dentro de una transacción de escritura
+def update(cur, name, row, data_json, ts, granularity):
+    owners = _dedicated_owners(cur, [row['sensor_id']])
+    target = ensure_partition(cur, ts, owners.get(row['sensor_id']), granularity)
+    if target == name:
+        cur.execute(f'UPDATE {_quote(name)} SET data = ?, ts = ? WHERE ID = ?', (data_json, ts, row['ID']))
+    else:
+        cur.execute(f'DELETE FROM {_quote(name)} WHERE ID = ?', (row['ID'],))
+        cur.execute(f'INSERT INTO {_quote(target)}(ID, sensor_id, data, ts) VALUES(?, ?, ?, ?)',
+                    (row['ID'], row['sensor_id'], data_json, ts))
+        _note_ids(cur, target, row['ID'], row['ID'])
+    _refresh_rollups(cur, row['sensor_id'], {row['ts'], ts})
+
+def delete(cur, name, row):
+    cur.execute(f'DELETE FROM {_quote(name)} WHERE ID = ?', (row['ID'],))
+    _refresh_rollups(cur, row['sensor_id'], {row['ts']})
+
+# Borra hasta limit lecturas (y luego rollups) de los sensores. Retorna cuántas filas borró; 0 indica que
+# ya no queda nada de esos sensores. Debe llamarse dentro de una transacción de escritura
+def purge_sensor_rows(cur, sensor_ids, limit):
+    placeholders = ','.join(['?'] * len(sensor_ids))
+    deleted = 0
+    for partition in all_partitions(cur):
+        if deleted >= limit:
+            return deleted
+        name = _quote(partition['name'])
+        # Cada partición tiene índice por (sensor_id, ts), así que el borrado no recorre la tabla
+        cur.execute(f'DELETE FROM {name} WHERE ID IN (SELECT ID FROM {name} WHERE sensor_id IN ({placeholders}) LIMIT ?)',
+                    list(sensor_ids) + [limit - deleted])
+        deleted += cur.rowcount
+    if deleted < limit:
+        cur.execute(f'DELETE FROM Sensor_Data_Rollup WHERE (sensor_id, bucket_size, bucket_start, field) IN '
+                    f'(SELECT sensor_id, bucket_size, bucket_start, field FROM Sensor_Data_Rollup '
+                    f'WHERE sensor_id IN ({placeholders}) LIMIT ?)',
+                    list(sensor_ids) + [limit - deleted])
+        deleted += cur.rowcount
+    return deleted
+
+# sensor_id distintos que tienen lecturas en alguna partición
+def reading_sensor_ids(cur):
+    sensor_ids = set()
+    for partition in all_partitions(cur):
+        cur.execute(f'SELECT DISTINCT sensor_id FROM {_quote(partition["name"])}')
+        sensor_ids.update(row[0] for row in cur.fetchall())
+    return sorted(sensor_ids)
+
+# Borra una partición completa y los rollups de sus sensores en ese rango de tiempo
+def drop_partition(cur, partition):
+    name = partition['name']
+    cur.execute(f'SELECT DISTINCT sensor_id FROM {_quote(name)}')
+    sensor_ids = [row[0] for row in cur.fetchall()]
+    for i in range(0, len(sensor_ids), 500):
+        chunk = sensor_ids[i:i + 500]
+        cur.execute('DELETE FROM Sensor_Data_Rollup WHERE sensor_id IN ({}) AND bucket_start BETWEEN ? AND ?'.format(','.join(['?'] * len(chunk))),
+                    chunk + [partition['start_ts'], partition['end_ts']])
+    cur.execute(f'DROP TABLE IF EXISTS {_quote(name)}')
+    cur.execute(f'DELETE FROM {CATALOG} WHERE name = ?', (name,))
+
+# Borra las particiones completas más antiguas que la retención. global_days se aplica a las particiones
+# compartidas y a las de compañías sin política propia; 0 o None desactiva la retención global.
+# Retorna los nombres de las particiones borradas
+def apply_retention(conn, global_days, now=None):
+    now = int(time.time()) if now is None else now
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        cur.execute('SELECT company_id, retention_days FROM Retention_Policy')
+        policies = {row[0]: row[1] for row in cur.fetchall()}
+        dropped = []
+        for partition in all_partitions(cur):
+            days = policies.get(partition['company_id'], global_days) if partition['company_id'] is not None else global_days
+            if not days or partition['end_ts'] >= now - days * 86400:
+                continue
+            drop_partition(cur, partition)
+            dropped.append(partition['name'])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return dropped
+
+# Mueve las filas de la tabla Sensor_Data sin particionar a particiones compartidas
+def partition_legacy_table(cur, granularity):
+    cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'Sensor_Data'")
+    row = cur.fetchone()
+    last_seq = row[0] if row else 0
+    cur.execute('SELECT COALESCE(MAX(ID), 0) FROM Sensor_Data')
+    cur.execute('INSERT INTO Sensor_Data_Sequence(seq) VALUES(?)', (max(last_seq, cur.fetchone()[0]),))
+
+    cur.execute('SELECT MIN(ts), MAX(ts) FROM Sensor_Data')
+    low, high = cur.fetchone()
+    ts = low
+    while ts is not None and ts <= high:
+        start, end, _ = period_bounds(ts, granularity)
+        cur.execute('SELECT MIN(ID), MAX(ID) FROM Sensor_Data WHERE ts BETWEEN ? AND ?', (start, end))
+        first_id, last_id = cur.fetchone()
+        if first_id is not None:
+            name = ensure_partition(cur, ts, None, granularity)
+            cur.execute(f'INSERT INTO {_quote(name)}(ID, sensor_id, data, ts) SELECT ID, sensor_id, data, ts FROM Sensor_Data WHERE ts BETWEEN ? AND ?',
+                        (start, end))
+            _note_ids(cur, name, first_id, last_id)
+        # Siguiente período con datos
+        cur.execute('SELECT MIN(ts) FROM Sensor_Data WHERE ts > ?', (end,))
+        ts = cur.fetchone()[0]
+    cur.execute('DROP TABLE Sensor_Data')
+
+# BACKEND
+
+# Interfaz de almacenamiento de lecturas que usan las rutas de Sensor_Data. SqliteBackend es la implementación
+# por defecto, sobre las particiones de este módulo; segment_store.SegmentStore es la alternativa en archivos.
+# Las filas que se retornan tienen ID, sensor_id, data (el JSON guardado), ts y time.
+# snapshot es lo que retorna open_snapshot(): las lecturas que lo reciben ven el mismo estado de los datos
+class SqliteBackend:
+    name = 'sqlite'
+
+    def __init__(self, granularity):
+        self.granularity = granularity
+        # El commit y after_commit se hacen juntos para que quien recibe los ids los reciba en orden
+        self._commit_lock = threading.Lock()
+
+    # Inserta las lecturas (sensor_id, data_json) con tiempo ts en una transacción y retorna los IDs.
+    # after_commit(ids) se llama justo después del commit, en el mismo orden de los commits
+    def insert(self, conn, rows, ts, after_commit=None):
+        cur = conn.cursor()
+        # BEGIN IMMEDIATE toma el lock de escritura de inmediato, así los ids del lote son consecutivos
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            ids = insert_rows(cur, rows, ts, self.granularity)
+            with self._commit_lock:
+                conn.commit()
+                if after_commit is not None:
+                    after_commit(ids)
+        except Exception:
+            conn.rollback()
+            raise
+        return ids
+
+    def iter_range(self, conn, sensor_ids, from_ts, to_ts, after=None, limit=None, company_id=None, chunk_size=500,
+                   snapshot=None, filters=None):
+        return iter_range(conn, sensor_ids, from_ts, to_ts, after, limit, company_id, chunk_size, filters=filters)
+
+    def count_range(self, conn, sensor_ids, from_ts, to_ts, company_id=None, snapshot=None):
+        return count_range(conn.cursor(), sensor_ids, from_ts, to_ts, company_id)
+
+    # Valor numérico de un campo de primer nivel de data para cada lectura del rango, en orden (ts, ID);
+    # None si la lectura no lo tiene o no es numérico
+    def iter_field_values(self, conn, sensor_ids, from_ts, to_ts, field, company_id=None, chunk_size=500,
+                          snapshot=None):
+        path = '$."' + field + '"'
+        rows = iter_range(conn, sensor_ids, from_ts, to_ts, company_id=company_id, chunk_size=chunk_size,
+                          columns="ts, ID, CASE WHEN json_valid(data) AND json_type(data, ?) IN ('integer', 'real') "
+                                  "THEN json_extract(data, ?) END AS value",
+                          column_params=(path, path))
+        return (row['value'] for row in rows)
+
+    # Campos numéricos que aparecen en las lecturas del rango (según los rollups)
+    def fields_in_range(self, conn, sensor_ids, from_ts, to_ts, snapshot=None):
+        return rollups.fields_in_range(conn.cursor(), sensor_ids, from_ts, to_ts)
+
+    def iter_after_id(self, conn, sensor_ids, after_id, company_id=None, chunk_size=500):
+        return iter_after_id(conn, sensor_ids, after_id, company_id, chunk_size)
+
+    def last_id(self, conn):
+        return last_id(conn.cursor())
+
+    def latest_per_sensor(self, conn, sensor_ids=None):
+        return latest_per_sensor(conn.cursor(), sensor_ids)
+
+    def find(self, conn, sensor_data_id, company_id=None):
+        return find(conn.cursor(), sensor_data_id, company_id)[1]
+
+    # Cambia data y ts de una lectura. Retorna la fila anterior, o None si no existe
+    def update(self, conn, sensor_data_id, company_id, data_json, ts):
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            name, row = find(cur, sensor_data_id, company_id)
+            if row is None:
+                conn.rollback()
+                return None
+            # Si el nuevo tiempo cae en otra partición, la lectura se mueve conservando su ID
+            update(cur, name, row, data_json, ts, self.granularity)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return row
+
+    # Borra una lectura. Retorna la fila borrada, o None si no existe
+    def delete(self, conn, sensor_data_id, company_id):
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            name, row = find(cur, sensor_data_id, company_id)
+            if row is None:
+                conn.rollback()
+                return None
+            delete(cur, name, row)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return row
+
+    # Agregados por bucket (ver rollups.aggregate). source es auto, raw o rollup.
+    # Retorna (filas, 'raw' o 'rollup'); levanta ValueError si la consulta no se puede responder
+    def aggregate(self, conn, sensor_ids, from_ts, to_ts, bucket, fields, source, company_id=None):
+        rollup_size = None if source == 'raw' else rollups.rollup_size_for(bucket)
+        if source == 'rollup' and rollup_size is None:
+            raise ValueError('No rollup is available for this bucket')
+        cur = conn.cursor()
+        # El cálculo desde las lecturas solo lee las particiones del rango
+        raw_sources = []
+        if rollup_size is None:
+            raw_sources = tables_for_range(cur, *rollups.aligned_range(from_ts, to_ts, bucket), company_id)
+            if len(raw_sources) > MAX_UNION_PARTITIONS:
+                raise ValueError('Range covers too many partitions for a raw aggregation')
+        rows = rollups.aggregate(cur, sensor_ids, from_ts, to_ts, bucket, fields, rollup_size, raw_sources) if sensor_ids else []
+        return rows, 'raw' if rollup_size is None else 'rollup'
+
+    # Abre una transacción de lectura: todo lo que se lea con conn hasta close() sale del mismo snapshot
+    def open_snapshot(self, conn):
+        conn.cursor().execute('BEGIN')
+        return _SqliteSnapshot(conn)
+
+    def apply_retention(self, conn, global_days, now=None):
+        return apply_retention(conn, global_days, now)
+
+    # Borra por partes las lecturas de sensores eliminados: cada llamada es una transacción corta con hasta
+    # limit filas, para no bloquear la ingesta. Retorna las filas borradas (0 cuando no queda nada)
+    def purge_sensors(self, conn, sensor_ids, limit):
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            deleted = purge_sensor_rows(cur, sensor_ids, limit)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return deleted
+
+    def reading_sensor_ids(self, conn):
+        return reading_sensor_ids(conn.cursor())
+
+    # Reemplaza los campos frecuentes de una categoría y ajusta las columnas generadas de todas las particiones.
+    # Crear el índice recorre cada partición una vez, así que en bases grandes la llamada tarda.
+    # Retorna (columnas agregadas, columnas quitadas)
+    def set_hot_fields(self, conn, sensor_category, paths):
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            data_filters.set_category_paths(cur, sensor_category, paths)
+            changes = sync_hot_columns(cur)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return changes
+
+    def partitions(self, conn):
+        return [dict(row) for row in all_partitions(conn.cursor())]
+
+class _SqliteSnapshot:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def close(self):
+        self.conn.rollback()
@@ -0,0 +1,98 @@
+import hashlib
+import threading
+import time
+
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+# Tokens de acceso firmados con HMAC-SHA256. El token lleva el scope (admin, company o sensor), la identidad
+# (Username, company_id o sensor_id) y la época de revocación de esa identidad al emitirse, así se valida
+# sin consultar la base. Revocar incrementa la época: los tokens emitidos antes dejan de ser válidos.
+# Las épocas se guardan en Token_Epoch y cada proceso las relee como mucho cada refresh_seconds.
+
+SCOPES = ('admin', 'company', 'sensor')
+SALT = 'iot-access-token'
+
+class InvalidToken(Exception):
+    pass
+
+class AccessTokens:
+    # secret_keys puede ser una lista: se firma con la última y se aceptan todas, para rotar la clave
+    # sin invalidar los tokens vigentes. load_epochs retorna {(scope, identidad en texto): época}
+    def __init__(self, secret_keys, ttl=900, refresh_seconds=5.0, load_epochs=None):
+        self.serializer = URLSafeTimedSerializer(secret_keys, salt=SALT,
+                                                 signer_kwargs={'digest_method': hashlib.sha256})
+        self.ttl = ttl
+        self.refresh_seconds = refresh_seconds
+        self.load_epochs = load_epochs
+        self._epochs = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.verified = 0
+        self.rejected = 0
+
+    def _sync(self):
+        if self.load_epochs is None:
+            return
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < self.refresh_seconds:
+            return
+        epochs = self.load_epochs()
+        with self._lock:
+            self._epochs = epochs
+            self._loaded_at = now
+
+    def epoch(self, scope, subject):
+        self._sync()
+        return self._epochs.get((scope, str(subject)), 0)
+
+    # Registra una época nueva en este proceso; los demás la ven en su siguiente relectura
+    def set_epoch(self, scope, subject, epoch):
+        with self._lock:
+            self._epochs[(scope, str(subject))] = epoch
+
+    def issue(self, scope, subject):
+        if scope not in SCOPES:
+            raise ValueError(f'Invalid token scope: {scope}')
+        token = self.serializer.dumps([scope, subject, self.epoch(scope, subject)])
+        with self._lock:
+            self.issued += 1
+        return token
+
+    # Retorna la identidad del token si es válido para el scope; si no, levanta InvalidToken
+    def verify(self, token, scope):
+        try:
+            payload = self.serializer.loads(token, max_age=self.ttl)
+            if not isinstance(payload, list) or len(payload) != 3:
+                raise BadSignature('Malformed payload')
+            token_scope, subject, epoch = payload
+            if token_scope != scope:
+                raise InvalidToken(f'Token is not valid for {scope} access')
+            if epoch != self.epoch(scope, subject):
+                raise InvalidToken('Token has been revoked')
+        except SignatureExpired:
+            self._reject()
+            raise InvalidToken('Token has expired')
+        except BadSignature:
+            self._reject()
+            raise InvalidToken('Invalid token')
+        except InvalidToken:
+            self._reject()
+            raise
+        with self._lock:
+            self.verified += 1
+        return subject
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ttl': self.ttl,
+                'issued': self.issued,
+                'verified': self.verified,
+                'rejected': self.rejected,
+                'revoked_subjects': len(self._epochs),
+            }
@@ -0,0 +1,414 @@
+import logging
+import os
+import queue
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+import msgpack
+
+from ingest_queue import Pending
+
+# Proceso escritor único para correr varios workers de gunicorn sin competir por el lock de escritura de SQLite.
+# Los workers leen directo de la base, pero las escrituras de lecturas (insertar, editar, borrar, retención y
+# purga de sensores eliminados) se envían por un socket Unix al proceso escritor, que las aplica con una sola
+# conexión. Las inserciones que llegan juntas desde varios workers se escriben en una transacción (group commit).
+#
+# Cada mensaje es un largo de 4 bytes seguido de MessagePack. La petición es [operación, argumentos] y la
+# respuesta {"result": ...} o {"error": "..."}. Cada hilo del worker usa su propia conexión al socket.
+
+FRAME = struct.Struct('<I')
+# Máximo de bytes de un mensaje (un lote de la API con lecturas grandes cabe con holgura)
+MAX_MESSAGE_BYTES = 256 * 1024 * 1024
+OPERATIONS = ('insert', 'update', 'delete', 'retention', 'purge', 'set_hot_fields', 'ping', 'stats')
+
+class WriterError(Exception):
+    pass
+
+# La petición se envió pero no llegó la respuesta: el escritor pudo haberla aplicado, así que no se reintenta
+class WriterReplyLost(WriterError):
+    pass
+
+def _send(sock, message):
+    data = msgpack.packb(message, use_bin_type=True)
+    sock.sendall(FRAME.pack(len(data)) + data)
+
+def _recv_exact(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            return None
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+# Retorna el mensaje recibido, o None si el otro extremo cerró la conexión
+def _recv(sock):
+    header = _recv_exact(sock, FRAME.size)
+    if header is None:
+        return None
+    (size,) = FRAME.unpack(header)
+    if size > MAX_MESSAGE_BYTES:
+        raise ValueError(f'Message of {size} bytes is too large')
+    data = _recv_exact(sock, size)
+    if data is None:
+        return None
+    return msgpack.unpackb(data, raw=False)
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _is_number(value):
+    return _is_int(value) or isinstance(value, float)
+
+# Revisa la forma de los argumentos de cada operación antes de encolarla, para que una petición mal formada
+# no llegue al hilo escritor
+def _valid_args(operation, args):
+    if operation == 'insert':
+        return (len(args) == 2 and isinstance(args[0], list) and _is_int(args[1])
+                and all(isinstance(row, list) and len(row) == 2 and _is_int(row[0]) and isinstance(row[1], str)
+                        for row in args[0]))
+    if operation == 'update':
+        return (len(args) == 4 and _is_int(args[0]) and _is_int(args[1]) and isinstance(args[2], str)
+                and _is_int(args[3]))
+    if operation == 'delete':
+        return len(args) == 2 and _is_int(args[0]) and _is_int(args[1])
+    if operation == 'retention':
+        return (len(args) == 2 and (args[0] is None or _is_number(args[0]))
+                and (args[1] is None or _is_number(args[1])))
+    if operation == 'purge':
+        return (len(args) == 2 and isinstance(args[0], list) and all(_is_int(sensor_id) for sensor_id in args[0])
+                and _is_int(args[1]))
+    if operation == 'set_hot_fields':
+        return (len(args) == 2 and isinstance(args[0], str) and isinstance(args[1], list)
+                and all(isinstance(path, str) for path in args[1]))
+    return not args
+
+# Las filas de sqlite3 se envían como diccionarios
+def _row(row):
+    return None if row is None else dict(row)
+
+class WriterServer:
+    # connect() retorna la conexión a la base que usa el hilo escritor
+    def __init__(self, path, backend, connect, max_batch=5000, logger=None):
+        self.path = path
+        self.backend = backend
+        self.connect = connect
+        self.max_batch = max_batch
+        self.logger = logger or logging.getLogger(__name__)
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self.clients = 0
+        self.requests = 0
+        self.failed = 0
+        self.batches = 0
+        self.largest_batch = 0
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            # Socket de un escritor anterior que no se cerró bien
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        listener.listen(128)
+        threading.Thread(target=self._run, name='writer', daemon=True).start()
+        while True:
+            sock, _ = listener.accept()
+            threading.Thread(target=self._serve_client, args=(sock,), name='writer-client', daemon=True).start()
+
+    # Un hilo por conexión: recibe peticiones, las deja en la cola del hilo escritor y responde
+    def _serve_client(self, sock):
+        with self._lock:
+            self.clients += 1
+        try:
+            with sock:
+                while True:
+                    request = _recv(sock)
+                    if request is None:
+                        return
+                    if (not isinstance(request, list) or len(request) != 2 or request[0] not in OPERATIONS
+                            or not isinstance(request[1], list) or not _valid_args(*request)):
+                        _send(sock, {'error': 'Invalid writer request'})
+                        continue
+                    pending = Pending(request, True)
+                    self._requests.put(pending)
+                    try:
+                        _send(sock, {'result': pending.wait()})
+                    except Exception as e:
+                        _send(sock, {'error': str(e)})
+        except (OSError, ValueError) as e:
+            self.logger.warning('Writer client disconnected: %s', e)
+        finally:
+            with self._lock:
+                self.clients -= 1
+
+    def _run(self):
+        conn = self.connect()
+        held = None
+        while True:
+            pending = held if held is not None else self._requests.get()
+            held = None
+            batch = [pending]
+            try:
+                operation, args = pending.payload
+                if operation != 'insert':
+                    self._execute(conn, pending)
+                    continue
+
+                # Las inserciones que ya están en la cola con el mismo tiempo van en la misma transacción
+                count = len(args[0])
+                while count < self.max_batch:
+                    try:
+                        item = self._requests.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item.payload[0] != 'insert' or item.payload[1][1] != args[1]:
+                        held = item
+                        break
+                    batch.append(item)
+                    count += len(item.payload[1][0])
+                self._insert(conn, batch, args[1])
+            except Exception as e:
+                # Un error inesperado no debe terminar el hilo: las peticiones quedarían esperando para siempre
+                self.logger.exception('Writer request failed')
+                with self._lock:
+                    self.failed += len(batch)
+                for item in batch:
+                    if not item.done():
+                        item.resolve(error=e)
+
+    def _insert(self, conn, batch, ts):
+        rows = [(sensor_id, data_json) for pending in batch for sensor_id, data_json in pending.payload[1][0]]
+        try:
+            ids = self.backend.insert(conn, rows, ts)
+        except Exception as e:
+            self.logger.error('Writer insert failed: %s', e)
+            with self._lock:
+                self.failed += len(batch)
+            for pending in batch:
+                pending.resolve(error=e)
+            return
+        with self._lock:
+            self.requests += len(batch)
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, len(batch))
+        offset = 0
+        for pending in batch:
+            size = len(pending.payload[1][0])
+            pending.resolve(result=ids[offset:offset + size])
+            offset += size
+
+    def _execute(self, conn, pending):
+        operation, args = pending.payload
+        try:
+            if operation == 'update':
+                result = _row(self.backend.update(conn, *args))
+            elif operation == 'delete':
+                result = _row(self.backend.delete(conn, *args))
+            elif operation == 'retention':
+                result = self.backend.apply_retention(conn, *args)
+            elif operation == 'purge':
+                result = self.backend.purge_sensors(conn, *args)
+            elif operation == 'set_hot_fields':
+                result = list(self.backend.set_hot_fields(conn, *args))
+            elif operation == 'stats':
+                result = self.stats()
+            else:
+                result = True
+        except Exception as e:
+            self.logger.error('Writer %s failed: %s', operation, e)
+            with self._lock:
+                self.failed += 1
+            pending.resolve(error=e)
+            return
+        with self._lock:
+            self.requests += 1
+        pending.resolve(result=result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'backend': self.backend.name,
+                'clients': self.clients,
+                'queue_depth': self._requests.qsize(),
+                'requests': self.requests,
+                'failed': self.failed,
+                'batches': self.batches,
+                'largest_batch': self.largest_batch,
+            }
+
+class WriterClient:
+    def __init__(self, path, timeout=10.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _socket(self):
+        sock = getattr(self._local, 'sock', None)
+        # Después de un fork no se reutiliza la conexión del proceso padre
+        if sock is None or self._local.pid != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._local.sock = sock
+            self._local.pid = os.getpid()
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    # timeout reemplaza el de la conexión para esta llamada (p. ej. operaciones que crean índices)
+    def call(self, operation, *args, timeout=None):
+        try:
+            reused = getattr(self._local, 'sock', None) is not None and self._local.pid == os.getpid()
+            sock = self._socket()
+            try:
+                _send(sock, [operation, list(args)])
+            except OSError:
+                if not reused:
+                    raise
+                # La conexión quedó de un escritor que ya terminó; la petición no llegó, así que se reintenta
+                self._close()
+                sock = self._socket()
+                _send(sock, [operation, list(args)])
+        except (OSError, ValueError) as e:
+            # Si el escritor se reinició, la siguiente llamada abre otra conexión
+            self._close()
+            raise WriterError(f'Writer process is unavailable: {e}')
+        # Un mensaje incompleto no se aplica, pero desde aquí el escritor pudo recibirlo completo
+        try:
+            if timeout is not None:
+                sock.settimeout(timeout)
+            reply = _recv(sock)
+            if timeout is not None:
+                sock.settimeout(self.timeout)
+        except (OSError, ValueError) as e:
+            self._close()
+            raise WriterReplyLost(f'No reply from writer process: {e}')
+        if reply is None:
+            self._close()
+            raise WriterReplyLost('Writer process closed the connection')
+        # El escritor informa el error después de deshacer la operación
+        if 'error' in reply:
+            raise WriterError(reply['error'])
+        return reply['result']
+
+# Backend de lecturas para los workers: lee con el backend local y envía las escrituras al proceso escritor
+class RemoteWriteBackend:
+    # schema_timeout es la espera de las operaciones que cambian el esquema de Sensor_Data
+    def __init__(self, local, client, schema_timeout=None):
+        self.local = local
+        self.client = client
+        self.schema_timeout = schema_timeout
+        self.name = local.name
+        # Solo si el backend local tiene campos frecuentes, así hasattr(backend, 'set_hot_fields') lo sigue indicando
+        if hasattr(local, 'set_hot_fields'):
+            self.set_hot_fields = self._set_hot_fields
+        # La llamada y after_commit se hacen juntos para que quien recibe los ids los reciba en orden
+        self._commit_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.local, name)
+
+    def insert(self, conn, rows, ts, after_commit=None):
+        with self._commit_lock:
+            ids = self.client.call('insert', [list(row) for row in rows], ts)
+            if after_commit is not None:
+                after_commit(ids)
+        return ids
+
+    def update(self, conn, sensor_data_id, company_id, data_json, ts):
+        return self.client.call('update', sensor_data_id, company_id, data_json, ts)
+
+    def delete(self, conn, sensor_data_id, company_id):
+        return self.client.call('delete', sensor_data_id, company_id)
+
+    def apply_retention(self, conn, global_days, now=None):
+        return self.client.call('retention', global_days, now)
+
+    def purge_sensors(self, conn, sensor_ids, limit):
+        return self.client.call('purge', list(sensor_ids), limit)
+
+    # Las columnas generadas y sus índices los crea el escritor, que es el dueño de las escrituras de Sensor_Data
+    def _set_hot_fields(self, conn, sensor_category, paths):
+        return tuple(self.client.call('set_hot_fields', sensor_category, list(paths), timeout=self.schema_timeout))
+
+    def stats(self):
+        return self.client.call('stats')
+
+# Corre el escritor en un proceso aparte (lo inicia el maestro de gunicorn, ver gunicorn.conf.py) y lo
+# vuelve a iniciar si termina. command es el comando que llama a WriterServer.serve_forever.
+# Se usa subprocess en vez de multiprocessing: el proceso nuevo no hereda los sockets ni los manejadores de
+# señales del maestro, y los workers (que también son hijos del maestro) no intentan esperarlo al salir
+class WriterProcess:
+    def __init__(self, path, command, cwd=None, ready_timeout=30.0, logger=None):
+        self.path = path
+        self.command = command
+        self.cwd = cwd
+        self.ready_timeout = ready_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.process = None
+        self.restarts = 0
+        self._stopping = threading.Event()
+        self._supervisor = None
+
+    def start(self):
+        self._spawn()
+        self._supervisor = threading.Thread(target=self._supervise, name='writer-supervisor', daemon=True)
+        self._supervisor.start()
+
+    def _spawn(self):
+        self.process = subprocess.Popen(self.command, cwd=self.cwd)
+        client = WriterClient(self.path, timeout=1.0)
+        deadline = time.monotonic() + self.ready_timeout
+        while True:
+            try:
+                client.call('ping')
+                client._close()
+                return
+            except WriterError:
+                if not self.alive() or time.monotonic() > deadline:
+                    raise WriterError('Writer process did not start')
+                time.sleep(0.05)
+
+    # El maestro de gunicorn recoge a los hijos que terminan, así que además de is_alive se revisa el pid
+    def alive(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            os.kill(self.process.pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def _supervise(self):
+        while not self._stopping.wait(1.0):
+            if self.alive():
+                continue
+            self.logger.error('Writer process exited; restarting it')
+            try:
+                self._spawn()
+                self.restarts += 1
+            except WriterError as e:
+                self.logger.error('Could not restart writer process: %s', e)
+
+    def stop(self, timeout=10.0):
+        self._stopping.set()
+        if self.process is not None and self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if os.path.exists(self.path):
+            os.remove(self.path)